@@ -0,0 +1,487 @@
+"""
+Length-bucketed batched prediction.
+
+`trainer.predict` runs the predict dataloader one piece per batch, and every
+piece is split into chunks that go through the model one at a time. Here the
+pieces are streamed from the dataloader in windows of `PIECE_WINDOW` pieces,
+and the chunks of the pieces of a window are pooled, sorted by length and run
+in batches of equal-length chunks, so no padding (and no attention mask) is
+needed. Every chunk is predicted on the same input as in the
+one-piece-per-batch path, but batched kernels (and autocast) are not
+guaranteed to be bitwise identical to batch-1 forward passes, so the logits
+match within numerical tolerance. The chunk predictions are then scattered
+back to their pieces, aggregated, postprocessed and scored in the original
+order. The scoring uses the vectorized `beat_metrics.compute_metrics`
+instead of the per-piece mir_eval calls of `trainer.predict`. Only the
+spectrograms of one window are held in memory.
+
+`check_batching` runs both paths on a few pieces and reports the largest
+logit and metric differences, and `beat_metrics.check_parity` of the
+batched predictions against mir_eval.
+
+with `telemetry=True`, the time spent on every piece is measured and split
+into data loading, model forward (the time of every batch is apportioned to
+its chunks), postprocessing and metric scoring (apportioned by number of
+beats), along with the duration of the piece and its real-time factor.
+`peak_rss_mb` gives the peak memory of the process for the run summary.
+
+example usage
+---
+    out = predict_bucketed(model, trainer, predict_dataloader, batch_size=32)
+    # same structure as trainer.predict(model, predict_dataloader)
+"""
+
+import sys
+import time
+from collections import defaultdict
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader
+
+from beat_this.inference import aggregate_prediction, split_piece
+
+import beat_metrics
+import dbn
+
+# as in PLBeatThis.predict_step
+CHUNK_SIZE = 1500
+BORDER_SIZE = 6
+OVERLAP_MODE = "keep_first"
+# frames per second of the spectrograms
+FPS = 50
+# number of pieces whose chunks are pooled into batches at a time
+PIECE_WINDOW = 64
+
+
+def as_times(x):
+    """
+    beat times of a dataset item, which are stored as raw bytes so that pieces
+    of different lengths can be collated
+    """
+    if isinstance(x, (bytes, bytearray)):
+        return np.frombuffer(x)
+    return np.asarray(x, dtype=np.float64)
+
+
+def piece_windows(dataset, num_workers=0, window=PIECE_WINDOW):
+    """
+    stream the items of a predict dataset, in order, in windows of up to
+    `window` items, so that only one window of spectrograms is in memory
+
+    yield
+    ---
+        items : list[dict]
+            dataset items of the window
+        seconds : list[float]
+            time spent waiting for each item
+    """
+    loader = DataLoader(dataset, batch_size=None, num_workers=num_workers)
+    items, seconds = [], []
+    start = time.perf_counter()
+    for item in loader:
+        now = time.perf_counter()
+        items.append(item)
+        seconds.append(now - start)
+        if len(items) == window:
+            yield items, seconds
+            items, seconds = [], []
+        # the time spent on the window is not waiting for the loader
+        start = time.perf_counter()
+    if items:
+        yield items, seconds
+
+
+def peak_rss_mb():
+    """
+    peak resident memory of this process in MB, nan where it is not available
+    """
+    try:
+        import resource
+    except ImportError:
+        return np.nan
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes on linux
+    if sys.platform == "darwin":
+        return peak / 2**20
+    return peak / 1024
+
+
+def synchronize(device):
+    """
+    wait for the queued kernels, so that wall times are meaningful on GPU
+    """
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+
+
+def make_buckets(chunk_lengths, batch_size):
+    """
+    group chunk indices into batches of equal-length chunks, longest first
+
+    arguments
+    ---
+        chunk_lengths : np.array
+            number of frames of each chunk
+        batch_size : int
+            maximum number of chunks per batch
+
+    return
+    ---
+        batches : list[np.array]
+            chunk indices of each batch
+    """
+    chunk_lengths = np.asarray(chunk_lengths)
+    batches = []
+    for length in np.unique(chunk_lengths)[::-1]:
+        same = np.flatnonzero(chunk_lengths == length)
+        batches.extend(np.array_split(same, -(-len(same) // batch_size)))
+    return batches
+
+
+def autocast_context(trainer, device):
+    """
+    autocast matching the precision of the trainer
+    """
+    precision = str(getattr(trainer, "precision", "32-true"))
+    if precision.startswith("16"):
+        return torch.autocast(device.type, dtype=torch.float16)
+    if precision.startswith("bf16"):
+        return torch.autocast(device.type, dtype=torch.bfloat16)
+    return torch.autocast(device.type, enabled=False)
+
+
+def run_chunks(model, chunks, batch_size, device, autocast, timed=False):
+    """
+    run the network on a list of chunks, batching chunks of equal length
+
+    return
+    ---
+        preds : list[dict]
+            beat and downbeat logits of each chunk, in the order of `chunks`
+        seconds : np.array
+            only if `timed`, forward time of each chunk: the time of every
+            batch split evenly between its (equal-length) chunks
+    """
+    preds = [None] * len(chunks)
+    seconds = np.zeros(len(chunks))
+    for batch in make_buckets([len(c) for c in chunks], batch_size):
+        start = time.perf_counter()
+        x = torch.stack([chunks[i] for i in batch]).to(device)
+        with autocast:
+            out = model(x)
+        for j, i in enumerate(batch):
+            preds[i] = {k: out[k][j].float() for k in ("beat", "downbeat")}
+        if timed:
+            synchronize(device)
+            seconds[batch] = (time.perf_counter() - start) / len(batch)
+    if timed:
+        return preds, seconds
+    return preds
+
+
+def predict_spects(network, spects, batch_size, device, autocast, timed=False):
+    """
+    beat and downbeat logits of whole spectrograms, with the chunks of all the
+    spectrograms pooled into length-bucketed batches
+
+    arguments
+    ---
+        network : BeatThis
+            the network (not the lightning module)
+        spects : list[torch.Tensor]
+            spectrograms of shape (frames, mels)
+        batch_size : int
+            maximum number of chunks per forward pass
+        device : torch.device
+            device to run the network on
+        autocast : torch.autocast
+            autocast context for the forward passes
+        timed : bool
+            also return the forward time of each spectrogram
+
+    return
+    ---
+        logits : list[tuple]
+            (beat, downbeat) frame logits of each spectrogram
+        seconds : list[float]
+            only if `timed`, forward time of the chunks of each spectrogram
+            plus the time to aggregate them
+    """
+    # split every spectrogram into chunks
+    chunks, owner, starts = [], [], defaultdict(list)
+    for i, spect in enumerate(spects):
+        piece_chunks, piece_starts = split_piece(
+            spect, CHUNK_SIZE, border_size=BORDER_SIZE, avoid_short_end=True
+        )
+        chunks.extend(piece_chunks)
+        owner.extend([i] * len(piece_chunks))
+        starts[i] = piece_starts
+
+    if timed:
+        chunk_preds, chunk_seconds = run_chunks(
+            network, chunks, batch_size, device, autocast, timed=True
+        )
+        seconds = np.bincount(owner, weights=chunk_seconds, minlength=len(spects))
+    else:
+        chunk_preds = run_chunks(network, chunks, batch_size, device, autocast)
+
+    # scatter the chunk predictions back to their spectrograms
+    piece_chunk_preds = defaultdict(list)
+    for i, pred in zip(owner, chunk_preds):
+        piece_chunk_preds[i].append(pred)
+
+    logits = []
+    for i, spect in enumerate(spects):
+        start = time.perf_counter()
+        logits.append(
+            aggregate_prediction(
+                piece_chunk_preds[i],
+                starts[i],
+                spect.shape[0],
+                CHUNK_SIZE,
+                BORDER_SIZE,
+                OVERLAP_MODE,
+                device,
+            )
+        )
+        if timed:
+            synchronize(device)
+            seconds[i] += time.perf_counter() - start
+    if timed:
+        return logits, seconds.tolist()
+    return logits
+
+
+def postprocessing_name(postprocessor):
+    """
+    short name of a postprocessor for the telemetry, e.g. "minimal", "dbn" or
+    "fast_dbn"
+    """
+    if isinstance(postprocessor, dbn.DBNPostprocessor):
+        return "fast_dbn"
+    return getattr(postprocessor, "type", type(postprocessor).__name__)
+
+
+def postprocess_pieces(postprocessor, logits, timed=False):
+    """
+    beat and downbeat times of every piece. pieces are decoded in parallel by
+    the NumPy DBN, unless `timed`, in which case every piece is postprocessed
+    on its own and timed
+
+    return
+    ---
+        beats : list[np.array]
+        downbeats : list[np.array]
+        seconds : list[float]
+            postprocessing time of each piece, only if `timed`
+    """
+    if isinstance(postprocessor, dbn.DBNPostprocessor) and not timed:
+        # decode all the pieces in parallel
+        return postprocessor.map(*zip(*logits))
+    beats, downbeats, seconds = [], [], []
+    for beat, downbeat in logits:
+        start = time.perf_counter()
+        postp_beat, postp_downbeat = postprocessor(beat, downbeat)
+        seconds.append(time.perf_counter() - start)
+        beats.append(postp_beat)
+        downbeats.append(postp_downbeat)
+    if timed:
+        return beats, downbeats, seconds
+    return beats, downbeats
+
+
+@torch.inference_mode()
+def predict_bucketed(
+    model, trainer, predict_dataloader, batch_size=32, telemetry=False, window=PIECE_WINDOW
+):
+    """
+    batched replacement for `trainer.predict(model, predict_dataloader)`
+
+    arguments
+    ---
+        model : PLBeatThis
+            model to evaluate
+        trainer : Trainer
+            trainer from `plmodel_setup`, used for the device and precision
+        predict_dataloader : DataLoader
+            one piece per batch predict dataloader
+        batch_size : int
+            maximum number of chunks per forward pass
+        telemetry : bool
+            time every piece. the postprocessing of the pieces is then not
+            parallelized, so that it can be attributed to them
+        window : int
+            number of pieces loaded and batched together
+
+    return
+    ---
+        out : list
+            one (metrics, prediction, [dataset], [piece]) tuple per piece, in
+            the original order, like trainer.predict. with `telemetry`, every
+            tuple has a fifth element, the dict of timings of the piece (see
+            `piece_telemetry`)
+    """
+    device = trainer.strategy.root_device
+    network = model.model.to(device).eval()
+    autocast = autocast_context(trainer, device)
+    out = []
+    for items, load_seconds in piece_windows(
+        predict_dataloader.dataset, predict_dataloader.num_workers, window
+    ):
+        out.extend(
+            predict_window(
+                model, network, items, load_seconds, batch_size, device, autocast, telemetry
+            )
+        )
+    return out
+
+
+def predict_window(
+    model, network, items, load_seconds, batch_size, device, autocast, telemetry=False
+):
+    """
+    predictions, metrics and (with `telemetry`) timings of a window of pieces,
+    see `predict_bucketed`
+    """
+    spects = [item["spect"] for item in items]
+    if telemetry:
+        logits, forward_seconds = predict_spects(
+            network, spects, batch_size, device, autocast, timed=True
+        )
+        predictions = [{"beat": b, "downbeat": d} for b, d in logits]
+        beats, downbeats, postprocessing_seconds = postprocess_pieces(
+            model.postprocessor, logits, timed=True
+        )
+    else:
+        logits = predict_spects(network, spects, batch_size, device, autocast)
+        predictions = [{"beat": b, "downbeat": d} for b, d in logits]
+        beats, downbeats = postprocess_pieces(model.postprocessor, logits)
+
+    truth_beats = [as_times(item["truth_orig_beat"]) for item in items]
+    truth_downbeats = [as_times(item["truth_orig_downbeat"]) for item in items]
+    start = time.perf_counter()
+    metrics = beat_metrics.compute_metrics(
+        truth_beats,
+        beats,
+        truth_downbeats,
+        downbeats,
+        eval_trim_beats=model.eval_trim_beats,
+    )
+    metrics_seconds = time.perf_counter() - start
+
+    out = [
+        (
+            {k: v[i] for k, v in metrics.items()},
+            predictions[i],
+            [item["dataset"]],
+            [item["spect_path"]],
+        )
+        for i, item in enumerate(items)
+    ]
+    if not telemetry:
+        return out
+
+    # the metrics are computed for all the pieces of the window at once, their
+    # cost grows with the number of beats
+    num_beats = np.asarray(
+        [
+            sum(len(x) for x in times)
+            for times in zip(truth_beats, beats, truth_downbeats, downbeats)
+        ],
+        dtype=float,
+    )
+    if num_beats.sum() > 0:
+        metrics_share = num_beats / num_beats.sum()
+    else:
+        metrics_share = np.full(len(items), 1 / max(len(items), 1))
+    postprocessing = postprocessing_name(model.postprocessor)
+    return [
+        o
+        + (
+            piece_telemetry(
+                load_seconds[i],
+                forward_seconds[i],
+                postprocessing_seconds[i],
+                metrics_seconds * metrics_share[i],
+                len(item["spect"]) / FPS,
+                postprocessing,
+            ),
+        )
+        for i, (o, item) in enumerate(zip(out, items))
+    ]
+
+
+@torch.inference_mode()
+def check_batching(model, trainer, predict_dataloader, batch_size=32):
+    """
+    compare `predict_bucketed` with `trainer.predict` on the pieces of a
+    (small) predict dataloader
+
+    return
+    ---
+        max_diff : dict
+            largest absolute difference over the pieces of the "beat_logits"
+            and "downbeat_logits" and of every logged metric between the two
+            paths, and in "parity_beat" and "parity_downbeat" the
+            `beat_metrics.check_parity` differences of the batched
+            predictions to mir_eval for every metric
+    """
+    reference = trainer.predict(model, predict_dataloader)
+    batched = predict_bucketed(model, trainer, predict_dataloader, batch_size)
+
+    max_diff = {}
+    for key in ("beat", "downbeat"):
+        max_diff[f"{key}_logits"] = max(
+            (
+                float(
+                    torch.max(
+                        torch.abs(
+                            r[1][key].float().cpu().reshape(-1)
+                            - b[1][key].float().cpu().reshape(-1)
+                        )
+                    )
+                )
+                for r, b in zip(reference, batched)
+            ),
+            default=0.0,
+        )
+    for name in batched[0][0] if batched else []:
+        max_diff[name] = max(
+            abs(float(r[0][name]) - float(b[0][name])) for r, b in zip(reference, batched)
+        )
+
+    logits = [(b[1]["beat"], b[1]["downbeat"]) for b in batched]
+    beats, downbeats = postprocess_pieces(model.postprocessor, logits)
+    items = [predict_dataloader.dataset[i] for i in range(len(batched))]
+    for key, pred in (("beat", beats), ("downbeat", downbeats)):
+        truth = [as_times(item[f"truth_orig_{key}"]) for item in items]
+        # report the differences instead of asserting them
+        max_diff[f"parity_{key}"] = beat_metrics.check_parity(
+            truth, pred, model.eval_trim_beats, atol=np.inf
+        )
+    return max_diff
+
+
+def piece_telemetry(load, forward, postprocessing, metrics, duration, postprocessor):
+    """
+    timings of one piece, in seconds
+
+    return
+    ---
+        telemetry : dict
+            the time spent on each stage, their total, the duration of the
+            piece, the real-time factor (total time over duration) and the
+            postprocessor
+    """
+    total = load + forward + postprocessing + metrics
+    return {
+        "load_s": load,
+        "forward_s": forward,
+        "postprocessing_s": postprocessing,
+        "metrics_s": metrics,
+        "total_s": total,
+        "duration_s": duration,
+        "rtf": total / duration if duration > 0 else np.nan,
+        "postprocessor": postprocessor,
+    }
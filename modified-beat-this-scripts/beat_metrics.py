@@ -0,0 +1,433 @@
+"""
+Vectorized beat tracking metrics for many pieces at once.
+
+Drop-in replacement for the per-piece mir_eval scoring of the eight metrics
+logged by `compute_predictions` (F-measure, Cemgil, CMLt and AMLt for beats
+and downbeats). All the pieces are scored together: their beat times are
+concatenated into a single array, and `offsets` marks where each piece starts
+(piece `i` is `values[offsets[i]:offsets[i + 1]]`). Nearest-beat lookups are
+done with one searchsorted over all the pieces, so there are no Python loops
+over pieces or beats, except for the (rare) pieces where F-measure windows
+overlap and a greedy matching is needed.
+
+The results agree with mir_eval.beat to floating point precision; use
+`check_parity` to verify it on a set of predictions.
+
+example usage
+---
+    import beat_metrics
+
+    metrics = beat_metrics.compute_metrics(
+        truth_beats, pred_beats, truth_downbeats, pred_downbeats, eval_trim_beats=5
+    )
+    metrics["F-measure_beat"]  # np.array with one value per piece
+"""
+
+import numpy as np
+
+METRIC_NAMES = ("F-measure", "Cemgil", "CMLt", "AMLt")
+
+
+def pack(pieces):
+    """
+    concatenate a list of per-piece beat arrays
+
+    return
+    ---
+        values : np.array
+            concatenated beat times
+        offsets : np.array
+            start of each piece in `values`, with a final entry for the end
+    """
+    pieces = [np.asarray(p, dtype=np.float64).ravel() for p in pieces]
+    offsets = np.zeros(len(pieces) + 1, dtype=np.int64)
+    np.cumsum([len(p) for p in pieces], out=offsets[1:])
+    values = np.concatenate(pieces) if pieces else np.zeros(0)
+    return values, offsets
+
+
+def unpack(values, offsets):
+    """
+    split concatenated beat times back into a list of per-piece arrays
+    """
+    return np.split(values, offsets[1:-1])
+
+
+def segment_ids(offsets):
+    """
+    piece index of every entry of the concatenated values
+    """
+    return np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+
+
+def trim_beats(values, offsets, min_beat_time=5.0):
+    """
+    remove beats before `min_beat_time` from every piece, like
+    mir_eval.beat.trim_beats
+    """
+    keep = values >= min_beat_time
+    return values[keep], _offsets_from_mask(keep, segment_ids(offsets), len(offsets) - 1)
+
+
+def _offsets_from_mask(mask, seg, n_pieces):
+    """
+    offsets of the entries selected by `mask`, given the piece index `seg` of
+    every entry
+    """
+    offsets = np.zeros(n_pieces + 1, dtype=np.int64)
+    np.cumsum(np.bincount(seg[mask], minlength=n_pieces), out=offsets[1:])
+    return offsets
+
+
+def segmented_searchsorted(a, a_offsets, v, v_offsets, side="left"):
+    """
+    np.searchsorted of each piece of `v` into the same piece of `a`, for all
+    the pieces at once. `a` must be sorted inside each piece.
+
+    return
+    ---
+        idx : np.array
+            global insertion indices into `a`, i.e. the local index plus the
+            start of the piece in `a`
+    """
+    n = len(a)
+    a_seg = segment_ids(a_offsets)
+    v_seg = segment_ids(v_offsets)
+    # with side="left" the values go before equal elements of `a`
+    a_kind, v_kind = (1, 0) if side == "left" else (0, 1)
+    kind = np.concatenate((np.full(n, a_kind), np.full(len(v), v_kind)))
+    order = np.lexsort((kind, np.concatenate((a, v)), np.concatenate((a_seg, v_seg))))
+
+    is_a = order < n
+    a_before = np.cumsum(is_a) - is_a
+    idx = np.empty(len(v), dtype=np.int64)
+    idx[order[~is_a] - n] = a_before[~is_a]
+    return idx
+
+
+def _nearest(ref, ref_offsets, est, est_offsets):
+    """
+    index into `ref` of the nearest reference beat of every estimated beat of
+    the same piece, resolving ties like np.argmin (first minimal index).
+    pieces with no reference beats get -1
+    """
+    nearest = np.full(len(est), -1, dtype=np.int64)
+    if len(ref) == 0:
+        return nearest
+
+    idx = segmented_searchsorted(ref, ref_offsets, est, est_offsets)
+    seg = segment_ids(est_offsets)
+    has_left = idx > ref_offsets[seg]
+    has_right = idx < ref_offsets[seg + 1]
+    left = np.maximum(idx - 1, 0)
+    right = np.minimum(idx, len(ref) - 1)
+    d_left = np.where(has_left, np.abs(est - ref[left]), np.inf)
+    d_right = np.where(has_right, np.abs(est - ref[right]), np.inf)
+
+    valid = has_left | has_right
+    nearest[valid] = np.where(d_left <= d_right, left, right)[valid]
+
+    # with repeated reference values np.argmin picks the first one
+    if (np.diff(ref) == 0).any():
+        nearest[valid] = segmented_searchsorted(
+            ref,
+            ref_offsets,
+            ref[nearest[valid]],
+            _offsets_from_mask(valid, seg, len(ref_offsets) - 1),
+        )
+    return nearest
+
+
+def _greedy_matches(ref, est, window):
+    """
+    size of the maximum matching of a single piece, like
+    mir_eval.util.match_events. since both sequences are sorted, the hit
+    windows of consecutive estimated beats are monotonic and matching every
+    estimated beat to the first free reference beat is optimal
+    """
+    left = np.searchsorted(ref, est - window, side="left")
+    right = np.searchsorted(ref, est + window, side="right")
+    matches, free = 0, 0
+    for start, end in zip(left, right):
+        free = max(free, start)
+        if free < end:
+            matches += 1
+            free += 1
+    return matches
+
+
+def f_measure(ref, ref_offsets, est, est_offsets, window=0.07):
+    """
+    F-measure of every piece, like mir_eval.beat.f_measure
+    """
+    n_pieces = len(ref_offsets) - 1
+    n_ref = np.diff(ref_offsets)
+    n_est = np.diff(est_offsets)
+
+    # reference beats inside the window of each estimated beat, as in
+    # mir_eval.util._fast_hit_windows
+    left = segmented_searchsorted(ref, ref_offsets, est - window, est_offsets, "left")
+    right = segmented_searchsorted(ref, ref_offsets, est + window, est_offsets, "right")
+    seg = segment_ids(est_offsets)
+    hit = right > left
+
+    # if the windows of the estimated beats do not overlap, each estimated
+    # beat with a hit is matched
+    matches = np.bincount(seg[hit], minlength=n_pieces)
+    h_seg, h_left, h_right = seg[hit], left[hit], right[hit]
+    overlap = (h_seg[1:] == h_seg[:-1]) & (h_right[:-1] > h_left[1:])
+    for piece in np.unique(h_seg[1:][overlap]):
+        matches[piece] = _greedy_matches(
+            ref[ref_offsets[piece] : ref_offsets[piece + 1]],
+            est[est_offsets[piece] : est_offsets[piece + 1]],
+            window,
+        )
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        precision = matches / n_est
+        recall = matches / n_ref
+        f = 2.0 * precision * recall / (precision + recall)
+    f[(n_ref == 0) | (n_est == 0) | (matches == 0)] = 0.0
+    return f
+
+
+def cemgil(ref, ref_offsets, est, est_offsets, sigma=0.04):
+    """
+    Cemgil accuracy of every piece with the original metrical level, like
+    mir_eval.beat.cemgil(...)[0]
+    """
+    n_pieces = len(ref_offsets) - 1
+    n_ref = np.diff(ref_offsets)
+    n_est = np.diff(est_offsets)
+
+    # nearest estimated beat of every reference beat
+    nearest = _nearest(est, est_offsets, ref, ref_offsets)
+    valid = nearest >= 0
+    diff = np.abs(ref[valid] - est[nearest[valid]])
+    error = np.exp(-(diff**2) / (2.0 * sigma**2))
+    accuracy = np.bincount(segment_ids(ref_offsets)[valid], error, minlength=n_pieces)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        accuracy = accuracy / (0.5 * (n_est + n_ref))
+    accuracy[(n_ref == 0) | (n_est == 0)] = 0.0
+    return accuracy
+
+
+def _reference_variations(ref, ref_offsets):
+    """
+    metrical variations of the reference beats of every piece, like
+    mir_eval.beat._get_reference_beat_variations: original, off-beat, double
+    tempo, half tempo odd and half tempo even
+    """
+    seg = segment_ids(ref_offsets)
+    local = np.arange(len(ref)) - ref_offsets[seg]
+    n_ref = np.diff(ref_offsets)
+
+    # off-beats interpolated the same way as np.interp
+    has_next = local < n_ref[seg] - 1
+    nxt = np.minimum(np.arange(len(ref)) + 1, len(ref) - 1)
+    off_beat = ((ref[nxt] - ref) * 0.5 + ref)[has_next]
+    off_seg = seg[has_next]
+
+    double = np.concatenate((ref, off_beat))
+    double_seg = np.concatenate((seg, off_seg))
+    double_rank = np.concatenate((2 * local, 2 * local[has_next] + 1))
+    order = np.lexsort((double_rank, double_seg))
+
+    odd, even = local % 2 == 0, local % 2 == 1
+    n_pieces = len(n_ref)
+    return [
+        (ref, ref_offsets),
+        (off_beat, _offsets_from_mask(has_next, seg, n_pieces)),
+        (double[order], ref_offsets + np.concatenate(([0], np.cumsum(np.maximum(n_ref - 1, 0))))),
+        (ref[odd], _offsets_from_mask(odd, seg, n_pieces)),
+        (ref[even], _offsets_from_mask(even, seg, n_pieces)),
+    ]
+
+
+def _continuity_variation(ref, ref_offsets, est, est_offsets, phase_threshold, period_threshold):
+    """
+    continuous and total accuracy of every piece for one reference variation.
+    follows the loop of mir_eval.beat.continuity, expressed over all the
+    estimated beats at once
+    """
+    n_pieces = len(ref_offsets) - 1
+    n_ref = np.diff(ref_offsets)
+    n_est = np.diff(est_offsets)
+    if len(ref) == 0 or len(est) == 0:
+        return np.zeros(n_pieces), np.zeros(n_pieces)
+
+    seg = segment_ids(est_offsets)
+    idx = np.arange(len(est))
+    m = idx - est_offsets[seg]
+
+    nearest = _nearest(ref, ref_offsets, est, est_offsets)
+    valid = nearest >= 0
+    nearest_ = np.maximum(nearest, 0)
+    k = nearest_ - ref_offsets[seg]
+    min_difference = np.abs(est - ref[nearest_])
+
+    # like reference_beats[nearest - 1], wrapping around to the last beat
+    prev_ref = np.where(k > 0, nearest_ - 1, np.maximum(ref_offsets[seg + 1] - 1, 0))
+    next_ref = np.minimum(nearest_ + 1, len(ref) - 1)
+    est_next = np.minimum(idx + 1, len(est) - 1)
+    est_prev = np.maximum(idx - 1, 0)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        # first beat or first annotation: look forward
+        forward_ref_interval = np.where(
+            k + 1 < n_ref[seg],
+            ref[next_ref] - ref[nearest_],
+            ref[nearest_] - ref[prev_ref],
+        )
+        forward_est_interval = np.where(
+            m + 1 < n_est[seg], est[est_next] - est, est - est[est_prev]
+        )
+        forward_phase = np.abs(min_difference / forward_ref_interval)
+        forward_period = np.abs(1 - forward_est_interval / forward_ref_interval)
+        # a zero reference interval never matches
+        forward_phase[forward_ref_interval == 0] = np.inf
+
+        # otherwise look backward
+        backward_ref_interval = ref[nearest_] - ref[prev_ref]
+        backward_phase = np.abs(min_difference / backward_ref_interval)
+        backward_period = np.abs(1 - (est - est[est_prev]) / backward_ref_interval)
+
+        forward = (m == 0) | (k == 0)
+        phase = np.where(forward, forward_phase, backward_phase)
+        period = np.where(forward, forward_period, backward_period)
+        candidate = valid & (phase < phase_threshold) & (period < period_threshold)
+
+    # an annotation can only be used once: only the first candidate that picks
+    # it succeeds
+    success = np.zeros(len(est), dtype=bool)
+    candidates = np.flatnonzero(candidate)
+    _, first = np.unique(nearest[candidates], return_index=True)
+    success[candidates[first]] = True
+
+    n_annotations = np.maximum(n_ref, n_est)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        total = np.bincount(seg, success, minlength=n_pieces) / n_annotations
+
+        # longest run of consecutive successes in each piece
+        last_failure = np.maximum.accumulate(np.where(success, -1, idx))
+        run = np.where(success, idx - np.maximum(last_failure, est_offsets[seg] - 1), 0)
+        longest = np.zeros(n_pieces)
+        np.maximum.at(longest, seg, run)
+        continuous = longest / n_annotations
+
+    return continuous, total
+
+
+def continuity(
+    ref,
+    ref_offsets,
+    est,
+    est_offsets,
+    phase_threshold=0.175,
+    period_threshold=0.175,
+):
+    """
+    continuity metrics of every piece, like mir_eval.beat.continuity
+
+    return
+    ---
+        CMLc, CMLt, AMLc, AMLt : np.array
+            one value per piece
+    """
+    continuous, total = zip(
+        *[
+            _continuity_variation(
+                var, var_offsets, est, est_offsets, phase_threshold, period_threshold
+            )
+            for var, var_offsets in _reference_variations(ref, ref_offsets)
+        ]
+    )
+    continuous, total = np.asarray(continuous), np.asarray(total)
+
+    # pieces with less than two beats can not be scored
+    scored = (np.diff(ref_offsets) > 1) & (np.diff(est_offsets) > 1)
+    return tuple(
+        np.where(scored, x, 0.0)
+        for x in (continuous[0], total[0], continuous.max(axis=0), total.max(axis=0))
+    )
+
+
+def piece_metrics(truth, pred, eval_trim_beats=None):
+    """
+    F-measure, Cemgil, CMLt and AMLt of every piece for one kind of event
+    (beats or downbeats)
+
+    arguments
+    ---
+        truth, pred : list[np.array] or tuple(np.array, np.array)
+            per-piece event times, either as a list of arrays or already
+            packed as (values, offsets)
+        eval_trim_beats : float or None
+            skip the events before this time, as mir_eval.beat.trim_beats
+    """
+    ref, ref_offsets = truth if isinstance(truth, tuple) else pack(truth)
+    est, est_offsets = pred if isinstance(pred, tuple) else pack(pred)
+    if eval_trim_beats:
+        ref, ref_offsets = trim_beats(ref, ref_offsets, eval_trim_beats)
+        est, est_offsets = trim_beats(est, est_offsets, eval_trim_beats)
+
+    _, cmlt, _, amlt = continuity(ref, ref_offsets, est, est_offsets)
+    return {
+        "F-measure": f_measure(ref, ref_offsets, est, est_offsets),
+        "Cemgil": cemgil(ref, ref_offsets, est, est_offsets),
+        "CMLt": cmlt,
+        "AMLt": amlt,
+    }
+
+
+def compute_metrics(truth_beat, pred_beat, truth_downbeat, pred_downbeat, eval_trim_beats=None):
+    """
+    the eight per-piece metrics logged by `compute_predictions`, as a
+    dictionary {"F-measure_beat": np.array, ..., "AMLt_downbeat": np.array}
+    """
+    metrics = {}
+    for kind, truth, pred in (
+        ("beat", truth_beat, pred_beat),
+        ("downbeat", truth_downbeat, pred_downbeat),
+    ):
+        for name, values in piece_metrics(truth, pred, eval_trim_beats).items():
+            metrics[f"{name}_{kind}"] = values
+    return metrics
+
+
+def check_parity(truth, pred, eval_trim_beats=None, atol=1e-9):
+    """
+    compare `piece_metrics` with mir_eval on a list of pieces
+
+    return
+    ---
+        max_diff : dict
+            maximum absolute difference per metric. raises AssertionError if
+            any of them is larger than `atol`
+    """
+    import warnings
+
+    import mir_eval
+
+    fast = piece_metrics(truth, pred, eval_trim_beats)
+    reference = {name: [] for name in METRIC_NAMES}
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        for t, p in zip(truth, pred):
+            t, p = np.asarray(t, dtype=np.float64), np.asarray(p, dtype=np.float64)
+            if eval_trim_beats:
+                t = mir_eval.beat.trim_beats(t, eval_trim_beats)
+                p = mir_eval.beat.trim_beats(p, eval_trim_beats)
+            reference["F-measure"].append(mir_eval.beat.f_measure(t, p))
+            reference["Cemgil"].append(mir_eval.beat.cemgil(t, p)[0])
+            _, cmlt, _, amlt = mir_eval.beat.continuity(t, p)
+            reference["CMLt"].append(cmlt)
+            reference["AMLt"].append(amlt)
+
+    max_diff = {
+        name: float(np.max(np.abs(fast[name] - np.asarray(reference[name])), initial=0))
+        for name in METRIC_NAMES
+    }
+    assert all(d <= atol for d in max_diff.values()), f"metrics differ from mir_eval: {max_diff}"
+    return max_diff
@@ -0,0 +1,159 @@
+"""
+Benchmark CPU inference profiles against fp32 on a fixed subset of pieces.
+
+For every profile, reports the real-time factor (processing time divided by
+audio duration) and the difference of the averaged metrics with respect to
+plain fp32 inference. Every profile first runs an untimed warm-up pass over
+the pieces, so that the timings include neither reading the spectrograms from
+a cold disk cache nor the compilation of torch.compile.
+
+example usage
+---
+    python benchmark_cpu_inference.py \
+            --model final0.ckpt \
+            --datasplit test \
+            --num_pieces 50 \
+            --num_threads 8
+"""
+
+import argparse
+import time
+
+import numpy as np
+
+from compute_paper_metrics_modified import (
+    checkpoint_hparams,
+    datamodule_setup,
+    load_checkpoint_mmap,
+    plmodel_setup,
+    subset_dataloader,
+)
+
+FPS = 50
+
+# name: keyword arguments for plmodel_setup
+PROFILES = {
+    "fp32": dict(cpu_precision="32-true"),
+    "bf16": dict(cpu_precision="bf16-mixed"),
+    "int8": dict(cpu_precision="32-true", quantize=True),
+    "fp32+compile": dict(cpu_precision="32-true", compile_model=True),
+    "bf16+compile": dict(cpu_precision="bf16-mixed", compile_model=True),
+    "int8+compile": dict(cpu_precision="32-true", quantize=True, compile_model=True),
+}
+
+
+def run_profile(checkpoint_path, dataloader, profile, eval_trim_beats, dbn, num_threads):
+    """
+    run inference with one profile, after an untimed warm-up pass
+
+    return
+    ---
+        seconds : float
+            wall time of the (second) prediction
+        metrics : dict
+            metrics averaged over the pieces
+    """
+    checkpoint = load_checkpoint_mmap(checkpoint_path)
+    model, trainer = plmodel_setup(
+        checkpoint, eval_trim_beats, dbn, -1, num_threads=num_threads, **profile
+    )
+    # warm up the page cache, the compiled graphs and the allocator
+    trainer.predict(model, dataloader)
+    start = time.perf_counter()
+    out = trainer.predict(model, dataloader)
+    seconds = time.perf_counter() - start
+    metrics = {k: np.mean([o[0][k] for o in out]) for k in out[0][0]}
+    return seconds, metrics
+
+
+def main(args):
+    datamodule = datamodule_setup(
+        checkpoint_hparams(args.model), args.num_workers, args.datasplit
+    )
+    predict_dataloader = datamodule.predict_dataloader()
+    dataloader = subset_dataloader(
+        predict_dataloader,
+        np.arange(min(args.num_pieces, len(predict_dataloader.dataset))),
+    )
+    duration = sum(item["spect"].shape[0] for item in dataloader.dataset) / FPS
+    print(f"{len(dataloader.dataset)} pieces, {duration:.1f} s of audio")
+
+    results = {}
+    for name in ["fp32"] + [p for p in args.profiles if p != "fp32"]:
+        print(f"Running {name}")
+        results[name] = run_profile(
+            args.model,
+            dataloader,
+            PROFILES[name],
+            args.eval_trim_beats,
+            args.dbn,
+            args.num_threads,
+        )
+
+    _, reference = results["fp32"]
+    print(f"{'profile':<16}{'time (s)':>10}{'RTF':>10}  max |metric delta| vs fp32")
+    for name, (seconds, metrics) in results.items():
+        deltas = {k: metrics[k] - reference[k] for k in reference}
+        worst = max(deltas, key=lambda k: abs(deltas[k]))
+        print(
+            f"{name:<16}{seconds:>10.2f}{seconds / duration:>10.4f}  "
+            f"{worst}: {deltas[worst]:+.4f}"
+        )
+        for k, v in deltas.items():
+            print(f"\t{k}: {metrics[k]:.4f} ({v:+.4f})")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmarks CPU inference profiles (bf16, int8, torch.compile) "
+        "against fp32 on a fixed subset of pieces."
+    )
+    parser.add_argument("--model", type=str, required=True, help="Local checkpoint file")
+    parser.add_argument(
+        "--datasplit",
+        type=str,
+        choices=("train", "val", "test"),
+        default="val",
+        help="data split to use: train, val or test (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--num_pieces",
+        type=int,
+        default=50,
+        help="number of pieces, taken from the start of the split (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--profiles",
+        type=str,
+        nargs="+",
+        choices=list(PROFILES),
+        default=["bf16", "int8", "fp32+compile"],
+        help="profiles to compare with fp32 (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--num_threads",
+        type=int,
+        default=None,
+        help="number of CPU threads used by torch (default: torch default)",
+    )
+    parser.add_argument(
+        "--num_workers", type=int, default=8, help="number of data loading workers "
+    )
+    parser.add_argument(
+        "--eval_trim_beats",
+        metavar="SECONDS",
+        type=float,
+        default=None,
+        help="Override whether to skip the first given seconds "
+        "per piece in evaluating (default: as stored in model)",
+    )
+    parser.add_argument(
+        "--dbn",
+        default=None,
+        action=argparse.BooleanOptionalAction,
+        help="override the option to use madmom postprocessing dbn",
+    )
+
+    args = parser.parse_args()
+
+    main(args)
@@ -1,158 +1,449 @@
 import argparse
+import hashlib
+import json
+from collections import defaultdict
+from functools import lru_cache
 from pathlib import Path
 
 import numpy as np
+import torch
 from pytorch_lightning import Trainer, seed_everything
+from torch.utils.data import DataLoader, Subset
 
 from beat_this.dataset import BeatDataModule
 from beat_this.inference import load_checkpoint
 from beat_this.model.pl_module import PLBeatThis
 import csv
 
+import dbn as numpy_dbn
+import smoke_eval
+from batched_prediction import check_batching, peak_rss_mb, predict_bucketed
+
 
 # for repeatability
 seed_everything(0, workers=True)
 
 
 def main(args):
+    if args.merge is not None:
+        # aggregate the per-piece results written by all the shards
+        results = load_shards(args.merge)
+    else:
+        results = evaluate(args)
+        if args.shard is not None:
+            shard_path = write_shard(results, args.shard_dir, *args.shard)
+            print(f"Shard {args.shard[0]}/{args.shard[1]} written to {shard_path}")
+            print(f"Run with --merge {args.shard_dir} once all the shards are done")
+            return
+        if args.smoke is not None:
+            # estimate the full-set metrics of every model from the sample
+            meters = smoke_eval.load_meters(args.meters) if args.meters else None
+            for r in results:
+                print(r["model"])
+                smoke_eval.print_estimates(
+                    r["metrics"], r["piece"], r["population"], meters
+                )
+            return
+    report(results, args.aggregation_type)
+
+
+def evaluate(args):
+    """
+    Compute the per-piece metrics of every model, restricted to one shard of
+    the pieces if `args.shard` is set, or to a stratified sample of them if
+    `args.smoke` is set.
+
+    Returns:
+        list: One dict per model with the checkpoint path ("model") and the
+        per-piece "metrics", "dataset", "piece" and "index" (position in the
+        predict dataset) arrays, and the ids of all the pieces in the predict
+        dataset ("population").
+    """
     if len(args.models) == 1:
         print("Single model prediction for", args.models[0])
-        # single model prediction
-        checkpoint_path = args.models[0]
-        checkpoint = load_checkpoint(checkpoint_path)
-
-        # create datamodule
-        datamodule = datamodule_setup(checkpoint, args.num_workers, args.datasplit)
+    meters = smoke_eval.load_meters(args.meters) if args.meters else None
+    results = []
+    datamodule = None
+    for i_model, checkpoint_path in enumerate(args.models):
+        if len(args.models) > 1:
+            print(f"Model {i_model+1}/{len(args.models)}")
+        # every fold has a different dataset, otherwise we assume the dataset
+        # is the same for all models and create the datamodule only once
+        if datamodule is None or args.aggregation_type == "k-fold":
+            datamodule = datamodule_setup(
+                checkpoint_hparams(checkpoint_path), args.num_workers, args.datasplit
+            )
         # create model and trainer
         model, trainer = plmodel_setup(
-            checkpoint, args.eval_trim_beats, args.dbn, args.gpu
+            load_checkpoint_mmap(checkpoint_path),
+            args.eval_trim_beats,
+            args.dbn,
+            args.gpu,
+            fast_dbn=args.fast_dbn,
+            **cpu_profile(args),
         )
         # predict
+        predict_dataloader = datamodule.predict_dataloader()
+        population = [
+            piece_id(item["spect_path"]) for item in predict_dataloader.dataset.items
+        ]
+        index = np.arange(len(population))
+        if args.smoke is not None:
+            index = smoke_eval.sample_pieces(
+                population, args.smoke, meters, args.smoke_seed
+            )
+        elif args.shard is not None:
+            index = shard_index(predict_dataloader.dataset, *args.shard)
+        if len(index) < len(population):
+            predict_dataloader = subset_dataloader(predict_dataloader, index)
+        if args.check_batching is not None:
+            check_dataloader = subset_dataloader(
+                predict_dataloader, np.arange(min(args.check_batching, len(index)))
+            )
+            print_batching_check(
+                check_batching(model, trainer, check_dataloader, args.batch_size)
+            )
         metrics, dataset, preds, piece = compute_predictions(
-            model, trainer, datamodule.predict_dataloader()
+            model, trainer, predict_dataloader, args.batch_size, args.telemetry
+        )
+        results.append(
+            dict(
+                model=checkpoint_path,
+                metrics=metrics,
+                dataset=dataset,
+                piece=piece,
+                index=index,
+                population=population,
+            )
         )
+    return results
+
+
+def report(results, aggregation_type):
+    """
+    Print the aggregated metrics of the per-model results from `evaluate`.
+    """
+    if len(results) == 1:
+        print_single_model(results[0]["metrics"], results[0]["dataset"])
+    elif aggregation_type == "mean-std":
+        # computing result variability for the same dataset and different model seeds
+        print_mean_std([r["metrics"] for r in results])
+    elif aggregation_type == "k-fold":
+        # computing results in the K-fold setting. Every fold has a different dataset
+        print_k_fold(
+            [r["metrics"] for r in results],
+            [r["dataset"] for r in results],
+            [r["piece"] for r in results],
+        )
+    else:
+        raise ValueError(f"Unknown aggregation type {aggregation_type}")
+
 
-        # compute averaged metrics
-        averaged_metrics = {k: np.mean(v) for k, v in metrics.items()}
-        # compute metrics averaged by dataset
-        dataset_metrics = {
-            k: {d: np.mean(v[dataset == d]) for d in np.unique(dataset)}
-            for k, v in metrics.items()
+def print_single_model(metrics, dataset):
+    # compute averaged metrics
+    averaged_metrics = {k: np.mean(v) for k, v in metrics.items()}
+    # compute metrics averaged by dataset
+    dataset_metrics = {
+        k: {d: np.mean(v[dataset == d]) for d in np.unique(dataset)}
+        for k, v in metrics.items()
+    }
+    # print for dataset
+    print("Metrics")
+    for k, v in averaged_metrics.items():
+        print(f"{k}: {v}")
+    print("Dataset metrics")
+    for k, v in dataset_metrics.items():
+        print(k)
+        for d, value in v.items():
+            print(f"{d}: {value}")
+        print("------")
+
+
+def print_mean_std(all_model_metrics):
+    # compute averaged metrics for each model
+    all_metrics = [
+        {k: np.mean(v) for k, v in metrics.items()} for metrics in all_model_metrics
+    ]
+    # compute mean and standard deviations for all model averages
+    all_metrics_mean = {
+        k: np.mean([m[k] for m in all_metrics]) for k in all_metrics[0]
+    }
+    all_metrics_std = {
+        k: np.std([m[k] for m in all_metrics]) for k in all_metrics[0]
+    }
+    all_metrics_stats = {
+        k: (all_metrics_mean[k], all_metrics_std[k])
+        for k, v in all_metrics[0].items()
+    }
+    # print all metrics
+    print("Metrics")
+    for k, v in all_metrics_stats.items():
+        # round to 3 decimal places
+        print(f"{k}: {round(v[0],3)} +- {round(v[1],3)}")
+
+
+def print_k_fold(all_piece_metrics, all_piece_dataset, all_piece):
+    # aggregate across folds
+    all_piece_metrics = {
+        k: np.concatenate([m[k] for m in all_piece_metrics])
+        for k in all_piece_metrics[0]
+    }
+    all_piece_dataset = np.concatenate(all_piece_dataset)
+    all_piece = np.concatenate(all_piece)
+    # double check that there are no errors in the fold and there are not repeated pieces
+    assert len(all_piece) == len(
+        np.unique(all_piece)
+    ), "There are repeated pieces in the folds"
+    dataset_metrics = {
+        k: {
+            d: np.mean(v[all_piece_dataset == d])
+            for d in np.unique(all_piece_dataset)
         }
-        # print for dataset
-        print("Metrics")
-        for k, v in averaged_metrics.items():
-            print(f"{k}: {v}")
-        print("Dataset metrics")
-        for k, v in dataset_metrics.items():
-            print(k)
-            for d, value in v.items():
-                print(f"{d}: {value}")
-            print("------")
-    else:  # multiple models
-        if args.aggregation_type == "mean-std":
-            # computing result variability for the same dataset and different model seeds
-            # create datamodule only once, as we assume it is the same for all models
-            checkpoint = load_checkpoint(args.models[0])
-            datamodule = datamodule_setup(checkpoint, args.num_workers, args.datasplit)
-            # create model and trainer
-            all_metrics = []
-            for checkpoint_path in args.models:
-                checkpoint = load_checkpoint(checkpoint_path)
-                model, trainer = plmodel_setup(
-                    checkpoint, args.eval_trim_beats, args.dbn, args.gpu
-                )
+        for k, v in all_piece_metrics.items()
+    }
+    # print for dataset
+    print("Dataset metrics")
+    for k, v in dataset_metrics.items():
+        print(k)
+        for d, value in v.items():
+            print(f"{d}: {round(value,3)}")
+        print("------")
 
-                metrics, dataset, preds, piece = compute_predictions(
-                    model, trainer, datamodule.predict_dataloader()
-                )
-                # compute averaged metrics for one model
-                averaged_metrics = {k: np.mean(v) for k, v in metrics.items()}
-                all_metrics.append(averaged_metrics)
-            # compute mean and standard deviations for all model averages
-            all_metrics_mean = {
-                k: np.mean([m[k] for m in all_metrics]) for k in all_metrics[0]
-            }
-            all_metrics_std = {
-                k: np.std([m[k] for m in all_metrics]) for k in all_metrics[0]
-            }
-            all_metrics_stats = {
-                k: (all_metrics_mean[k], all_metrics_std[k])
-                for k, v in all_metrics[0].items()
-            }
-            # print all metrics
-            print("Metrics")
-            for k, v in all_metrics_stats.items():
-                # round to 3 decimal places
-                print(f"{k}: {round(v[0],3)} +- {round(v[1],3)}")
-        elif args.aggregation_type == "k-fold":
-            # computing results in the K-fold setting. Every fold has a different dataset
-            all_piece_metrics = []
-            all_piece_dataset = []
-            all_piece = []
-            # create datamodule for each model
-            for i_model, checkpoint_path in enumerate(args.models):
-                print(f"Model {i_model+1}/{len(args.models)}")
-                checkpoint = load_checkpoint(checkpoint_path)
-                datamodule = datamodule_setup(
-                    checkpoint, args.num_workers, args.datasplit
-                )
-                # create model and trainer
-                model, trainer = plmodel_setup(
-                    checkpoint, args.eval_trim_beats, args.dbn, args.gpu
-                )
-                # predict
-                metrics, dataset, preds, piece = compute_predictions(
-                    model, trainer, datamodule.predict_dataloader()
+
+def parse_shard(value):
+    """
+    Parse a "i/N" shard specification into (i, N).
+    """
+    try:
+        shard, num_shards = (int(x) for x in value.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected i/N, got {value!r}")
+    if not 0 <= shard < num_shards:
+        raise argparse.ArgumentTypeError(f"shard {shard} not in [0, {num_shards})")
+    return shard, num_shards
+
+
+def piece_id(spect_path):
+    """
+    Identifier of a piece that does not depend on where the data folder is,
+    i.e. the last three components of the spectrogram path.
+    """
+    return "/".join(Path(spect_path).parts[-3:])
+
+
+def piece_shard(spect_path, num_shards):
+    """
+    Shard of a piece, from the md5 hash of its id, so that the partition is
+    the same on every machine and for every model.
+    """
+    digest = hashlib.md5(piece_id(spect_path).encode()).hexdigest()
+    return int(digest, 16) % num_shards
+
+
+def shard_index(dataset, shard, num_shards):
+    """
+    Indices of the pieces of one shard in a predict dataset.
+    """
+    # the dataset items hold the annotations and paths, the spectrograms are
+    # only loaded in __getitem__
+    return np.asarray(
+        [
+            i
+            for i, item in enumerate(dataset.items)
+            if piece_shard(item["spect_path"], num_shards) == shard
+        ],
+        dtype=int,
+    )
+
+
+def subset_dataloader(predict_dataloader, index):
+    """
+    Restrict a predict dataloader to the pieces at the given indices.
+    """
+    return DataLoader(
+        Subset(predict_dataloader.dataset, np.asarray(index).tolist()),
+        batch_size=1,
+        num_workers=predict_dataloader.num_workers,
+        collate_fn=predict_dataloader.collate_fn,
+    )
+
+
+def write_shard(results, shard_dir, shard, num_shards):
+    """
+    Write the per-piece metrics of one shard for all models to a csv file, and
+    the ordered list of models to a json file next to it.
+    """
+    shard_dir = Path(shard_dir)
+    shard_dir.mkdir(parents=True, exist_ok=True)
+    shard_path = shard_dir / f"shard-{shard}-of-{num_shards}.csv"
+    # the model order sets the fold order of the k-fold aggregate, and a
+    # model may have no piece in this shard
+    with open(shard_path.with_suffix(".json"), "w") as file:
+        json.dump({"models": [r["model"] for r in results]}, file)
+    metric_names = list(results[0]["metrics"])
+    with open(shard_path, mode="w", newline="") as file:
+        writer = csv.writer(file)
+        writer.writerow(["Model", "Index", "Piece", "Dataset"] + metric_names)
+        for r in results:
+            for i in range(len(r["piece"])):
+                writer.writerow(
+                    [r["model"], r["index"][i], r["piece"][i], r["dataset"][i]]
+                    + [repr(float(r["metrics"][k][i])) for k in metric_names]
                 )
-                all_piece_metrics.append(metrics)
-                all_piece_dataset.append(dataset)
-                all_piece.append(piece)
-            # aggregate across folds
-            all_piece_metrics = {
-                k: np.concatenate([m[k] for m in all_piece_metrics])
-                for k in all_piece_metrics[0]
-            }
-            all_piece_dataset = np.concatenate(all_piece_dataset)
-            all_piece = np.concatenate(all_piece)
-            # double check that there are no errors in the fold and there are not repeated pieces
-            assert len(all_piece) == len(
-                np.unique(all_piece)
-            ), "There are repeated pieces in the folds"
-            dataset_metrics = {
-                k: {
-                    d: np.mean(v[all_piece_dataset == d])
-                    for d in np.unique(all_piece_dataset)
-                }
-                for k, v in all_piece_metrics.items()
-            }
-            # print for dataset
-            print("Dataset metrics")
-            for k, v in dataset_metrics.items():
-                print(k)
-                for d, value in v.items():
-                    print(f"{d}: {round(value,3)}")
-                print("------")
-        else:
-            raise ValueError(f"Unknown aggregation type {args.aggregation_type}")
+    return shard_path
+
+
+def load_shards(shard_dir):
+    """
+    Read the csv files of all the shards in `shard_dir` back into per-model
+    results, in the same model and piece order as an unsharded run, so that the
+    aggregates are exactly the same. The model order is taken from the json
+    files written by `write_shard`, and every model must have pieces.
+    """
+    shard_paths = sorted(Path(shard_dir).glob("shard-*-of-*.csv"))
+    if not shard_paths:
+        raise FileNotFoundError(f"No shard files in {shard_dir}")
+    shards = {}
+    for path in shard_paths:
+        shard, num_shards = (int(x) for x in path.stem.split("-")[1::2])
+        shards[shard] = (num_shards, path)
+    num_shards = {n for n, _ in shards.values()}
+    if len(num_shards) != 1:
+        raise ValueError(f"Shard files from different partitions: {num_shards}")
+    num_shards = num_shards.pop()
+    missing = sorted(set(range(num_shards)) - set(shards))
+    if missing:
+        raise ValueError(f"Missing shards {missing} of {num_shards}")
+
+    models = None
+    for shard in range(num_shards):
+        models_path = shards[shard][1].with_suffix(".json")
+        with open(models_path) as file:
+            shard_models = json.load(file)["models"]
+        if models is None:
+            models = shard_models
+        elif shard_models != models:
+            raise ValueError(f"{models_path} lists different models than shard 0")
+
+    rows = defaultdict(list)
+    for shard in range(num_shards):
+        with open(shards[shard][1], newline="") as file:
+            reader = csv.reader(file)
+            metric_names = next(reader)[4:]
+            for model, index, piece, dataset, *values in reader:
+                rows[model].append((int(index), piece, dataset, values))
+
+    unknown = sorted(set(rows) - set(models))
+    if unknown:
+        raise ValueError(f"Rows of models that are not in the model lists: {unknown}")
+    empty = [model for model in models if model not in rows]
+    if empty:
+        raise ValueError(f"No pieces of models {empty} in any shard")
+
+    results = []
+    for model in models:
+        model_rows = sorted(rows[model], key=lambda row: row[0])
+        values = np.asarray([row[3] for row in model_rows], dtype=float)
+        results.append(
+            dict(
+                model=model,
+                metrics={k: values[:, j] for j, k in enumerate(metric_names)},
+                dataset=np.asarray([row[2] for row in model_rows]),
+                piece=np.asarray([row[1] for row in model_rows]),
+                index=np.asarray([row[0] for row in model_rows]),
+            )
+        )
+    print(f"Merged {num_shards} shards of {len(results)} models from {shard_dir}")
+    return results
+
+
+def load_checkpoint_mmap(checkpoint_path):
+    """
+    Load a checkpoint with its tensors memory-mapped instead of read into RAM.
+
+    Only the pickled metadata is read, the weights are paged in from the file
+    (and shared through the page cache between processes) when they are used.
+    Checkpoint names that are not local files are resolved by beat_this.
+
+    Args:
+        checkpoint_path (str): Local checkpoint file or beat_this checkpoint name.
+
+    Returns:
+        dict: The checkpoint.
+    """
+    if not Path(checkpoint_path).is_file():
+        return load_checkpoint(checkpoint_path)
+    try:
+        return torch.load(checkpoint_path, map_location="cpu", mmap=True)
+    except RuntimeError:
+        # legacy (non-zip) serialization cannot be memory-mapped
+        return load_checkpoint(checkpoint_path)
+
+
+@lru_cache(maxsize=None)
+def checkpoint_hparams(checkpoint_path):
+    """
+    Read the model and datamodule hyperparameters of a checkpoint without
+    loading its weights.
+
+    Returns:
+        dict: The "hyper_parameters" and "datamodule_hyper_parameters" of the
+        checkpoint. Treat as read-only, it is cached.
+    """
+    checkpoint = load_checkpoint_mmap(checkpoint_path)
+    return {
+        k: checkpoint[k] for k in ("hyper_parameters", "datamodule_hyper_parameters")
+    }
+
+
+# datamodules by configuration, so that models evaluated on the same data share
+# one datamodule
+_datamodules = {}
 
 
 def datamodule_setup(checkpoint, num_workers, datasplit):
-    # Load the datamodule
-    print("Creating datamodule")
     data_dir = Path(__file__).parent.parent.relative_to(Path.cwd()) / "data"
-    datamodule_hparams = checkpoint["datamodule_hyper_parameters"]
+    # copy, so that the (possibly cached) checkpoint is left untouched
+    datamodule_hparams = dict(checkpoint["datamodule_hyper_parameters"])
     # update the hparams with the ones from the arguments
     if num_workers is not None:
         datamodule_hparams["num_workers"] = num_workers
     datamodule_hparams["predict_datasplit"] = datasplit
     datamodule_hparams["data_dir"] = data_dir
-    datamodule = BeatDataModule(**datamodule_hparams)
-    datamodule.setup(stage="predict")
-    return datamodule
+    key = repr(sorted(datamodule_hparams.items()))
+    if key not in _datamodules:
+        # Load the datamodule
+        print("Creating datamodule")
+        datamodule = BeatDataModule(**datamodule_hparams)
+        datamodule.setup(stage="predict")
+        _datamodules[key] = datamodule
+    return _datamodules[key]
+
 
+def cpu_profile(args):
+    """
+    Collect the CPU inference options from the parsed arguments, as keyword
+    arguments for `plmodel_setup`.
+    """
+    return dict(
+        cpu_precision=args.cpu_precision,
+        quantize=args.quantize,
+        compile_model=args.compile,
+        num_threads=args.num_threads,
+    )
 
-def plmodel_setup(checkpoint, eval_trim_beats, dbn, gpu):
+
+def plmodel_setup(
+    checkpoint,
+    eval_trim_beats,
+    dbn,
+    gpu,
+    cpu_precision="32-true",
+    quantize=False,
+    compile_model=False,
+    num_threads=None,
+    fast_dbn=False,
+):
     """
     Set up the pytorch lightning model and trainer for evaluation.
 
@@ -161,45 +452,78 @@ def plmodel_setup(checkpoint, eval_trim_beats, dbn, gpu):
         eval_trim_beats (int or None): The number of beats to trim during evaluation. If None, the setting is taken from the pretrained model.
         dbn (bool or None): Whether to use the Dynamic Bayesian Network (DBN) module during evaluation. If None, the default behavior from the pretrained model is used.
         gpu (int): The index of the GPU device to use for training.
+        cpu_precision (str): Lightning precision used when running on CPU, "32-true" or "bf16-mixed". Ignored on GPU, which always uses "16-mixed".
+        quantize (bool): Whether to apply dynamic int8 quantization to the linear layers (including the attention projections) on CPU.
+        compile_model (bool): Whether to compile the network with torch.compile on CPU.
+        num_threads (int or None): Number of intra-op threads used on CPU. If None, the torch default is kept.
+        fast_dbn (bool): Whether to replace the postprocessing with the NumPy meter-aware DBN from `dbn.py`, regardless of `dbn`.
 
     Returns:
         tuple: A tuple containing the initialized pytorch lightning model and trainer.
 
     """
+    hparams = dict(checkpoint["hyper_parameters"])
     if eval_trim_beats is not None:
-        checkpoint["hyper_parameters"]["eval_trim_beats"] = eval_trim_beats
+        hparams["eval_trim_beats"] = eval_trim_beats
     if dbn is not None:
-        checkpoint["hyper_parameters"]["use_dbn"] = dbn
+        hparams["use_dbn"] = dbn
 
-    model = PLBeatThis(**checkpoint["hyper_parameters"])
-    model.load_state_dict(checkpoint["state_dict"])
+    model = PLBeatThis(**hparams)
+    # use the (memory-mapped) checkpoint tensors as parameters, without a copy
+    model.load_state_dict(checkpoint["state_dict"], assign=True)
+    if fast_dbn:
+        model.postprocessor = numpy_dbn.DBNPostprocessor(fps=hparams.get("fps", numpy_dbn.FPS))
     # set correct device and accelerator
     if gpu >= 0:
         devices = [gpu]
         accelerator = "gpu"
+        precision = "16-mixed"
     else:
         devices = 1
         accelerator = "cpu"
+        # fp16 autocast is slow or unsupported on CPU
+        precision = cpu_precision
+        if num_threads is not None:
+            torch.set_num_threads(num_threads)
+        if quantize:
+            model.model = torch.ao.quantization.quantize_dynamic(
+                model.model, {torch.nn.Linear}, dtype=torch.qint8
+            )
+        if compile_model:
+            model.model = torch.compile(model.model)
     # create trainer
     trainer = Trainer(
         accelerator=accelerator,
         devices=devices,
         logger=None,
         deterministic=True,
-        precision="16-mixed",
+        precision=precision,
     )
     return model, trainer
 
 
 
-def compute_predictions(model, trainer, predict_dataloader):
+def compute_predictions(
+    model, trainer, predict_dataloader, batch_size=None, telemetry=False
+):
     print("Computing predictions ...")
-    out = trainer.predict(model, predict_dataloader)
-    
+    if telemetry and batch_size is None:
+        # only the custom loop is instrumented. with one chunk per batch the
+        # predictions are the same as with trainer.predict
+        batch_size = 1
+    if batch_size is None:
+        out = trainer.predict(model, predict_dataloader)
+    else:
+        # pool the chunks of all pieces into length-bucketed batches
+        out = predict_bucketed(
+            model, trainer, predict_dataloader, batch_size, telemetry=telemetry
+        )
+
     metrics = [o[0] for o in out]  # Per-batch metrics
     preds = [o[1] for o in out]  # Predictions (not used here)
     dataset = np.asarray([o[2][0] for o in out])  # Dataset name
     piece = np.asarray([o[3][0] for o in out])  # Piece name
+    timings = [o[4] for o in out] if telemetry else None  # Per-piece telemetry
 
     # Convert metrics to a dictionary with numpy arrays
     metrics_dict = {k: np.asarray([m[k] for m in metrics]) for k in metrics[0]}
@@ -209,17 +533,79 @@ def compute_predictions(model, trainer, predict_dataloader):
     with open(log_file, mode="w", newline="") as file:
         writer = csv.writer(file)
         headers = ["Piece", "Dataset"] + list(metrics_dict.keys())
+        if timings:
+            headers += list(timings[0])
         writer.writerow(headers)
 
         for i in range(len(piece)):
             row = [piece[i], dataset[i]] + [metrics_dict[k][i] for k in metrics_dict]
+            if timings:
+                row += list(timings[i].values())
             writer.writerow(row)
 
     print(f"Metrics per file logged to {log_file}")
+    if timings:
+        print_telemetry(timings, dataset, piece)
 
     return metrics_dict, dataset, preds, piece
 
 
+def print_batching_check(max_diff):
+    """
+    Print the differences between the batched and the one-piece-per-batch
+    predictions from `batched_prediction.check_batching`.
+
+    Args:
+        max_diff (dict): Largest absolute differences per logit and metric.
+    """
+    print("Batched vs trainer.predict, max absolute difference")
+    for name, diff in max_diff.items():
+        if name.startswith("parity_"):
+            print(f"  beat_metrics vs mir_eval ({name[len('parity_'):]}):")
+            for metric, value in diff.items():
+                print(f"    {metric}: {value:.3g}")
+        else:
+            print(f"  {name}: {diff:.3g}")
+
+
+def print_telemetry(timings, dataset, piece, num_slowest=5):
+    """
+    Print the p50/p95/p99 latency per dataset, the share of each stage and the
+    slowest pieces.
+
+    Args:
+        timings (list): Per-piece telemetry dicts from `predict_bucketed`.
+        dataset (np.ndarray): Dataset name of every piece.
+        piece (np.ndarray): Name of every piece.
+        num_slowest (int): Number of slowest pieces to list.
+    """
+    stages = ["load_s", "forward_s", "postprocessing_s", "metrics_s"]
+    total = np.asarray([t["total_s"] for t in timings])
+    rtf = np.asarray([t["rtf"] for t in timings])
+    print(f"Telemetry (postprocessing: {timings[0]['postprocessor']})")
+    print(
+        f"{'dataset':<20}{'pieces':>7}{'p50 (s)':>9}{'p95 (s)':>9}{'p99 (s)':>9}"
+        f"{'RTF p50':>9}  " + " ".join(f"{s[:-2]:>14}" for s in stages)
+    )
+    for d in np.unique(dataset):
+        mask = dataset == d
+        p50, p95, p99 = np.percentile(total[mask], [50, 95, 99])
+        # share of the total time spent in each stage
+        shares = [
+            np.sum([t[s] for t, m in zip(timings, mask) if m]) / total[mask].sum()
+            for s in stages
+        ]
+        print(
+            f"{d:<20}{mask.sum():>7}{p50:>9.3f}{p95:>9.3f}{p99:>9.3f}"
+            f"{np.median(rtf[mask]):>9.4f}  "
+            + " ".join(f"{share:>14.1%}" for share in shares)
+        )
+    print(f"Peak RSS: {peak_rss_mb():.0f} MB")
+    print("Slowest pieces")
+    for i in np.argsort(total)[::-1][:num_slowest]:
+        print(f"{total[i]:.3f} s (RTF {rtf[i]:.4f}) {dataset[i]} {piece[i]}")
+
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
@@ -230,8 +616,7 @@ if __name__ == "__main__":
         "--models",
         type=str,
         nargs="+",
-        required=True,
-        help="Local checkpoint files to use",
+        help="Local checkpoint files to use (required unless --merge is given)",
     )
     parser.add_argument(
         "--datasplit",
@@ -258,6 +643,59 @@ if __name__ == "__main__":
         action=argparse.BooleanOptionalAction,
         help="override the option to use madmom postprocessing dbn",
     )
+    parser.add_argument(
+        "--fast_dbn",
+        action="store_true",
+        help="use the NumPy meter-aware DBN (2 to 7 beats per bar) instead of the "
+        "configured postprocessing; pieces are decoded in parallel with --batch_size",
+    )
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        default=None,
+        help="predict with batches of up to this many equal-length chunks pooled "
+        "across pieces instead of one piece per batch (default: one piece per batch)",
+    )
+    parser.add_argument(
+        "--telemetry",
+        action="store_true",
+        help="time the data loading, forward pass, postprocessing and metrics of "
+        "every piece, add the timings and real-time factor to the per-file log, "
+        "and print the p50/p95/p99 latency per dataset and the peak memory "
+        "(uses the --batch_size loop, with one chunk per batch if it is not given)",
+    )
+    parser.add_argument(
+        "--check_batching",
+        metavar="N_PIECES",
+        type=int,
+        default=None,
+        help="before evaluating, predict the first N_PIECES pieces with both "
+        "--batch_size and trainer.predict and print the largest logit and metric "
+        "differences, and the parity of the batched metrics with mir_eval",
+    )
+    parser.add_argument(
+        "--cpu_precision",
+        type=str,
+        choices=("32-true", "bf16-mixed"),
+        default="32-true",
+        help="precision used when running on CPU with --gpu -1 (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--quantize",
+        action="store_true",
+        help="apply dynamic int8 quantization to the linear and attention layers (CPU only)",
+    )
+    parser.add_argument(
+        "--compile",
+        action="store_true",
+        help="compile the model with torch.compile (CPU only)",
+    )
+    parser.add_argument(
+        "--num_threads",
+        type=int,
+        default=None,
+        help="number of CPU threads used by torch (default: torch default)",
+    )
     parser.add_argument(
         "--aggregation-type",
         type=str,
@@ -266,6 +704,56 @@ if __name__ == "__main__":
         help="Type of aggregation to use for multiple models; ignored if only one model is given",
     )
 
+    parser.add_argument(
+        "--shard",
+        metavar="i/N",
+        type=parse_shard,
+        default=None,
+        help="only evaluate shard i of N (pieces are partitioned by a hash of their "
+        "id) and write the per-piece metrics to --shard_dir instead of aggregating",
+    )
+    parser.add_argument(
+        "--shard_dir",
+        type=str,
+        default="shards",
+        help="folder for the per-piece metrics of each shard (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--smoke",
+        metavar="N",
+        type=int,
+        default=None,
+        help="only evaluate a stratified sample of about N pieces (by dataset, genre "
+        "and meter) and print estimated full-set metrics with 95%% confidence intervals",
+    )
+    parser.add_argument(
+        "--smoke_seed",
+        type=int,
+        default=0,
+        help="seed of the --smoke sample (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--meters",
+        type=str,
+        default=None,
+        help="time_signatures_test.json, to stratify --smoke by meter "
+        "(default: dataset and genre only)",
+    )
+    parser.add_argument(
+        "--merge",
+        metavar="SHARD_DIR",
+        type=str,
+        default=None,
+        help="aggregate the per-piece metrics of all the shards in SHARD_DIR "
+        "instead of computing predictions",
+    )
+
     args = parser.parse_args()
+    if args.merge is None and not args.models:
+        parser.error("--models is required unless --merge is given")
+    if args.smoke is not None and args.shard is not None:
+        parser.error("--smoke and --shard cannot be combined")
+    if args.check_batching is not None and args.batch_size is None:
+        parser.error("--check_batching requires --batch_size")
 
     main(args)
@@ -0,0 +1,400 @@
+"""
+Meter-aware DBN post-processing in NumPy.
+
+A replacement for madmom's `DBNDownBeatTrackingProcessor` as used by the
+beat_this `Postprocessor` with `--dbn`. It implements the same bar pointer
+model (Krebs et al. 2015, Böck et al. 2016): one HMM per number of beats per
+bar, whose states are (beat in bar, beat interval, position in beat), with
+tempo changes only allowed at beat boundaries and the RNN downbeat observation
+model. The model with the highest Viterbi log probability gives the beats and
+downbeats. By default it covers 2, 3, 4, 5, 6 and 7 beats per bar, i.e. the
+2/4, 3/4, 5/4, 6/4 and 7/4 meters of the time-signature augmentation and the
+4/4 source.
+
+Instead of building the dense or CSR transition matrices, the Viterbi uses
+the structure of the model: inside a beat every state has a single
+predecessor, so a time step is a shift of the flat state array, and only the
+first state of every (beat, interval) pair takes a max over the intervals of
+the previous beat. The HMMs of all the meters are stacked into one state space
+and decoded in a single pass over the frames. Backpointers are only stored for
+the first states of the beats (one byte per beat and interval and frame) and
+the path is backtracked one beat at a time. Pieces are decoded in parallel
+processes.
+
+example usage
+---
+    import dbn
+
+    beats, downbeats = dbn.postprocess(beat_logits, downbeat_logits)
+
+    # as a drop-in for the beat_this postprocessor
+    model.postprocessor = dbn.DBNPostprocessor(fps=50)
+"""
+
+from functools import lru_cache
+from multiprocessing import Pool
+
+import numpy as np
+
+FPS = 50
+BEATS_PER_BAR = (2, 3, 4, 5, 6, 7)
+MIN_BPM = 55.0
+MAX_BPM = 215.0
+NUM_TEMPI = 60
+TRANSITION_LAMBDA = 100
+OBSERVATION_LAMBDA = 16
+THRESHOLD = 0.05
+# limit of the probabilities, since 0 and 1 create problems in the DBN
+EPSILON = 1e-5
+
+
+def beat_intervals(min_bpm=MIN_BPM, max_bpm=MAX_BPM, fps=FPS, num_tempi=NUM_TEMPI):
+    """
+    beat intervals in frames modelled by the HMMs, as in madmom's BeatStateSpace:
+    all the integer intervals in the tempo range, or `num_tempi` log-spaced
+    ones if there are more
+    """
+    min_interval = 60.0 * fps / max_bpm
+    max_interval = 60.0 * fps / min_bpm
+    intervals = np.arange(np.round(min_interval), np.round(max_interval) + 1)
+    if num_tempi is not None and num_tempi < len(intervals):
+        num_log_tempi = num_tempi
+        intervals = []
+        while len(intervals) < num_tempi:
+            intervals = np.unique(
+                np.round(
+                    np.logspace(
+                        np.log2(min_interval),
+                        np.log2(max_interval),
+                        num_log_tempi,
+                        base=2,
+                    )
+                )
+            )
+            num_log_tempi += 1
+    return np.asarray(intervals, dtype=int)
+
+
+def tempo_transitions(intervals, transition_lambda=TRANSITION_LAMBDA):
+    """
+    log probabilities of moving from interval i (rows) to interval j (columns)
+    at a beat boundary, proportional to exp(-lambda * |j / i - 1|)
+    """
+    ratio = intervals[np.newaxis, :] / intervals[:, np.newaxis]
+    prob = np.exp(-transition_lambda * np.abs(ratio - 1.0))
+    prob[prob <= np.spacing(1)] = 0
+    prob /= prob.sum(axis=1, keepdims=True)
+    with np.errstate(divide="ignore"):
+        return np.log(prob)
+
+
+@lru_cache(maxsize=None)
+def bar_model(
+    beats_per_bar=BEATS_PER_BAR,
+    min_bpm=MIN_BPM,
+    max_bpm=MAX_BPM,
+    fps=FPS,
+    num_tempi=NUM_TEMPI,
+    transition_lambda=TRANSITION_LAMBDA,
+    observation_lambda=OBSERVATION_LAMBDA,
+):
+    """
+    joint state space of the bar pointer HMMs for every number of beats per bar
+
+    the HMMs are stacked side by side with no transitions between them and a
+    uniform initial distribution each, so the Viterbi path of the joint model
+    is the path of the HMM with the highest log probability. the states are
+    laid out flat, ordered by HMM, beat in bar, interval and position in the
+    beat, so that moving one position forward is moving one index forward.
+    a "row" is a (HMM, beat in bar) pair
+
+    return
+    ---
+        model : dict
+            intervals, log_transitions (interval to interval), initial (log
+            probability of every state), first and last (flat index of the
+            first and last state of every row and interval, shape (rows,
+            intervals)), previous_last (last states of the previous beat of
+            every row), and for every state its row, meter (index in
+            `beats_per_bar`), beat, interval index, position and observation
+            class (0 no beat, 1 beat, 2 downbeat)
+    """
+    intervals = beat_intervals(min_bpm, max_bpm, fps, num_tempi)
+    num_intervals = len(intervals)
+    states_per_beat = intervals.sum()
+
+    # one row per (HMM, beat in bar)
+    row_meter = np.repeat(np.arange(len(beats_per_bar)), beats_per_bar)
+    row_beat = np.concatenate([np.arange(n) for n in beats_per_bar])
+    num_rows = len(row_beat)
+
+    starts = np.concatenate(([0], np.cumsum(intervals)[:-1]))
+    row = np.repeat(np.arange(num_rows), states_per_beat)
+    interval_index = np.tile(np.repeat(np.arange(num_intervals), intervals), num_rows)
+    position = np.tile(
+        np.arange(states_per_beat) - np.repeat(starts, intervals), num_rows
+    )
+    meter = row_meter[row]
+    beat = row_beat[row]
+
+    first = np.arange(num_rows)[:, None] * states_per_beat + starts[None, :]
+    last = first + intervals[None, :] - 1
+    # the previous beat of beat 0 is the last beat of the same HMM
+    previous_row = np.arange(num_rows) - 1
+    previous_row[row_beat == 0] += np.asarray(beats_per_bar)
+    previous_last = last[previous_row]
+
+    num_states = np.asarray(beats_per_bar) * states_per_beat
+    initial = -np.log(num_states)[meter]
+
+    # the first 1 / observation_lambda of every beat is a beat (or downbeat)
+    observation = np.zeros(len(row), dtype=np.intp)
+    on_beat = position / intervals[interval_index] < 1.0 / observation_lambda
+    observation[on_beat] = 1
+    observation[on_beat & (beat == 0)] = 2
+
+    return dict(
+        intervals=intervals,
+        log_transitions=tempo_transitions(intervals, transition_lambda),
+        initial=initial,
+        first=first,
+        last=last,
+        previous_last=previous_last,
+        row=row,
+        meter=meter,
+        beat=beat,
+        interval=interval_index,
+        position=position,
+        observation=observation,
+    )
+
+
+def log_densities(activations, observation_lambda=OBSERVATION_LAMBDA):
+    """
+    log densities of the no beat, beat and downbeat observations, from
+    (beat but not downbeat, downbeat) activations of shape (frames, 2)
+    """
+    densities = np.empty((len(activations), 3))
+    with np.errstate(divide="ignore"):
+        densities[:, 0] = np.log(
+            (1.0 - activations.sum(axis=1)) / (observation_lambda - 1)
+        )
+        densities[:, 1] = np.log(activations[:, 0])
+        densities[:, 2] = np.log(activations[:, 1])
+    return densities
+
+
+def viterbi(model, densities):
+    """
+    most likely state sequence of a bar pointer model
+
+    arguments
+    ---
+        model : dict
+            from `bar_model`
+        densities : np.array
+            observation log densities of shape (frames, 3), from `log_densities`
+
+    return
+    ---
+        path : np.array
+            flat state index of every frame
+        log_prob : float
+            log probability of the path
+    """
+    num_frames = len(densities)
+    first, previous_last = model["first"], model["previous_last"]
+    observation = model["observation"]
+    # (to, from), so that the max over the previous intervals is contiguous
+    log_transitions = np.ascontiguousarray(model["log_transitions"].T)
+
+    delta = model["initial"] + densities[0][observation]
+    # backpointers (previous interval index) of the first states of every row
+    backpointers = np.zeros((num_frames,) + first.shape, np.uint8)
+    new_delta = np.empty_like(delta)
+    frame_densities = np.empty_like(delta)
+    for t in range(1, num_frames):
+        # from the last state of the previous beat, with any interval
+        incoming = delta[previous_last][:, None, :] + log_transitions
+        best = incoming.argmax(axis=2)
+        backpointers[t] = best
+        np.take(densities[t], observation, out=frame_densities)
+        # inside a beat, from the previous position
+        np.add(delta[:-1], frame_densities[1:], out=new_delta[1:])
+        new_delta[first] = (
+            np.take_along_axis(incoming, best[:, :, None], axis=2)[:, :, 0]
+            + frame_densities[first]
+        )
+        delta, new_delta = new_delta, delta
+
+    # backtrack one beat at a time
+    path = np.empty(num_frames, dtype=int)
+    state = int(delta.argmax())
+    log_prob = float(delta[state])
+    t = num_frames - 1
+    while True:
+        position = model["position"][state]
+        start = max(t - position, 0)
+        path[start : t + 1] = np.arange(state - (t - start), state + 1)
+        if t - position <= 0:
+            break
+        t -= position
+        row = model["row"][state]
+        previous = backpointers[t, row, model["interval"][state]]
+        state = previous_last[row, previous]
+        t -= 1
+    return path, log_prob
+
+
+def decode(
+    activations,
+    beats_per_bar=BEATS_PER_BAR,
+    fps=FPS,
+    threshold=THRESHOLD,
+    **model_kwargs,
+):
+    """
+    beats and downbeats of one piece, like madmom's DBNDownBeatTrackingProcessor
+    with `correct=True`
+
+    arguments
+    ---
+        activations : np.array
+            (beat but not downbeat, downbeat) activations of shape (frames, 2)
+        beats_per_bar : tuple
+            numbers of beats per bar to model, one HMM each
+        fps : int
+            frames per second of the activations
+        threshold : float
+            frames before the first and after the last activation above the
+            threshold are ignored
+        model_kwargs : dict
+            tempo range and lambdas passed to `bar_model`
+
+    return
+    ---
+        beats : np.array
+            (time, beat number) of shape (beats, 2), beat number 1 is a downbeat
+    """
+    first = 0
+    if threshold:
+        idx = np.nonzero(activations >= threshold)[0]
+        if idx.any():
+            first = max(first, np.min(idx))
+            last = min(len(activations), np.max(idx) + 1)
+        else:
+            last = first
+        activations = activations[first:last]
+    if not activations.any():
+        return np.empty((0, 2))
+
+    densities = log_densities(
+        activations, model_kwargs.get("observation_lambda", OBSERVATION_LAMBDA)
+    )
+    model = bar_model(tuple(beats_per_bar), fps=fps, **model_kwargs)
+    path, _ = viterbi(model, densities)
+
+    # one beat per contiguous beat range of the path, at the activation peak
+    beat_range = model["observation"][path] >= 1
+    idx = np.nonzero(np.diff(beat_range.astype(int)))[0] + 1
+    if beat_range[0]:
+        idx = np.r_[0, idx]
+    if beat_range[-1]:
+        idx = np.r_[idx, beat_range.size]
+    beats = np.asarray(
+        [
+            np.argmax(activations[left:right]) // 2 + left
+            for left, right in idx.reshape((-1, 2))
+        ],
+        dtype=int,
+    )
+    beat_numbers = model["beat"][path[beats]] + 1
+    return np.vstack(((beats + first) / float(fps), beat_numbers)).T
+
+
+def to_numpy(x):
+    if hasattr(x, "detach"):
+        x = x.detach().cpu().double().numpy()
+    return np.asarray(x, dtype=float)
+
+
+def postprocess(beat, downbeat, beats_per_bar=BEATS_PER_BAR, fps=FPS):
+    """
+    beat and downbeat times of one piece from the beat_this frame logits,
+    built the same way as in the beat_this dbn postprocessing
+
+    return
+    ---
+        beats : np.array
+            beat times in seconds
+        downbeats : np.array
+            downbeat times in seconds
+    """
+    epsilon = EPSILON
+    beat_prob = 1 / (1 + np.exp(-to_numpy(beat)))
+    downbeat_prob = 1 / (1 + np.exp(-to_numpy(downbeat)))
+    beat_prob = beat_prob * (1 - epsilon) + epsilon / 2
+    downbeat_prob = downbeat_prob * (1 - epsilon) + epsilon / 2
+    # artificial multiclass prediction, as suggested by Böck et al.
+    activations = np.vstack(
+        (np.maximum(beat_prob - downbeat_prob, epsilon / 2), downbeat_prob)
+    ).T
+    out = decode(activations, beats_per_bar, fps)
+    return out[:, 0], out[out[:, 1] == 1][:, 0]
+
+
+def _postprocess_item(args):
+    return postprocess(*args)
+
+
+class DBNPostprocessor:
+    """
+    drop-in for the beat_this `Postprocessor(type="dbn")`, decoding the pieces
+    of a batch in parallel processes
+
+    use `map` to decode a list of pieces of different lengths
+    """
+
+    def __init__(self, fps=FPS, beats_per_bar=BEATS_PER_BAR, num_workers=None):
+        self.fps = fps
+        self.beats_per_bar = tuple(beats_per_bar)
+        self.num_workers = num_workers
+
+    def map(self, beats, downbeats):
+        """
+        decode lists of beat and downbeat logits
+
+        return
+        ---
+            postp_beats : list[np.array]
+                beat times of every piece
+            postp_downbeats : list[np.array]
+                downbeat times of every piece
+        """
+        items = [
+            (to_numpy(b), to_numpy(d), self.beats_per_bar, self.fps)
+            for b, d in zip(beats, downbeats)
+        ]
+        if len(items) == 1 or self.num_workers == 0:
+            out = [_postprocess_item(item) for item in items]
+        else:
+            with Pool(self.num_workers) as pool:
+                out = pool.map(_postprocess_item, items)
+        if not out:
+            return [], []
+        postp_beats, postp_downbeats = zip(*out)
+        return list(postp_beats), list(postp_downbeats)
+
+    def __call__(self, beat, downbeat, padding_mask=None):
+        batched = beat.ndim != 1
+        if not batched:
+            beat, downbeat = beat[None], downbeat[None]
+            if padding_mask is not None:
+                padding_mask = padding_mask[None]
+        if padding_mask is not None:
+            beat = [b[m] for b, m in zip(beat, padding_mask)]
+            downbeat = [d[m] for d, m in zip(downbeat, padding_mask)]
+        postp_beat, postp_downbeat = self.map(beat, downbeat)
+        if not batched:
+            return postp_beat[0], postp_downbeat[0]
+        return postp_beat, postp_downbeat
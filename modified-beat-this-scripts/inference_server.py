@@ -0,0 +1,366 @@
+"""
+Local beat tracking service that keeps checkpoints in memory.
+
+Starting an evaluation script pays for importing Lightning, loading the
+checkpoint and building a Trainer before the first piece is processed. This
+server pays that once: it loads one or more checkpoints, listens on localhost
+and answers requests for audio files or precomputed spectrograms (.npy).
+Concurrent requests are micro-batched: the first request of a batch waits at
+most `--max_latency` seconds for others to arrive (up to `--max_batch`), and
+the chunks of all the requests for the same model go through the network
+together (see `batched_prediction.predict_spects`).
+
+`--synthetic` serves a fake 120 bpm predictor instead of checkpoints, which
+does not need torch or beat_this, so that the service and its clients can be
+exercised fully offline.
+
+example usage
+---
+    python inference_server.py --models final0=final0.ckpt fold0=fold0.ckpt
+
+    curl -s localhost:8765/predict \
+            -d '{"path": "track.wav", "model": "final0"}'
+    # {"beats": [...], "downbeats": [...], "timing": {...}}
+
+    # from python
+    from inference_server import request
+    result = request("track.wav", model="final0")
+"""
+
+import argparse
+import json
+import queue
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib import request as urlrequest
+
+import numpy as np
+
+FPS = 50
+DEFAULT_PORT = 8765
+
+
+def parse_models(models):
+    """
+    parse `name=checkpoint` pairs. a bare checkpoint is named after its stem
+    """
+    checkpoints = {}
+    for m in models:
+        name, sep, checkpoint = m.partition("=")
+        if not sep:
+            name, checkpoint = Path(m).stem, m
+        checkpoints[name] = checkpoint
+    return checkpoints
+
+
+def checkpoint_predictor(checkpoints, device="cpu", dbn=False, batch_size=32):
+    """
+    predict function backed by beat_this checkpoints
+
+    arguments
+    ---
+        checkpoints : dict
+            model name: checkpoint path or beat_this checkpoint name
+        device : str
+            torch device
+        dbn : bool
+            use the madmom dbn postprocessing instead of the minimal one
+        batch_size : int
+            maximum number of chunks per forward pass
+
+    return
+    ---
+        predict : function
+            predict(model_name, paths) -> list of (beats, downbeats)
+    """
+    import torch
+    from beat_this.inference import Audio2Beats
+    from beat_this.preprocessing import load_audio
+
+    from batched_prediction import predict_spects
+
+    models = {
+        name: Audio2Beats(checkpoint, device=device, dbn=dbn)
+        for name, checkpoint in checkpoints.items()
+    }
+    no_autocast = torch.autocast(torch.device(device).type, enabled=False)
+
+    def load_spect(a2b, path):
+        if path.endswith(".npy"):
+            return torch.from_numpy(np.load(path)).float()
+        signal, sr = load_audio(path)
+        return a2b.signal2spect(signal, sr)
+
+    @torch.inference_mode()
+    def predict(model_name, paths):
+        a2b = models[model_name]
+        spects = [load_spect(a2b, p) for p in paths]
+        logits = predict_spects(
+            a2b.model, spects, batch_size, a2b.device, no_autocast
+        )
+        return [a2b.frames2beats(beat, downbeat) for beat, downbeat in logits]
+
+    return predict
+
+
+def synthetic_predictor(bpm=120, beats_per_bar=4):
+    """
+    fake predict function with a constant tempo and meter, for running the
+    service without torch. the duration is read from the spectrogram shape
+    (.npy) or the audio header
+    """
+
+    def duration(path):
+        if path.endswith(".npy"):
+            return np.load(path, mmap_mode="r").shape[0] / FPS
+        import soundfile as sf
+
+        return sf.info(path).duration
+
+    def predict(model_name, paths):
+        out = []
+        for path in paths:
+            beats = np.arange(0, duration(path), 60 / bpm)
+            out.append((beats, beats[::beats_per_bar]))
+        return out
+
+    return predict
+
+
+class MicroBatcher:
+    """
+    collects concurrent requests and runs them through `predict` in batches
+
+    a worker thread takes the first pending request, then keeps collecting
+    requests until `max_batch` are pending or `max_latency` seconds have passed
+    since the first one arrived. the batch is split per model and every model
+    gets a single `predict(model_name, paths)` call
+    """
+
+    def __init__(self, predict, max_batch=8, max_latency=0.02):
+        self.predict = predict
+        self.max_batch = max_batch
+        self.max_latency = max_latency
+        self.pending = queue.Queue()
+        self.worker = threading.Thread(target=self._run, daemon=True)
+        self.worker.start()
+
+    def submit(self, path, model_name):
+        """
+        queue a request and block until its result is ready
+
+        return
+        ---
+            result : dict
+                beats, downbeats (in seconds) and timing of the request
+        """
+        future = Future()
+        self.pending.put((path, model_name, time.perf_counter(), future))
+        return future.result()
+
+    def _collect(self):
+        batch = [self.pending.get()]
+        deadline = batch[0][2] + self.max_latency
+        while len(batch) < self.max_batch:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.pending.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            per_model = defaultdict(list)
+            for job in batch:
+                per_model[job[1]].append(job)
+
+            for model_name, jobs in per_model.items():
+                start = time.perf_counter()
+                try:
+                    results = self.predict(model_name, [job[0] for job in jobs])
+                except Exception as e:
+                    for job in jobs:
+                        job[3].set_exception(e)
+                    continue
+                end = time.perf_counter()
+
+                for (path, _, submitted, future), (beats, downbeats) in zip(
+                    jobs, results
+                ):
+                    future.set_result(
+                        {
+                            "path": path,
+                            "model": model_name,
+                            "beats": np.asarray(beats).tolist(),
+                            "downbeats": np.asarray(downbeats).tolist(),
+                            "timing": {
+                                "queue_seconds": start - submitted,
+                                "predict_seconds": end - start,
+                                "total_seconds": end - submitted,
+                                "batch_size": len(jobs),
+                            },
+                        }
+                    )
+
+
+def make_handler(batcher, model_names):
+    """
+    http request handler class bound to a batcher
+    """
+
+    class Handler(BaseHTTPRequestHandler):
+        def _send(self, code, body):
+            data = json.dumps(body).encode()
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            if self.path == "/models":
+                self._send(200, {"models": model_names})
+            elif self.path == "/health":
+                self._send(200, {"status": "ok"})
+            else:
+                self._send(404, {"error": f"unknown endpoint {self.path}"})
+
+        def do_POST(self):
+            if self.path != "/predict":
+                self._send(404, {"error": f"unknown endpoint {self.path}"})
+                return
+            try:
+                length = int(self.headers.get("Content-Length", 0))
+                body = json.loads(self.rfile.read(length))
+                path = str(body["path"])
+                model_name = body.get("model", model_names[0])
+            except (ValueError, KeyError, TypeError) as e:
+                self._send(400, {"error": f"bad request: {e!r}"})
+                return
+            if model_name not in model_names:
+                self._send(400, {"error": f"unknown model {model_name}"})
+                return
+            if not Path(path).is_file():
+                self._send(404, {"error": f"no such file {path}"})
+                return
+            try:
+                self._send(200, batcher.submit(path, model_name))
+            except Exception as e:
+                self._send(500, {"error": repr(e)})
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def serve(predict, model_names, port=DEFAULT_PORT, max_batch=8, max_latency=0.02):
+    """
+    start the server on localhost and return it, serving from a daemon thread.
+    call `server.shutdown()` to stop it
+    """
+    batcher = MicroBatcher(predict, max_batch, max_latency)
+    server = ThreadingHTTPServer(
+        ("127.0.0.1", port), make_handler(batcher, list(model_names))
+    )
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def request(path, model=None, port=DEFAULT_PORT, timeout=600):
+    """
+    send one prediction request to a running server
+
+    return
+    ---
+        result : dict
+            beats, downbeats and timing, as returned by the server
+    """
+    body = {"path": str(Path(path).resolve())}
+    if model is not None:
+        body["model"] = model
+    req = urlrequest.Request(
+        f"http://127.0.0.1:{port}/predict",
+        data=json.dumps(body).encode(),
+        headers={"Content-Type": "application/json"},
+    )
+    with urlrequest.urlopen(req, timeout=timeout) as response:
+        return json.load(response)
+
+
+def main(args):
+    if args.synthetic:
+        predict = synthetic_predictor()
+        model_names = ["synthetic"]
+    else:
+        checkpoints = parse_models(args.models)
+        print(f"Loading {', '.join(checkpoints)} ...")
+        predict = checkpoint_predictor(
+            checkpoints, args.device, args.dbn, args.chunk_batch_size
+        )
+        model_names = list(checkpoints)
+
+    server = serve(predict, model_names, args.port, args.max_batch, args.max_latency)
+    print(f"Serving {', '.join(model_names)} on http://127.0.0.1:{args.port}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Local beat tracking service holding checkpoints in memory "
+        "and micro-batching concurrent requests."
+    )
+    parser.add_argument(
+        "--models",
+        type=str,
+        nargs="+",
+        default=["final0"],
+        help="checkpoints to serve, as name=checkpoint or checkpoint "
+        "(default: %(default)s)",
+    )
+    parser.add_argument(
+        "--synthetic",
+        action="store_true",
+        help="serve a fake 120 bpm predictor instead of checkpoints (no torch needed)",
+    )
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument(
+        "--max_batch",
+        type=int,
+        default=8,
+        help="maximum number of requests per batch (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--max_latency",
+        type=float,
+        default=0.02,
+        help="maximum seconds a request waits for a batch to fill (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--chunk_batch_size",
+        type=int,
+        default=32,
+        help="maximum number of chunks per forward pass (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--dbn",
+        default=False,
+        action=argparse.BooleanOptionalAction,
+        help="use madmom postprocessing dbn (default: %(default)s)",
+    )
+
+    args = parser.parse_args()
+
+    main(args)
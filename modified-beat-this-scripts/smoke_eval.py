@@ -0,0 +1,207 @@
+"""
+Stratified smoke evaluation.
+
+Selects a small fixed-seed subset of the pieces, stratified by dataset, genre
+(from the gtzan piece names) and meter (from `time_signatures_test.json`), and
+estimates the full-set mean of every metric from it with a 95% confidence
+interval. Every stratum gets at least two pieces (or all of its pieces) and the
+rest of the budget is allocated proportionally to the stratum sizes.
+
+`compute_paper_metrics_modified.py --smoke N` evaluates only the selected
+pieces. Run standalone on a per-piece results csv to check how close the
+estimates of a given budget are to the full-set means.
+
+example usage
+---
+    python smoke_eval.py \
+            --results ../beat-this-results-on-test/final-model-track-metrics.csv \
+            --meters ../notebooks/time-signatures-analysis-results/time_signatures_test.json \
+            --num_pieces 100
+"""
+
+import argparse
+import csv
+import json
+from collections import Counter
+from pathlib import Path
+
+import numpy as np
+
+Z_95 = 1.959963984540054
+MIN_PER_STRATUM = 2
+
+
+def load_meters(path):
+    """
+    invert a meter -> annotation file list json into a piece name -> meter dict,
+    e.g. "gtzan_country_00012.beats" in "4/4" gives {"gtzan_country_00012": "4/4"}
+    """
+    with open(path) as f:
+        meter_files = json.load(f)
+    return {
+        Path(name).stem: meter for meter, names in meter_files.items() for name in names
+    }
+
+
+def piece_stratum(piece, meters=None):
+    """
+    stratum of a piece from its path, which ends in dataset/piece_name/track.npy
+
+    return
+    ---
+        stratum : tuple
+            (dataset, genre, meter). the genre is only known for gtzan and the
+            meter only for pieces in `meters`, otherwise they are ""
+    """
+    dataset, name = Path(piece).parts[-3:-1]
+    fields = name.split("_")
+    genre = fields[1] if dataset == "gtzan" and len(fields) == 3 else ""
+    meter = meters.get(name, "") if meters else ""
+    return dataset, genre, meter
+
+
+def allocate(sizes, num_pieces):
+    """
+    number of pieces to sample from each stratum
+
+    arguments
+    ---
+        sizes : np.array
+            number of pieces in each stratum
+        num_pieces : int
+            total budget. it is exceeded if there are too many strata to give
+            each one MIN_PER_STRATUM pieces
+
+    return
+    ---
+        alloc : np.array
+            number of pieces to sample from each stratum
+    """
+    sizes = np.asarray(sizes, dtype=int)
+    alloc = np.minimum(sizes, MIN_PER_STRATUM)
+    rest = min(num_pieces, sizes.sum()) - alloc.sum()
+    if rest <= 0:
+        return alloc
+    # largest remainder allocation of the rest, proportional to what is left
+    capacity = sizes - alloc
+    quota = rest * capacity / capacity.sum()
+    extra = np.floor(quota).astype(int)
+    order = np.argsort(-(quota - extra), kind="stable")
+    extra[order[: rest - extra.sum()]] += 1
+    return alloc + np.minimum(extra, capacity)
+
+
+def sample_pieces(pieces, num_pieces, meters=None, seed=0):
+    """
+    fixed-seed stratified sample of the pieces
+
+    return
+    ---
+        index : np.array
+            sorted indices of the sampled pieces
+    """
+    strata = [piece_stratum(p, meters) for p in pieces]
+    members = {}
+    for i, s in enumerate(strata):
+        members.setdefault(s, []).append(i)
+    keys = sorted(members)
+    alloc = allocate([len(members[k]) for k in keys], num_pieces)
+    rng = np.random.default_rng(seed)
+    index = [
+        rng.choice(members[k], size=n, replace=False) for k, n in zip(keys, alloc)
+    ]
+    return np.sort(np.concatenate(index)).astype(int)
+
+
+def stratified_estimate(values, sampled, population_pieces, meters=None):
+    """
+    stratified estimate of the population mean of `values`, measured on
+    `sampled`, with a 95% confidence interval
+
+    return
+    ---
+        mean : float
+            estimated population mean
+        ci : float
+            half width of the 95% confidence interval
+    """
+    values = np.asarray(values, dtype=float)
+    sample_strata = [piece_stratum(p, meters) for p in sampled]
+    population = Counter(piece_stratum(p, meters) for p in population_pieces)
+    total = sum(population.values())
+    per_stratum = {}
+    for s, v in zip(sample_strata, values):
+        per_stratum.setdefault(s, []).append(v)
+
+    mean, var = 0.0, 0.0
+    for s, size in population.items():
+        y = np.asarray(per_stratum.get(s, []))
+        if len(y) == 0:
+            continue
+        weight = size / total
+        mean += weight * y.mean()
+        if len(y) > 1:
+            # with finite population correction
+            var += weight**2 * (1 - len(y) / size) * y.var(ddof=1) / len(y)
+    return mean, Z_95 * np.sqrt(var)
+
+
+def print_estimates(metrics, sampled, population_pieces, meters=None):
+    """
+    print the estimated full-set mean and 95% confidence interval of every metric
+    """
+    print(
+        f"Smoke estimate from {len(sampled)} of {len(population_pieces)} "
+        "pieces (95% CI)"
+    )
+    for k, v in metrics.items():
+        mean, ci = stratified_estimate(v, sampled, population_pieces, meters)
+        print(f"{k}: {round(mean,3)} +- {round(ci,3)}")
+
+
+def main(args):
+    with open(args.results, newline="") as f:
+        rows = list(csv.DictReader(f))
+    meters = load_meters(args.meters) if args.meters else None
+    pieces = [row["Piece"] for row in rows]
+    metric_names = [k for k in rows[0] if k not in ("Piece", "Dataset")]
+    metrics = {k: np.asarray([float(row[k]) for row in rows]) for k in metric_names}
+
+    index = sample_pieces(pieces, args.num_pieces, meters, args.seed)
+    sample = [pieces[i] for i in index]
+    print(f"{len(index)} of {len(pieces)} pieces, seed {args.seed}")
+    print(f"{'metric':<22}{'full':>8}{'estimate':>10}{'95% CI':>9}  covered")
+    for k, v in metrics.items():
+        mean, ci = stratified_estimate(v[index], sample, pieces, meters)
+        full = v.mean()
+        print(
+            f"{k:<22}{full:>8.3f}{mean:>10.3f}{ci:>9.3f}  "
+            f"{'yes' if abs(mean - full) <= ci else 'no'}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Checks stratified smoke estimates against the full-set means "
+        "of a per-piece results csv."
+    )
+    parser.add_argument(
+        "--results", type=str, required=True, help="per-piece metrics csv"
+    )
+    parser.add_argument(
+        "--meters",
+        type=str,
+        default=None,
+        help="time_signatures_test.json, to stratify by meter (default: no meter)",
+    )
+    parser.add_argument(
+        "--num_pieces",
+        type=int,
+        default=100,
+        help="number of pieces to sample (default: %(default)s)",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+
+    args = parser.parse_args()
+
+    main(args)
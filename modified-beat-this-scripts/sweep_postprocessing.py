@@ -0,0 +1,480 @@
+"""
+Sweep the peak-picking parameters of the minimal postprocessing over stored
+activations.
+
+The network runs once: the beat and downbeat logits of every piece are kept
+in memory (and optionally saved with --save_activations, so that later sweeps
+do not need torch or beat_this at all). Every point of the grid of beat and
+downbeat thresholds, max-pool kernel sizes and `eval_trim_beats` is then
+postprocessed and scored for all the pieces at once: the local maxima of each
+kernel size are found once with shifted maxima over the concatenated logits,
+thresholding is a mask over them, and the scoring is done with
+`beat_metrics`. Beat results are shared by all the downbeat thresholds.
+
+The postprocessing mirrors the beat_this minimal postprocessor: frames equal
+to the maximum of their window and above the threshold are peaks, adjacent
+peaks are merged like `deduplicate_peaks(width=1)`, and every downbeat is
+moved to the nearest beat, removing duplicates. With the default thresholds
+(0.5) and kernel (7) it gives the same results as the evaluation script.
+
+example usage
+---
+    python sweep_postprocessing.py \
+            --model final0.ckpt \
+            --datasplit val \
+            --save_activations val_activations.npz
+
+    python sweep_postprocessing.py \
+            --activations val_activations.npz \
+            --beat_thresholds 0.3 0.4 0.5 0.6 \
+            --kernels 5 7 9 11 \
+            --eval_trim_beats 0 5 \
+            --output_csv sweep.csv
+"""
+
+import argparse
+import csv
+import time
+
+import numpy as np
+
+import beat_metrics
+
+FPS = 50
+# as in beat_this: maxima within +/- 70 ms with a probability over 0.5
+DEFAULT_KERNEL = 7
+DEFAULT_THRESHOLD = 0.5
+
+
+def collect_activations(
+    checkpoint_path, datasplit, gpu=-1, num_workers=None, batch_size=32
+):
+    """
+    run the network once over a split and keep the logits and annotations
+
+    return
+    ---
+        activations : dict
+            concatenated "beat" and "downbeat" logits with their "frame_offsets",
+            the packed "truth_beat" and "truth_downbeat" times with their
+            offsets, and the "dataset" and "piece" of every piece
+    """
+    import torch
+
+    from batched_prediction import as_times, autocast_context, piece_windows, predict_spects
+    from compute_paper_metrics_modified import (
+        checkpoint_hparams,
+        datamodule_setup,
+        load_checkpoint_mmap,
+        piece_id,
+        plmodel_setup,
+    )
+
+    datamodule = datamodule_setup(
+        checkpoint_hparams(checkpoint_path), num_workers, datasplit
+    )
+    model, trainer = plmodel_setup(
+        load_checkpoint_mmap(checkpoint_path), None, False, gpu
+    )
+    dataloader = datamodule.predict_dataloader()
+
+    device = trainer.strategy.root_device
+    network = model.model.to(device).eval()
+    autocast = autocast_context(trainer, device)
+    # only the logits and annotations are kept, not the spectrograms
+    logits, items = [], []
+    for window, _ in piece_windows(dataloader.dataset, dataloader.num_workers):
+        with torch.inference_mode():
+            logits += predict_spects(
+                network, [item["spect"] for item in window], batch_size, device, autocast
+            )
+        items += [{k: v for k, v in item.items() if k != "spect"} for item in window]
+
+    beat, frame_offsets = pack_frames([b.float().cpu().numpy() for b, _ in logits])
+    downbeat, _ = pack_frames([d.float().cpu().numpy() for _, d in logits])
+    truth_beat, truth_beat_offsets = beat_metrics.pack(
+        [as_times(item["truth_orig_beat"]) for item in items]
+    )
+    truth_downbeat, truth_downbeat_offsets = beat_metrics.pack(
+        [as_times(item["truth_orig_downbeat"]) for item in items]
+    )
+    return dict(
+        beat=beat,
+        downbeat=downbeat,
+        frame_offsets=frame_offsets,
+        truth_beat=truth_beat,
+        truth_beat_offsets=truth_beat_offsets,
+        truth_downbeat=truth_downbeat,
+        truth_downbeat_offsets=truth_downbeat_offsets,
+        dataset=np.asarray([item["dataset"] for item in items]),
+        piece=np.asarray([piece_id(item["spect_path"]) for item in items]),
+        eval_trim_beats=np.float64(model.eval_trim_beats or 0),
+    )
+
+
+def pack_frames(pieces):
+    """
+    concatenate per-piece frame logits, with the start of every piece and a
+    final entry for the end
+    """
+    offsets = np.zeros(len(pieces) + 1, dtype=np.int64)
+    np.cumsum([len(p) for p in pieces], out=offsets[1:])
+    values = np.concatenate(pieces).astype(np.float32) if pieces else np.zeros(0)
+    return values, offsets
+
+
+def save_activations(path, activations):
+    np.savez(path, **activations)
+
+
+def load_activations(path):
+    with np.load(path) as data:
+        return {k: data[k] for k in data.files}
+
+
+def local_maxima(logits, offsets, kernel):
+    """
+    frames equal to the maximum of the `kernel` frames centered on them,
+    without crossing piece boundaries, like the max_pool1d of beat_this
+
+    return
+    ---
+        frames : np.array
+            global indices of the maxima in `logits`
+        values : np.array
+            their logits
+    """
+    n = len(logits)
+    seg = beat_metrics.segment_ids(offsets)
+    local = np.arange(n) - offsets[seg]
+    lengths = np.diff(offsets)[seg]
+    window_max = logits.copy()
+    half = kernel // 2
+    for shift in range(1, half + 1):
+        for sign in (-1, 1):
+            # value of the frame at local + sign * shift, if it is in the piece
+            source = np.arange(n) + sign * shift
+            valid = (local + sign * shift >= 0) & (local + sign * shift < lengths)
+            neighbour = np.where(valid, logits[np.clip(source, 0, n - 1)], -np.inf)
+            np.maximum(window_max, neighbour, out=window_max)
+    frames = np.flatnonzero(logits == window_max)
+    return frames, logits[frames]
+
+
+def deduplicate(frames, seg):
+    """
+    merge adjacent peaks like beat_this `deduplicate_peaks(width=1)`, for all
+    the pieces at once. that function replaces a peak by the running mean of
+    its group, so a run of consecutive frames is merged two by two
+
+    arguments
+    ---
+        frames : np.array
+            sorted local peak frames
+        seg : np.array
+            piece of every peak
+
+    return
+    ---
+        frames : np.array
+            merged (possibly fractional) peak frames
+        seg : np.array
+            piece of every merged peak
+    """
+    if len(frames) == 0:
+        return frames.astype(np.float64), seg
+    new_run = np.ones(len(frames), dtype=bool)
+    new_run[1:] = (np.diff(frames) != 1) | (np.diff(seg) != 0)
+    run_start = np.flatnonzero(new_run)
+    position = np.arange(len(frames)) - np.repeat(run_start, np.diff(np.append(run_start, len(frames))))
+    group_start = np.flatnonzero(position % 2 == 0)
+    sizes = np.diff(np.append(group_start, len(frames)))
+    merged = np.add.reduceat(frames.astype(np.float64), group_start) / sizes
+    return merged, seg[group_start]
+
+
+def pick_peaks(candidates, offsets, threshold):
+    """
+    peak times of every piece above a logit threshold
+
+    arguments
+    ---
+        candidates : tuple
+            (frames, values) from `local_maxima`
+        offsets : np.array
+            frame offsets of the pieces
+        threshold : float
+            logit threshold
+
+    return
+    ---
+        times : np.array
+            packed peak times in seconds
+        time_offsets : np.array
+            start of every piece in `times`
+    """
+    frames, values = candidates
+    frames = frames[values > threshold]
+    seg = beat_metrics.segment_ids(offsets)[frames]
+    merged, seg = deduplicate(frames - offsets[seg], seg)
+    time_offsets = np.zeros(len(offsets), dtype=np.int64)
+    np.cumsum(np.bincount(seg, minlength=len(offsets) - 1), out=time_offsets[1:])
+    return merged / FPS, time_offsets
+
+
+def snap_downbeats(beats, beat_offsets, downbeats, downbeat_offsets):
+    """
+    move every downbeat to the nearest beat of its piece (the earlier one on
+    ties) and remove the duplicates. pieces without beats keep their downbeats
+    """
+    n_pieces = len(beat_offsets) - 1
+    seg = beat_metrics.segment_ids(downbeat_offsets)
+    idx = beat_metrics.segmented_searchsorted(
+        beats, beat_offsets, downbeats, downbeat_offsets
+    )
+    start, end = beat_offsets[seg], beat_offsets[seg + 1]
+    has_beats = end > start
+    left = np.clip(idx - 1, start, np.maximum(end - 1, start))
+    right = np.clip(idx, start, np.maximum(end - 1, start))
+    if len(beats):
+        left_time = beats[np.minimum(left, len(beats) - 1)]
+        right_time = beats[np.minimum(right, len(beats) - 1)]
+        nearest = np.where(
+            np.abs(downbeats - left_time) <= np.abs(right_time - downbeats),
+            left_time,
+            right_time,
+        )
+        snapped = np.where(has_beats, nearest, downbeats)
+    else:
+        snapped = downbeats
+    # snapping keeps the order, so duplicates are adjacent
+    keep = np.ones(len(snapped), dtype=bool)
+    keep[1:] = (np.diff(snapped) != 0) | (np.diff(seg) != 0)
+    offsets = np.zeros(n_pieces + 1, dtype=np.int64)
+    np.cumsum(np.bincount(seg[keep], minlength=n_pieces), out=offsets[1:])
+    return snapped[keep], offsets
+
+
+def to_logit(probability):
+    return np.log(probability) - np.log1p(-probability)
+
+
+def sweep(activations, beat_thresholds, downbeat_thresholds, kernels, trims):
+    """
+    score every combination of postprocessing parameters
+
+    return
+    ---
+        results : list[dict]
+            one dict per grid point with the parameters and the per-piece
+            metrics (np.array) of `beat_metrics.compute_metrics`
+    """
+    offsets = activations["frame_offsets"]
+    truth_beat = (activations["truth_beat"], activations["truth_beat_offsets"])
+    truth_downbeat = (activations["truth_downbeat"], activations["truth_downbeat_offsets"])
+
+    results = []
+    for kernel in kernels:
+        beat_candidates = local_maxima(activations["beat"], offsets, kernel)
+        downbeat_candidates = local_maxima(activations["downbeat"], offsets, kernel)
+        downbeat_peaks = {
+            t: pick_peaks(downbeat_candidates, offsets, to_logit(t))
+            for t in downbeat_thresholds
+        }
+        for beat_threshold in beat_thresholds:
+            beats = pick_peaks(beat_candidates, offsets, to_logit(beat_threshold))
+            snapped = {
+                t: snap_downbeats(*beats, *peaks) for t, peaks in downbeat_peaks.items()
+            }
+            for trim in trims:
+                beat_scores = beat_metrics.piece_metrics(truth_beat, beats, trim)
+                for downbeat_threshold in downbeat_thresholds:
+                    downbeat_scores = beat_metrics.piece_metrics(
+                        truth_downbeat, snapped[downbeat_threshold], trim
+                    )
+                    metrics = {f"{k}_beat": v for k, v in beat_scores.items()}
+                    metrics.update({f"{k}_downbeat": v for k, v in downbeat_scores.items()})
+                    results.append(
+                        dict(
+                            beat_threshold=beat_threshold,
+                            downbeat_threshold=downbeat_threshold,
+                            kernel=kernel,
+                            eval_trim_beats=trim,
+                            metrics=metrics,
+                        )
+                    )
+    return results
+
+
+PARAMETERS = ("beat_threshold", "downbeat_threshold", "kernel", "eval_trim_beats")
+
+
+def write_csv(results, dataset, output_csv):
+    """
+    write the metrics of every grid point averaged over all the pieces and
+    over every dataset
+    """
+    datasets = ["all"] + list(np.unique(dataset))
+    metric_names = list(results[0]["metrics"])
+    with open(output_csv, mode="w", newline="") as file:
+        writer = csv.writer(file)
+        writer.writerow(list(PARAMETERS) + ["Dataset"] + metric_names)
+        for r in results:
+            for d in datasets:
+                mask = np.ones(len(dataset), dtype=bool) if d == "all" else dataset == d
+                writer.writerow(
+                    [r[p] for p in PARAMETERS]
+                    + [d]
+                    + [np.mean(r["metrics"][k][mask]) for k in metric_names]
+                )
+
+
+def print_best(results, dataset, metrics, default):
+    """
+    print, for every dataset and metric, the best grid point next to the
+    default postprocessing
+    """
+    baseline = next(
+        (r for r in results if all(r[p] == default[p] for p in PARAMETERS)), None
+    )
+    for d in ["all"] + list(np.unique(dataset)):
+        mask = np.ones(len(dataset), dtype=bool) if d == "all" else dataset == d
+        print(f"{d} ({mask.sum()} pieces)")
+        for metric in metrics:
+            means = [np.mean(r["metrics"][metric][mask]) for r in results]
+            best = results[int(np.argmax(means))]
+            setting = ", ".join(f"{p}={best[p]}" for p in PARAMETERS)
+            line = f"\t{metric}: best {max(means):.4f} ({setting})"
+            if baseline is not None:
+                line += f", default {np.mean(baseline['metrics'][metric][mask]):.4f}"
+            print(line)
+
+
+def main(args):
+    if args.activations is not None:
+        activations = load_activations(args.activations)
+    else:
+        start = time.perf_counter()
+        activations = collect_activations(
+            args.model, args.datasplit, args.gpu, args.num_workers, args.batch_size
+        )
+        print(f"Inference: {time.perf_counter() - start:.1f} s")
+        if args.save_activations is not None:
+            save_activations(args.save_activations, activations)
+            print(f"Activations saved to {args.save_activations}")
+
+    trims = args.eval_trim_beats
+    if trims is None:
+        trims = [float(activations.get("eval_trim_beats", 0.0))]
+    grid_size = (
+        len(args.beat_thresholds)
+        * len(args.downbeat_thresholds)
+        * len(args.kernels)
+        * len(trims)
+    )
+    n_pieces = len(activations["frame_offsets"]) - 1
+    print(f"Sweeping {grid_size} settings over {n_pieces} pieces")
+    start = time.perf_counter()
+    results = sweep(
+        activations, args.beat_thresholds, args.downbeat_thresholds, args.kernels, trims
+    )
+    print(f"Sweep: {time.perf_counter() - start:.1f} s")
+
+    write_csv(results, activations["dataset"], args.output_csv)
+    print(f"Metric surface written to {args.output_csv}")
+    default = dict(
+        beat_threshold=DEFAULT_THRESHOLD,
+        downbeat_threshold=DEFAULT_THRESHOLD,
+        kernel=DEFAULT_KERNEL,
+        eval_trim_beats=trims[0],
+    )
+    print_best(results, activations["dataset"], args.metrics, default)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Sweeps the peak-picking parameters of the minimal postprocessing "
+        "over activations computed once, and reports the metrics per dataset."
+    )
+    parser.add_argument("--model", type=str, help="Local checkpoint file")
+    parser.add_argument(
+        "--activations",
+        type=str,
+        default=None,
+        help="activations saved with --save_activations, instead of running --model",
+    )
+    parser.add_argument(
+        "--save_activations",
+        type=str,
+        default=None,
+        help="save the activations and annotations to this .npz file",
+    )
+    parser.add_argument(
+        "--datasplit",
+        type=str,
+        choices=("train", "val", "test"),
+        default="val",
+        help="data split to use: train, val or test (default: %(default)s)",
+    )
+    parser.add_argument("--gpu", type=int, default=0)
+    parser.add_argument(
+        "--num_workers", type=int, default=8, help="number of data loading workers"
+    )
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        default=32,
+        help="maximum number of chunks per forward pass (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--beat_thresholds",
+        type=float,
+        nargs="+",
+        default=[0.3, 0.4, 0.5, 0.6, 0.7],
+        help="beat probability thresholds (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--downbeat_thresholds",
+        type=float,
+        nargs="+",
+        default=[0.3, 0.4, 0.5, 0.6, 0.7],
+        help="downbeat probability thresholds (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--kernels",
+        type=int,
+        nargs="+",
+        default=[5, 7, 9, 11],
+        help="odd max-pool kernel sizes in frames, i.e. the minimum distance "
+        "between peaks (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--eval_trim_beats",
+        metavar="SECONDS",
+        type=float,
+        nargs="+",
+        default=None,
+        help="skip the events before these times when scoring (default: as stored "
+        "in the model)",
+    )
+    parser.add_argument(
+        "--metrics",
+        type=str,
+        nargs="+",
+        default=["F-measure_beat", "F-measure_downbeat"],
+        help="metrics to report the best settings for (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--output_csv",
+        type=str,
+        default="postprocessing_sweep.csv",
+        help="metrics of every setting, overall and per dataset (default: %(default)s)",
+    )
+
+    args = parser.parse_args()
+    if args.activations is None and args.model is None:
+        parser.error("--model is required unless --activations is given")
+    if any(k % 2 == 0 for k in args.kernels):
+        parser.error("--kernels must be odd")
+
+    main(args)
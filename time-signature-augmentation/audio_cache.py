@@ -0,0 +1,195 @@
+"""
+Persistent decoded-audio cache shared between processes
+
+decoding the same GTZAN/Beatles/RWC files with librosa is the slowest part of
+loading a track. when the `AUDIO_CACHE_DIR` environment variable is set, the
+decoded audio is stored there as float32 `.npy` files keyed by the source
+path, its modification time and size, the sampling rate and the mono flag,
+and read back with `np.load(mmap_mode="r")`, so that a warm cache is a page
+cache hit. the arrays returned from the cache are read-only.
+
+new entries are written to a temporary file and moved into place with
+`os.replace`, so concurrent writers never expose a partial file. the cache is
+kept under `AUDIO_CACHE_MAX_BYTES` (default 10 GiB) by evicting the least
+recently used entries, where reads refresh the modification time. each
+process keeps a running total of the cache size, counted once from the folder
+and then updated with its own writes, and only scans the folder again to
+evict when the total goes over the cap. entries are then evicted down to
+`EVICT_TO` of the cap, so that a full cache is not scanned on every miss.
+entries written by other processes are counted at the next scan, so with
+concurrent writers the cache can go over the cap until one of them evicts.
+a cache that is not writable (e.g. a shared read-only copy) is only read.
+
+example usage
+---
+    export AUDIO_CACHE_DIR=/scratch/audio_cache
+    export AUDIO_CACHE_MAX_BYTES=50000000000
+    python augment_dataset.py --data_home ... --datasets gtzan
+
+    # in python
+    import audio_cache
+    y, sr = audio_cache.load(path, 44100, True, decode=decode_fn)
+"""
+
+import hashlib
+import os
+import tempfile
+
+import numpy as np
+
+CACHE_DIR_ENV = "AUDIO_CACHE_DIR"
+MAX_BYTES_ENV = "AUDIO_CACHE_MAX_BYTES"
+DEFAULT_MAX_BYTES = 10 * 2**30
+# fraction of the cap the cache is evicted down to
+EVICT_TO = 0.9
+
+# running total of the size in bytes of each cache folder, see `load`
+_sizes = {}
+
+
+def cache_dir():
+    """
+    cache folder from the environment, None if the cache is disabled
+    """
+    return os.environ.get(CACHE_DIR_ENV) or None
+
+
+def max_bytes():
+    """
+    size cap of the cache in bytes, from the environment
+    """
+    return int(os.environ.get(MAX_BYTES_ENV, DEFAULT_MAX_BYTES))
+
+
+def cache_key(path, sr, mono):
+    """
+    sha1 of the absolute path, modification time and size of the source file,
+    the sampling rate and the mono flag. editing or replacing the source file
+    changes the key
+    """
+    stat = os.stat(path)
+    key = f"{os.path.abspath(path)}\0{stat.st_mtime_ns}\0{stat.st_size}\0{sr}\0{mono}"
+    return hashlib.sha1(key.encode()).hexdigest()
+
+
+def _lookup(directory, key, sr):
+    # the sampling rate is part of the file name, as it is only known after
+    # decoding when the native rate is requested (sr=None)
+    if sr is not None:
+        path = os.path.join(directory, f"{key}.{sr}.npy")
+        return (path, sr) if os.path.exists(path) else (None, None)
+    prefix = f"{key}."
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.name.startswith(prefix) and entry.name.endswith(".npy"):
+                return entry.path, int(entry.name[len(prefix) : -len(".npy")])
+    return None, None
+
+
+def _write(directory, key, y, sr):
+    final_path = os.path.join(directory, f"{key}.{sr}.npy")
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=f".{key}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            np.save(f, np.ascontiguousarray(y, dtype=np.float32))
+        os.replace(tmp_path, final_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return final_path
+
+
+def evict(directory, limit):
+    """
+    remove the least recently used entries until the cache is at most `limit`
+    bytes. entries removed concurrently by another process are ignored
+    """
+    entries = []
+    with os.scandir(directory) as it:
+        for entry in it:
+            if entry.name.endswith(".npy"):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= limit:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+    return total
+
+
+def load(path, sr, mono, decode, directory=None, limit=None):
+    """
+    decoded audio of `path`, through the cache if it is enabled
+
+    arguments
+    ---
+        path : str
+            audio file
+        sr : int or None
+            sampling rate, None for the native one
+        mono : bool
+            downmix to mono
+        decode : function
+            decode(path, sr, mono) -> (y, sr), called on cache misses
+        directory : str
+            cache folder. defaults to $AUDIO_CACHE_DIR, no caching if unset
+        limit : int
+            size cap in bytes. defaults to $AUDIO_CACHE_MAX_BYTES
+
+    return
+    ---
+        y : np.array
+            float32 audio, memory mapped (read-only) when it comes from the cache
+        sr : int
+            sampling rate of y
+    """
+    directory = directory or cache_dir()
+    if directory is None:
+        return decode(path, sr, mono)
+
+    os.makedirs(directory, exist_ok=True)
+    key = cache_key(path, sr, mono)
+    cached_path, cached_sr = _lookup(directory, key, sr)
+    if cached_path is not None:
+        try:
+            y = np.load(cached_path, mmap_mode="r")
+        except (FileNotFoundError, ValueError):
+            # evicted or replaced meanwhile, decode again
+            pass
+        else:
+            try:
+                # refresh the entry for the LRU eviction
+                os.utime(cached_path)
+            except OSError:
+                # read-only cache
+                pass
+            return y, cached_sr
+
+    y, sr_out = decode(path, sr, mono)
+    try:
+        cached_path = _write(directory, key, y, sr_out)
+    except OSError:
+        # read-only cache
+        return y, sr_out
+
+    limit = max_bytes() if limit is None else limit
+    if directory not in _sizes:
+        _sizes[directory] = evict(directory, limit)
+    else:
+        _sizes[directory] += np.size(y) * np.dtype(np.float32).itemsize
+        if _sizes[directory] > limit:
+            _sizes[directory] = evict(directory, int(EVICT_TO * limit))
+    try:
+        return np.load(cached_path, mmap_mode="r"), sr_out
+    except FileNotFoundError:
+        # evicted right away, e.g. a single file larger than the cap
+        return y, sr_out
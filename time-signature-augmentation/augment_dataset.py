@@ -12,16 +12,47 @@ augment rwc_classical to all available time signature:
     python augment_dataset.py \
             --data_home /home/Documents/datasets/ \
             --datasets rwc_classical
+
+profile the augmentation of 5 random gtzan tracks to 3/4, written to a scratch
+gtzan_genre_profile folder next to the datasets and rewritten on every run:
+    python augment_dataset.py \
+            --data_home /home/Documents/datasets/ \
+            --datasets gtzan_genre \
+            --target_aug 34 \
+            --profile 5
+
+write 7/4 edit lists instead of audio, rendered from the source when loaded:
+    python augment_dataset.py \
+            --data_home /home/Documents/datasets/ \
+            --datasets gtzan_genre \
+            --target_aug 74 \
+            --virtual
+
+plan the augmentation of gtzan to 3/4 and 7/4 in 16 shards, then run them:
+    python augment_dataset.py \
+            --data_home /home/Documents/datasets/ \
+            --datasets gtzan_genre \
+            --target_aug 34 74 \
+            --plan gtzan_plan.json \
+            --num_shards 16
+
+    python augment_dataset.py \
+            --from_plan gtzan_plan.json \
+            --worker $SLURM_ARRAY_TASK_ID \
+            --timings_json timings_$SLURM_ARRAY_TASK_ID.json
 """
 import argparse
+import json
 import os
+import random
+import shutil
 from collections import Counter
 
-import soundfile as sf
-import tqdm
+import profiling
 
-import meter_augmentation as me # noqa: E402
-import utils
+# soundfile, tqdm, meter_augmentation and utils (mirdata, librosa) are imported
+# where they are used, so that --help and runs where every augmentation already
+# exists start fast
 
 def load_meter(dataset, include, print_stats=False):
     """
@@ -58,7 +89,9 @@ def load_meter(dataset, include, print_stats=False):
     return meters
 
 
-def augment(dataset, track_meter, target_augmentation, aug_dict):
+def augment(
+    dataset, track_meter, target_augmentation, aug_dict, grids=None, stream=False, virtual=False
+):
     """
     augment tracks and write new audio file into specified folder defined inside
     the aug_dict parameter
@@ -71,28 +104,429 @@ def augment(dataset, track_meter, target_augmentation, aug_dict):
         dictionary with meter information of the track
     target_augmentation : str
         target augmentation value. 34 stands for 3/4. supported augmentations
-        are ["24", "34", "64", "74"]
+        are the keys of meter_augmentation.METER_TRANSFORMS
     aug_dict : dict
         dictionary with augmentation-related information
+    grids : dict
+        precomputed meter_augmentation.BeatGrid of each track, shared across
+        target augmentations. computed on the fly if None
+    stream : bool
+        read and write the audio in bar-aligned blocks instead of loading the
+        whole track, keeping memory constant for very long tracks. the output
+        keeps the sampling rate of the source file
+    virtual : bool
+        write an edit list (.edl, see edit_list.py) with the sample ranges of
+        the source instead of the audio. the audio is rendered when loaded
     """
+    import numpy as np
+    import soundfile as sf
+    import tqdm
+
+    import edit_list
+    from dataset import SAMPLE_RATE
+
+    if grids is None:
+        grids = {}
+
     augmentation_fn = aug_dict[target_augmentation]["function"]
     audio_path = aug_dict[target_augmentation]["audio_path"]
     beats_path = aug_dict[target_augmentation]["beats_path"]
+    meter_path = aug_dict[target_augmentation]["meter_path"]
 
     for track_id, meter in tqdm.tqdm(track_meter.items()):
-        _, sr = dataset.track(track_id).audio
-        y2, corrected_intervals, corrected_positions = augmentation_fn(dataset, track_id)
+        audio_file = os.path.join(audio_path, f"{track_id}_{target_augmentation}.wav")
+
+        if virtual:
+            audio_file = os.path.splitext(audio_file)[0] + edit_list.EXTENSION
+            intervals, corrected_intervals, corrected_positions = augmentation_fn.virtual(
+                dataset, track_id, SAMPLE_RATE, grid=grids.get(track_id)
+            )
+        elif stream:
+            sr, corrected_intervals, corrected_positions = augmentation_fn.stream(
+                dataset, track_id, audio_file, grid=grids.get(track_id)
+            )
+        else:
+            y2, sr, corrected_intervals, corrected_positions = augmentation_fn(
+                dataset, track_id, grid=grids.get(track_id)
+            )
+
+        with profiling.stage("write_annotations"):
+            beats_file = os.path.join(beats_path, f"{track_id}_{target_augmentation}.beats")
+            with open(beats_file, "w") as f:
+                for i in zip(corrected_intervals[:,0], corrected_positions):
+                    f.write(f"{i[0]}\t{i[1]}\n")
+
+            meter_file = os.path.join(meter_path, f"{track_id}_{target_augmentation}.meter")
+            with open(meter_file, "w") as f:
+                f.write(f"{target_augmentation[0]}/{target_augmentation[1]}")
+        profiling.add_file_bytes("written", beats_file)
+        profiling.add_file_bytes("written", meter_file)
+
+        if virtual:
+            with profiling.stage("write_edit_list"):
+                edit_list.write(
+                    audio_file,
+                    dataset.track(track_id).audio_path,
+                    SAMPLE_RATE,
+                    intervals,
+                    beats=np.column_stack((corrected_intervals[:, 0], corrected_positions)),
+                    meter=f"{target_augmentation[0]}/{target_augmentation[1]}",
+                )
+        elif not stream:
+            with profiling.stage("write_audio"):
+                sf.write(audio_file, y2, sr)
+        profiling.add_file_bytes("written", audio_file)
+
+    return
+
+
+# bytes of the header written by soundfile for a PCM_16 wav file
+WAV_HEADER_BYTES = 44
+
+
+def plan_track(
+    dataset, track_id, target_augmentation, grid, stream=False, virtual=False, output_path=None
+):
+    """
+    exact size of the outputs of `augment` for one track, from the audio
+    header and the beat grid only. `output_path` is the augmented dataset
+    folder, the edit lists of `virtual` store the source path relative to it
+    (absolute if None)
+
+    return
+    ---
+        plan : dict
+            number of kept beat intervals, source and output duration in
+            seconds, output samples, bytes of the audio (or edit list) and
+            annotation files, and the cost used to balance the shards: the
+            seconds of audio decoded and written (1 per track with `virtual`)
+    """
+    import numpy as np
+    import soundfile as sf
+
+    import edit_list
+    import meter_augmentation as me
+    from dataset import SAMPLE_RATE
+
+    transform = me.get_transform(target_augmentation)
+    audio_path = dataset.track(track_id).audio_path
+    info = sf.info(audio_path)
+    if stream:
+        sr, source_samples = info.samplerate, info.frames
+    else:
+        # librosa.load resamples to ceil(frames * ratio) samples
+        sr = SAMPLE_RATE
+        source_samples = int(np.ceil(info.frames * SAMPLE_RATE / info.samplerate))
+
+    good_intervals, corrected_intervals, corrected_positions = transform.intervals(grid, sr)
+    intervals = me.remix_intervals(good_intervals)
+    # as in remix and stream_remix, the ranges stop at the end of the source
+    clipped = np.minimum(intervals, source_samples)
+    output_samples = int(np.sum(clipped[:, 1] - clipped[:, 0]))
+
+    meter = f"{target_augmentation[0]}/{target_augmentation[1]}"
+    beats_bytes = sum(
+        len(f"{t}\t{p}\n".encode())
+        for t, p in zip(corrected_intervals[:, 0], corrected_positions)
+    )
+    if virtual:
+        beats = np.column_stack((corrected_intervals[:, 0], corrected_positions))
+        directory = None
+        if output_path is not None:
+            directory = os.path.abspath(os.path.join(output_path, target_augmentation, "audio"))
+        edl = edit_list.encode(audio_path, sr, intervals, beats, meter, directory)
+        audio_bytes = len(edl.encode())
+        cost = 1.0
+    else:
+        # mono PCM_16
+        audio_bytes = WAV_HEADER_BYTES + 2 * output_samples
+        cost = info.duration + output_samples / sr
+    return {
+        "kept_intervals": len(good_intervals),
+        "source_seconds": info.duration,
+        "output_samples": output_samples,
+        "output_seconds": output_samples / sr,
+        "audio_bytes": audio_bytes,
+        "annotation_bytes": beats_bytes + len(meter),
+        "cost": cost,
+    }
+
+
+def balance_shards(items, num_shards):
+    """
+    split work items into shards of about the same total cost, assigning the
+    most expensive items first to the cheapest shard (longest processing
+    time first scheduling), so that no shard ends with a long track
+
+    return
+    ---
+        shards : list[dict]
+            total "cost" and indices in `items` ("items") of every shard
+    """
+    import heapq
+
+    shards = [{"cost": 0.0, "items": []} for _ in range(num_shards)]
+    heap = [(0.0, i) for i in range(num_shards)]
+    for k in sorted(range(len(items)), key=lambda k: items[k]["cost"], reverse=True):
+        cost, i = heapq.heappop(heap)
+        shards[i]["items"].append(k)
+        shards[i]["cost"] = cost + items[k]["cost"]
+        heapq.heappush(heap, (shards[i]["cost"], i))
+    return shards
+
+
+def make_plan(args):
+    """
+    plan the augmentation of `args.datasets` to `args.target_aug` without
+    decoding any audio
+
+    return
+    ---
+        plan : dict
+            the options, one item per (dataset, target augmentation, track)
+            with its `plan_track` sizes, and the shards (indices of items)
+    """
+    import tqdm
+
+    import utils
+
+    items = []
+    for dataset_name in args.datasets:
+        output_path = os.path.join(args.data_home, f"{dataset_name}_augmented")
+        target_augs = missing_targets(output_path, args.target_aug)
+        if not target_augs:
+            continue
+        dataset = utils.custom_dataset_loader(args.data_home, dataset_name, "")
+        track_meters, grids = select_tracks(dataset, target_augs, cache_grids=args.cache_grids)
+        for ta in target_augs:
+            track_meter = track_meters[transform_source(ta)]
+            for track_id, meter in tqdm.tqdm(track_meter.items(), desc=f"{dataset_name} {ta}"):
+                item = {
+                    "dataset": dataset_name,
+                    "target_aug": ta,
+                    "track_id": track_id,
+                    "meter": meter,
+                }
+                item.update(
+                    plan_track(
+                        dataset,
+                        track_id,
+                        ta,
+                        grids[track_id],
+                        args.stream,
+                        args.virtual,
+                        output_path,
+                    )
+                )
+                items.append(item)
+
+    return {
+        "version": 1,
+        "data_home": args.data_home,
+        "stream": args.stream,
+        "virtual": args.virtual,
+        "cache_grids": args.cache_grids,
+        "items": items,
+        "shards": balance_shards(items, args.num_shards),
+    }
+
+
+def print_plan(plan):
+    """
+    print the outputs per dataset and target augmentation, and the balance of
+    the shards
+    """
+    totals = {}
+    for item in plan["items"]:
+        key = (item["dataset"], item["target_aug"])
+        total = totals.setdefault(key, Counter())
+        total.update(
+            tracks=1,
+            kept_intervals=item["kept_intervals"],
+            source_seconds=item["source_seconds"],
+            output_seconds=item["output_seconds"],
+            bytes=item["audio_bytes"] + item["annotation_bytes"],
+        )
+    print(
+        f"{'dataset':<20}{'target':>8}{'tracks':>8}{'intervals':>11}"
+        f"{'source (h)':>12}{'output (h)':>12}{'size (GB)':>11}"
+    )
+    for (dataset_name, ta), total in totals.items():
+        print(
+            f"{dataset_name:<20}{ta:>8}{total['tracks']:>8}{total['kept_intervals']:>11}"
+            f"{total['source_seconds'] / 3600:>12.2f}{total['output_seconds'] / 3600:>12.2f}"
+            f"{total['bytes'] / 1e9:>11.3f}"
+        )
+    size = sum(item["audio_bytes"] + item["annotation_bytes"] for item in plan["items"])
+    print(f"total: {len(plan['items'])} tracks, {size / 1e9:.3f} GB")
+    costs = [shard["cost"] for shard in plan["shards"]]
+    if costs and max(costs) > 0:
+        print(
+            f"{len(costs)} shards, cost min {min(costs):.0f} / max {max(costs):.0f} "
+            f"(max / mean {max(costs) / (sum(costs) / len(costs)):.3f})"
+        )
+
+
+def run_plan(plan, worker):
+    """
+    augment the tracks of one shard of a plan. shards can run concurrently,
+    they share the output folders
+    """
+    import meter_augmentation as me
+    import utils
+
+    items = [plan["items"][k] for k in plan["shards"][worker]["items"]]
+    print(f"worker {worker}: {len(items)} tracks")
+    by_dataset = {}
+    for item in items:
+        tracks = by_dataset.setdefault(item["dataset"], {}).setdefault(item["target_aug"], {})
+        tracks[item["track_id"]] = item["meter"]
+
+    for dataset_name, targets in by_dataset.items():
+        dataset = utils.custom_dataset_loader(plan["data_home"], dataset_name, "")
+        output_path = os.path.join(plan["data_home"], f"{dataset_name}_augmented")
+        track_ids = sorted({t for track_meter in targets.values() for t in track_meter})
+        grids = me.load_beat_grids(dataset, track_ids, cache=plan["cache_grids"])
+        aug_dict = make_aug_dict(output_path, list(targets), exist_ok=True)
+        for ta, track_meter in targets.items():
+            augment(
+                dataset, track_meter, ta, aug_dict, grids, plan["stream"], plan["virtual"]
+            )
+
 
-        with open(os.path.join(beats_path, f"{track_id}_{target_augmentation}.beats"), "w") as f:
-            for i in zip(corrected_intervals[:,0], corrected_positions):
-                f.write(f"{i[0]}\t{i[1]}\n")
+def missing_targets(output_path, target_aug):
+    """
+    target augmentations whose output folder does not exist yet
+    """
+    target_augs = []
+    for ta in target_aug:
+        aug_path = os.path.join(output_path, ta)
+        if os.path.isdir(aug_path):
+            print(f"{aug_path} already exists.")
+        else:
+            target_augs.append(ta)
+    return target_augs
+
+
+def transform_source(target_augmentation):
+    """
+    source meter of a target augmentation, e.g. "4/4" for "34"
+    """
+    import meter_augmentation as me
+
+    return me.get_transform(target_augmentation).source
+
+
+def select_tracks(dataset, target_augs, profile=None, cache_grids=False):
+    """
+    tracks and beat grids for each source meter, shared by all the target
+    augmentations with that source
+
+    return
+    ---
+        track_meters : dict
+            {source meter: {track_id: meter}}
+        grids : dict
+            meter_augmentation.BeatGrid of every selected track
+    """
+    import meter_augmentation as me
+
+    track_meters = {}
+    grids = {}
+    for source in {transform_source(ta) for ta in target_augs}:
+        track_meter = load_meter(dataset, include=[source])
+
+        if profile is not None:
+            sample = random.Random(0).sample(
+                sorted(track_meter), min(profile, len(track_meter))
+            )
+            track_meter = {t: track_meter[t] for t in sample}
+
+        track_meters[source] = track_meter
+        grids.update(me.load_beat_grids(dataset, track_meter, cache=cache_grids))
+    return track_meters, grids
 
-        with open(os.path.join(meter_path, f"{track_id}_{target_augmentation}.meter"), "w") as f:
-            f.write(f"{target_augmentation[0]}/{target_augmentation[1]}")
 
-        sf.write(os.path.join(audio_path, f"{track_id}_{target_augmentation}.wav"), y2, sr)
+def make_aug_dict(output_path, target_augs, exist_ok=False):
+    """
+    create the output folders of the target augmentations
 
     return
+    ---
+        aug_dict : dict
+            paths and meter transform of every target augmentation
+    """
+    import meter_augmentation as me
+
+    aug_dict = {}
+    for ta in target_augs:
+        aug_path = os.path.join(output_path, ta)
+        audio_path = os.path.join(aug_path, "audio")
+        annotations_path = os.path.join(aug_path, "annotations")
+        beats_path = os.path.join(annotations_path, "beats")
+        meter_path = os.path.join(annotations_path, "meter")
+        # tempo_path = os.path.join(annotations_path, "tempo")
+
+        aug_dict[ta] = {}
+        aug_dict[ta]["aug_path"] = aug_path
+        aug_dict[ta]["audio_path"] = audio_path
+        aug_dict[ta]["annotations_path"] = annotations_path
+        aug_dict[ta]["beats_path"] = beats_path
+        aug_dict[ta]["meter_path"] = meter_path
+        aug_dict[ta]["function"] = me.get_transform(ta)
+
+        os.makedirs(output_path, exist_ok=True)
+        for path in (aug_path, audio_path, annotations_path, beats_path, meter_path):
+            os.makedirs(path, exist_ok=exist_ok)
+        # os.mkdir(tempo_path)
+    return aug_dict
+
+
+def augment_datasets(args):
+    """
+    augment every dataset of `args.datasets` to the target augmentations of
+    `args.target_aug` whose output folder does not exist yet
+    """
+    for dataset_name in args.datasets:
+        if args.profile is not None:
+            # profiling runs only augment a sample of the tracks, they are
+            # written to a scratch folder so that they are not taken for a
+            # complete augmentation, and rewritten on every run
+            output_path = os.path.join(args.data_home, f"{dataset_name}_profile")
+            for ta in args.target_aug:
+                shutil.rmtree(os.path.join(output_path, ta), ignore_errors=True)
+        else:
+            output_path = os.path.join(args.data_home, f"{dataset_name}_augmented")
+        target_augs = missing_targets(output_path, args.target_aug)
+        if not target_augs:
+            # nothing to do, skip loading the dataset
+            continue
+
+        import utils
+
+        print(f"Augmenting {dataset_name}")
+        dataset = utils.custom_dataset_loader(args.data_home, dataset_name, "")
+
+        # tracks and beat grids for each source meter, shared by all the
+        # target augmentations with that source
+        track_meters, grids = select_tracks(
+            dataset, target_augs, args.profile, args.cache_grids
+        )
+
+        aug_dict = make_aug_dict(output_path, target_augs)
+        for ta in target_augs:
+            track_meter = track_meters[aug_dict[ta]["function"].source]
+
+            print(f"target augmentation = {aug_dict[ta]['function']}")
+            print(f"\toutput path {output_path}")
+            print(f"\taudio path {aug_dict[ta]['audio_path']}")
+            print(f"\tannotations path {aug_dict[ta]['annotations_path']}")
+            if args.profile is not None:
+                with profiling.profile(os.path.join(output_path, f"profile_{ta}")):
+                    augment(dataset, track_meter, ta, aug_dict, grids, args.stream, args.virtual)
+            else:
+                augment(dataset, track_meter, ta, aug_dict, grids, args.stream, args.virtual)
+
 
 def create_parser():
     """
@@ -103,8 +537,8 @@ def create_parser():
     parser.add_argument(
         "--data_home",
         type=str,
-        required=True,
-        help="path for datasets folder"
+        required=False,
+        help="path for datasets folder. required unless --from_plan is given"
     )
     parser.add_argument(
         "--datasets",
@@ -120,11 +554,79 @@ def create_parser():
         required=False,
         help="target augmentations. if no values are provided, augment to all possible target values"
     )
+    parser.add_argument(
+        "--cache_grids",
+        action="store_true",
+        help="persist the beat grid of each track as .npz next to its beat annotations"
+    )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="stream the audio in bar-aligned blocks to keep memory constant on long tracks. "
+        "output files keep the sampling rate of the source files"
+    )
+    parser.add_argument(
+        "--virtual",
+        action="store_true",
+        help="write edit lists (.edl) referencing the source audio instead of wav files. "
+        "the audio is rendered from the source when the track is loaded"
+    )
+    parser.add_argument(
+        "--plan",
+        type=str,
+        default=None,
+        metavar="PLAN_JSON",
+        help="only read the audio headers and beat annotations, write the exact output "
+        "durations and sizes and --num_shards balanced work shards to PLAN_JSON"
+    )
+    parser.add_argument(
+        "--num_shards",
+        type=int,
+        default=1,
+        help="number of work shards of --plan, e.g. one per worker (default: %(default)s)"
+    )
+    parser.add_argument(
+        "--from_plan",
+        type=str,
+        default=None,
+        metavar="PLAN_JSON",
+        help="augment the tracks of shard --worker of a plan written with --plan. "
+        "the datasets, targets and options are taken from the plan"
+    )
+    parser.add_argument(
+        "--worker",
+        type=int,
+        default=0,
+        help="shard of --from_plan to run (default: %(default)s)"
+    )
+    parser.add_argument(
+        "--profile",
+        type=int,
+        default=None,
+        metavar="N_TRACKS",
+        help="run cProfile and tracemalloc on a random sample of N_TRACKS tracks per dataset, "
+        "written to {data_home}/{dataset}_profile instead of the augmented folder"
+    )
+    parser.add_argument(
+        "--timings_json",
+        type=str,
+        default=None,
+        help="export the per-stage timings to this json file, e.g. one per --worker"
+    )
     return parser
 
 
 if __name__ == "__main__":
-    args = create_parser().parse_args()
+    parser = create_parser()
+    args = parser.parse_args()
+    if args.stream and args.virtual:
+        parser.error("--stream and --virtual cannot be combined")
+    if args.data_home is None and args.from_plan is None:
+        parser.error("--data_home is required unless --from_plan is given")
+    if args.plan is not None and args.from_plan is not None:
+        parser.error("--plan and --from_plan cannot be combined")
+    if args.profile is not None and (args.plan is not None or args.from_plan is not None):
+        parser.error("--profile cannot be combined with --plan or --from_plan")
 
     if args.target_aug is None:
         args.target_aug = ["24", "34"]
@@ -132,45 +634,20 @@ if __name__ == "__main__":
     if args.datasets is None:
         args.datasets = ["beatles", "gtzan", "rwcc", "rwcj"]
 
-    for dataset_name in args.datasets:
-        print(f"Augmenting {dataset_name}")
-        dataset = utils.custom_dataset_loader(args.data_home, dataset_name, "")
-
-        track_meter = load_meter(dataset, include=["4/4"])
+    if args.plan is not None:
+        plan = make_plan(args)
+        with open(args.plan, "w") as f:
+            json.dump(plan, f)
+        print_plan(plan)
+        print(f"plan written to {args.plan}, run each shard with --from_plan {args.plan} --worker i")
+    else:
+        if args.from_plan is not None:
+            with open(args.from_plan) as f:
+                run_plan(json.load(f), args.worker)
+        else:
+            augment_datasets(args)
 
-        aug_dict = {}
-        for ta in args.target_aug:
-            output_path = os.path.join(args.data_home, f"{dataset_name}_augmented")
-            aug_path = os.path.join(output_path, ta)
-            audio_path = os.path.join(aug_path, "audio")
-            annotations_path = os.path.join(aug_path, "annotations")
-            beats_path = os.path.join(annotations_path, "beats")
-            meter_path = os.path.join(annotations_path, "meter")
-            # tempo_path = os.path.join(annotations_path, "tempo")
-
-            aug_dict[ta] = {}
-            aug_dict[ta]["aug_path"] = aug_path
-            aug_dict[ta]["audio_path"] = audio_path
-            aug_dict[ta]["annotations_path"] = annotations_path
-            aug_dict[ta]["beats_path"] = beats_path
-            aug_dict[ta]["meter_path"] = meter_path
-            aug_dict[ta]["function"] = getattr(me, f"to_{ta}")
-
-            if not os.path.isdir(output_path):
-                os.mkdir(output_path)
-
-            if not os.path.isdir(aug_path):
-                os.mkdir(aug_path)
-                os.mkdir(audio_path)
-                os.mkdir(annotations_path)
-                os.mkdir(beats_path)
-                os.mkdir(meter_path)
-                # os.mkdir(tempo_path)
-
-                print(f"target augmentation = {ta[0]}/{ta[1]}")
-                print(f"\toutput path {output_path}")
-                print(f"\taudio path {audio_path}")
-                print(f"\tannotations path {annotations_path}")
-                augment(dataset, track_meter, ta, aug_dict)
-            else:
-                print(f"{aug_path} already exists.")
+        profiling.print_summary()
+        if args.timings_json is not None:
+            profiling.to_json(args.timings_json)
+            print(f"timings written to {args.timings_json}")
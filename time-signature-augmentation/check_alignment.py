@@ -0,0 +1,363 @@
+"""
+Check that the corrected beat annotations of augmented tracks line up with the
+spliced audio
+
+for every `{track_id}_{ta}.wav` written by `augment_dataset.py` (or edit list
+`{track_id}_{ta}.edl` with `--virtual`, rendered from its source) the onset
+strength envelope is computed once, and the beats are scored with windowed
+peak lookups at the annotated times: the mean of the envelope maxima around
+the beats divided by the mean of the maxima around the off-beats (midpoints
+between beats), and the median lag of the peak around each beat. the source
+track of every augmented track is scored the same way, as how much beats
+stand out from off-beats depends on the music. files are processed in a
+process pool. a file is flagged when its score is a low outlier within its
+target augmentation (robust z-score from the median absolute deviation), when
+its score is much lower than the score of its source, or when the median lag
+is too large. results are written to a csv, and the exit status is non-zero
+if too many files are flagged, so it can gate fine-tuning.
+
+example usage
+---
+check all the augmentations of gtzan:
+
+    python check_alignment.py \
+            --augmented_path /home/Documents/datasets/gtzan_genre_augmented \
+            --source_path /home/Documents/datasets/gtzan_genre \
+            --output_csv gtzan_alignment.csv \
+            --num_workers 8
+"""
+
+import argparse
+import csv
+import glob
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+SR = 22050
+HOP_LENGTH = 256
+
+
+def load_beat_times(beats_file):
+    """
+    beat times in seconds of a .beats file
+    """
+    return np.loadtxt(beats_file, ndmin=2)[:, 0]
+
+
+def onset_envelope(audio_file, sr=SR, hop_length=HOP_LENGTH):
+    """
+    onset strength envelope of an audio file or edit list and its frame rate
+    """
+    import librosa
+
+    import edit_list
+
+    if audio_file.endswith(edit_list.EXTENSION):
+        from dataset import load_audio
+
+        y, source_sr = load_audio(audio_file)
+        y = librosa.resample(y, orig_sr=source_sr, target_sr=sr)
+    else:
+        y, sr = librosa.load(audio_file, sr=sr, mono=True)
+    return librosa.onset.onset_strength(y=y, sr=sr, hop_length=hop_length), sr / hop_length
+
+
+def alignment_score(envelope, fps, beat_times, window=0.05):
+    """
+    score how well beat times line up with the peaks of an onset envelope
+
+    arguments
+    ---
+        envelope : np.array
+            onset strength envelope
+        fps : float
+            frame rate of the envelope
+        beat_times : np.array
+            annotated beat times in seconds
+        window : float
+            half width in seconds of the peak lookup window
+
+    return
+    ---
+        score : float
+            mean envelope maximum around the beats over the mean maximum around
+            the off-beats. about 1 means the beats are no stronger than any
+            other point
+        lag : float
+            median offset in seconds of the envelope maximum around each beat
+    """
+    from numpy.lib.stride_tricks import sliding_window_view
+
+    w = max(int(round(window * fps)), 1)
+    padded = np.pad(envelope, w, mode="constant")
+    # windows[i] is centered on frame i of the envelope
+    windows = sliding_window_view(padded, 2 * w + 1)
+
+    frames = np.round(beat_times * fps).astype(int)
+    frames = frames[(frames >= 0) & (frames < len(envelope))]
+    if len(frames) < 2:
+        return np.nan, np.nan
+    offbeats = (frames[:-1] + frames[1:]) // 2
+
+    on = windows[frames].max(axis=1)
+    off = windows[offbeats].max(axis=1)
+    score = on.mean() / max(off.mean(), np.finfo(float).tiny)
+    lag = np.median(windows[frames].argmax(axis=1) - w) / fps
+    return score, lag
+
+
+def check_file(audio_file, beats_file, window=0.05):
+    """
+    alignment score of one augmented track
+
+    return
+    ---
+        result : dict
+            file, target augmentation, number of beats, score and lag (in
+            seconds), or the error message if the file could not be checked
+    """
+    target = os.path.basename(os.path.dirname(os.path.dirname(audio_file)))
+    result = {"file": audio_file, "target": target, "n_beats": 0, "error": ""}
+    try:
+        beat_times = load_beat_times(beats_file)
+        envelope, fps = onset_envelope(audio_file)
+        score, lag = alignment_score(envelope, fps, beat_times, window)
+        result.update(n_beats=len(beat_times), score=score, lag=lag)
+    except Exception as e:
+        result.update(score=np.nan, lag=np.nan, error=repr(e))
+    return result
+
+
+def find_pairs(augmented_path):
+    """
+    (audio file or edit list, beats file) of every augmented track under
+    `{augmented_path}/{ta}/audio`
+    """
+    import edit_list
+
+    audio_files = []
+    for ext in (".wav", edit_list.EXTENSION):
+        audio_files += glob.glob(os.path.join(augmented_path, "*", "audio", f"*{ext}"))
+    pairs = []
+    for audio_file in sorted(audio_files):
+        aug_path = os.path.dirname(os.path.dirname(audio_file))
+        name = os.path.splitext(os.path.basename(audio_file))[0]
+        beats_file = os.path.join(aug_path, "annotations", "beats", f"{name}.beats")
+        pairs.append((audio_file, beats_file))
+    return pairs
+
+
+def find_sources(pairs, source_path):
+    """
+    (audio file, beats file) of the source track of every augmented track,
+    `{track_id}_{ta}` in the dataset at `source_path`, or None if it is not
+    there
+    """
+    from dataset import Dataset
+
+    dataset = Dataset(
+        data_home=os.path.join(source_path, "audio"),
+        annotations_home=os.path.join(source_path, "annotations"),
+        dataset_name=os.path.basename(os.path.normpath(source_path)),
+    )
+    track_ids = set(dataset.track_ids)
+    sources = []
+    for audio_file, _ in pairs:
+        target = os.path.basename(os.path.dirname(os.path.dirname(audio_file)))
+        name = os.path.splitext(os.path.basename(audio_file))[0]
+        track_id = name[: -len(target) - 1] if name.endswith(f"_{target}") else name
+        if track_id in track_ids:
+            track = dataset.track(track_id)
+            sources.append((track.audio_path, track.beats_path))
+        else:
+            sources.append(None)
+    return sources
+
+
+def add_source_scores(results, source_results):
+    """
+    add the score of the source track and the ratio of the score to it to
+    every result. the ratio is nan if the source could not be scored
+    """
+    for r, source in zip(results, source_results):
+        source_score = np.nan if source is None else source["score"]
+        r["source_score"] = source_score
+        if np.isfinite(source_score) and source_score > 0:
+            r["score_ratio"] = r["score"] / source_score
+        else:
+            r["score_ratio"] = np.nan
+    return results
+
+
+def flag_outliers(
+    results, z_threshold=3.5, min_score_ratio=0.75, max_lag=0.035, min_spread=0.1
+):
+    """
+    add the robust z-score of the score within each target augmentation and
+    the reasons for flagging every file. the spread (1.4826 * MAD) is at least
+    `min_spread` times the median score, so that small or very uniform groups
+    do not flag files that are only marginally worse. files are also flagged
+    when their score is below `min_score_ratio` times the score of their
+    source (see `add_source_scores`), files without a source score are not
+    """
+    for target in {r["target"] for r in results}:
+        group = [r for r in results if r["target"] == target]
+        scores = np.asarray([r["score"] for r in group], dtype=float)
+        median = np.nanmedian(scores) if np.isfinite(scores).any() else np.nan
+        spread = 1.4826 * np.nanmedian(np.abs(scores - median))
+        spread = max(spread, min_spread * median)
+        for r, score in zip(group, scores):
+            r["z"] = (score - median) / spread if spread > 0 else 0.0
+            reasons = []
+            if r["error"]:
+                reasons.append("error")
+            elif not np.isfinite(score):
+                reasons.append("too few beats")
+            else:
+                if r["z"] < -z_threshold:
+                    reasons.append("low outlier")
+                if r.get("score_ratio", np.nan) < min_score_ratio:
+                    reasons.append("beats weaker than in the source")
+                if abs(r["lag"]) > max_lag:
+                    reasons.append("lagged")
+            r["flagged"] = bool(reasons)
+            r["reason"] = "; ".join(reasons)
+    return results
+
+
+def write_csv(results, output_csv):
+    fields = [
+        "file",
+        "target",
+        "n_beats",
+        "score",
+        "lag",
+        "source_score",
+        "score_ratio",
+        "z",
+        "flagged",
+        "reason",
+        "error",
+    ]
+    with open(output_csv, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=fields)
+        writer.writeheader()
+        for r in results:
+            writer.writerow({k: r.get(k, "") for k in fields})
+
+
+def create_parser():
+    """
+    creates ArgumentParser
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--augmented_path",
+        type=str,
+        required=True,
+        help="output folder of augment_dataset.py, e.g. {data_home}/gtzan_augmented",
+    )
+    parser.add_argument(
+        "--source_path",
+        type=str,
+        default=None,
+        help="dataset folder of the source tracks, with audio and annotations/beats "
+        "(default: augmented_path without the _augmented suffix)",
+    )
+    parser.add_argument(
+        "--output_csv",
+        type=str,
+        default="alignment.csv",
+        help="per file results (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--num_workers",
+        type=int,
+        default=None,
+        help="number of processes (default: number of CPUs)",
+    )
+    parser.add_argument(
+        "--window",
+        type=float,
+        default=0.05,
+        help="half width in seconds of the peak lookup window (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--z_threshold",
+        type=float,
+        default=3.5,
+        help="flag scores below median - z_threshold * MAD (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--min_score_ratio",
+        type=float,
+        default=0.75,
+        help="flag files whose score is below this fraction of the score of their "
+        "source, 0 to disable (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--max_lag",
+        type=float,
+        default=0.035,
+        help="flag files whose median peak lag in seconds is larger (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--max_flagged",
+        type=float,
+        default=0.0,
+        help="fraction of flagged files above which the check fails (default: %(default)s)",
+    )
+    return parser
+
+
+if __name__ == "__main__":
+    args = create_parser().parse_args()
+
+    pairs = find_pairs(args.augmented_path)
+    if not pairs:
+        sys.exit(f"no augmented audio found in {args.augmented_path}")
+
+    source_path = args.source_path
+    if source_path is None:
+        source_path = os.path.normpath(args.augmented_path)
+        if source_path.endswith("_augmented"):
+            source_path = source_path[: -len("_augmented")]
+    sources = [None] * len(pairs)
+    if args.min_score_ratio > 0:
+        if os.path.isdir(os.path.join(source_path, "audio")):
+            sources = find_sources(pairs, source_path)
+        else:
+            print(f"no source tracks in {source_path}, scores are not compared to them")
+    # every source is scored once, for all its augmentations
+    unique_sources = sorted({s for s in sources if s is not None})
+
+    with ProcessPoolExecutor(args.num_workers) as executor:
+        files = pairs + unique_sources
+        all_results = list(
+            executor.map(
+                check_file,
+                [a for a, _ in files],
+                [b for _, b in files],
+                [args.window] * len(files),
+                chunksize=4,
+            )
+        )
+    results = all_results[: len(pairs)]
+    source_results = dict(zip(unique_sources, all_results[len(pairs) :]))
+    add_source_scores(results, [source_results.get(s) for s in sources])
+    flag_outliers(results, args.z_threshold, args.min_score_ratio, args.max_lag)
+    write_csv(results, args.output_csv)
+
+    flagged = [r for r in results if r["flagged"]]
+    for target in sorted({r["target"] for r in results}):
+        scores = [r["score"] for r in results if r["target"] == target]
+        print(f"{target}: {len(scores)} files, median score {np.nanmedian(scores):.2f}")
+    for r in flagged:
+        print(f"FLAGGED {r['file']}: {r['reason']}")
+    print(f"{len(flagged)}/{len(results)} files flagged, results in {args.output_csv}")
+
+    if len(flagged) > args.max_flagged * len(results):
+        sys.exit(1)
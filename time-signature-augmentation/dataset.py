@@ -5,14 +5,23 @@ Custom dataset
 import os
 import types
 from collections import Counter
-from typing import BinaryIO, Optional, TextIO, Tuple
+from functools import cached_property
+from typing import TYPE_CHECKING, BinaryIO, Optional, TextIO, Tuple
 
-import librosa
 import numpy as np
-from mirdata import annotations, initialize
-from mirdata.core import cached_property
+
+import audio_cache
+import edit_list
+
+# mirdata.annotations and librosa are only imported when annotations or audio
+# are loaded. functools.cached_property behaves like mirdata.core.cached_property
+# without importing mirdata.core, which is slow to import
+if TYPE_CHECKING:
+    from mirdata import annotations
 
 MAX_STR_LEN = 500
+# sampling rate of the loaded audio
+SAMPLE_RATE = 44100
 
 
 class Track:
@@ -26,7 +35,7 @@ class Track:
         self.meter_path = self.get_path("meter")
 
     @cached_property
-    def beats(self) -> Optional[annotations.BeatData]:
+    def beats(self) -> Optional["annotations.BeatData"]:
         return load_beats(self.beats_path)
 
     @cached_property
@@ -76,7 +85,9 @@ class Track:
         return repr_str
 
 
-def load_beats(fhandle: TextIO) -> annotations.BeatData:
+def load_beats(fhandle: TextIO) -> "annotations.BeatData":
+    from mirdata import annotations
+
     try:
         beats = np.loadtxt(fhandle)
         times = beats[:, 0]
@@ -112,11 +123,25 @@ def load_tempo(fhandle: TextIO) -> float:
     return float(tempo)
 
 
-def load_audio(fhandle: BinaryIO) -> Tuple[np.ndarray, float]:
-    audio, sr = librosa.load(fhandle, sr=44100, mono=True)
+def decode_audio(fhandle: BinaryIO, sr, mono) -> Tuple[np.ndarray, float]:
+    import librosa
+
+    audio, sr = librosa.load(fhandle, sr=sr, mono=mono)
     return audio, sr
 
 
+def load_source(fhandle: BinaryIO, sr=SAMPLE_RATE) -> Tuple[np.ndarray, float]:
+    # decoded audio is cached on disk if $AUDIO_CACHE_DIR is set
+    return audio_cache.load(fhandle, sr=sr, mono=True, decode=decode_audio)
+
+
+def load_audio(fhandle: BinaryIO) -> Tuple[np.ndarray, float]:
+    # virtual augmented tracks are rendered from their (cached) source
+    if str(fhandle).endswith(edit_list.EXTENSION):
+        return edit_list.render(edit_list.read(fhandle), load_source)
+    return load_source(fhandle)
+
+
 def indexing_function(filename):
     return os.path.splitext(filename)[0]
 
@@ -145,15 +170,21 @@ class Dataset:
                         "audio": os.path.join(root, name),
                         "beats": os.path.join(
                             beats_home,
-                            name.replace(".wav", ".beats").replace(".mp3", ".beats"),
+                            name.replace(".wav", ".beats")
+                            .replace(".mp3", ".beats")
+                            .replace(edit_list.EXTENSION, ".beats"),
                         ),
                         "tempo": os.path.join(
                             tempo_home,
-                            name.replace(".wav", ".bpm").replace(".mp3", ".bpm"),
+                            name.replace(".wav", ".bpm")
+                            .replace(".mp3", ".bpm")
+                            .replace(edit_list.EXTENSION, ".bpm"),
                         ),
                         "meter": os.path.join(
                             meter_home,
-                            name.replace(".wav", ".meter").replace(".mp3", ".meter"),
+                            name.replace(".wav", ".meter")
+                            .replace(".mp3", ".meter")
+                            .replace(edit_list.EXTENSION, ".meter"),
                         ),
                     }
                     file_code = indexing_function(name)
@@ -0,0 +1,188 @@
+"""
+Edit lists: augmented tracks stored as sample ranges of their source
+
+a meter augmentation only reorders beat intervals of the source track, so
+instead of writing the remixed audio, `augment_dataset.py --virtual` writes a
+small `.edl` file (json) per augmented track with the path (relative to the
+folder of the `.edl` file, so that the datasets folder can be moved or
+mounted elsewhere), modification time and size of the source audio file, the sampling rate, the sample ranges to
+concatenate and the corrected beats and meter. the audio is rendered when it
+is loaded (`dataset.load_audio` handles `.edl` files like audio files), from
+the decoded source, which is shared by all the augmentations of a track
+through the audio cache (see `audio_cache.py`).
+
+`frame_index` maps the frames of the augmented track to the frames of the
+source, so that features such as spectrograms can be taken from the source
+features instead of being computed on the rendered audio.
+
+example usage
+---
+    import edit_list
+
+    edl = edit_list.read("gtzan_genre_augmented/34/audio/blues.00000_34.edl")
+    y, sr = edit_list.render(edl, load_source)  # load_source(path, sr) -> (y, sr)
+    spect_34 = spect[edit_list.frame_index(edl, fps=50)]
+"""
+
+import json
+import os
+
+import numpy as np
+
+EXTENSION = ".edl"
+VERSION = 1
+
+
+def write(path, source_path, sr, intervals, beats=None, meter=None):
+    """
+    write the edit list of an augmented track
+
+    arguments
+    ---
+        path : str
+            output .edl file
+        source_path : str
+            source audio file
+        sr : int
+            sampling rate the intervals refer to. the source is decoded mono at
+            this rate when rendering
+        intervals : np.array
+            int64 array with the sample ranges of the source to concatenate,
+            shape (n, 2)
+        beats : np.array
+            corrected beat times and positions, shape (n, 2)
+        meter : str
+            meter of the augmented track, e.g. "3/4"
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    with open(path, "w") as f:
+        f.write(encode(source_path, sr, intervals, beats, meter, directory))
+
+
+def encode(source_path, sr, intervals, beats=None, meter=None, directory=None):
+    """
+    content of the .edl file written by `write`. the source path is stored
+    relative to `directory`, the folder of the .edl file, or absolute if None
+    """
+    stat = os.stat(source_path)
+    source = os.path.abspath(source_path)
+    if directory is not None:
+        source = os.path.relpath(source, directory)
+    edl = {
+        "version": VERSION,
+        "source": source,
+        "mtime_ns": stat.st_mtime_ns,
+        "size": stat.st_size,
+        "sr": int(sr),
+        "intervals": np.asarray(intervals, dtype=np.int64).tolist(),
+        "beats": None if beats is None else np.asarray(beats).tolist(),
+        "meter": meter,
+    }
+    return json.dumps(edl)
+
+
+def read(path):
+    """
+    read an edit list. the source path is returned absolute, the intervals as
+    an int64 array of shape (n, 2), and the beats as an array of shape (n, 2)
+    or None
+    """
+    with open(path) as f:
+        edl = json.load(f)
+    if edl.get("version") != VERSION:
+        raise ValueError(f"{path}: unsupported edit list version {edl.get('version')}")
+    # relative to the folder of the edit list
+    edl["source"] = os.path.normpath(
+        os.path.join(os.path.dirname(os.path.abspath(path)), edl["source"])
+    )
+    edl["intervals"] = np.asarray(edl["intervals"], dtype=np.int64).reshape(-1, 2)
+    if edl["beats"] is not None:
+        edl["beats"] = np.asarray(edl["beats"], dtype=np.float64).reshape(-1, 2)
+    return edl
+
+
+def check_source(edl):
+    """
+    raise a ValueError if the source file was modified after the edit list was
+    written, as its sample ranges may not match anymore
+    """
+    stat = os.stat(edl["source"])
+    if (stat.st_mtime_ns, stat.st_size) != (edl["mtime_ns"], edl["size"]):
+        raise ValueError(f"{edl['source']} changed since its edit list was written")
+
+
+def num_samples(edl):
+    """
+    length in samples of the rendered audio (less if intervals go past the end
+    of the source)
+    """
+    return int(np.sum(edl["intervals"][:, 1] - edl["intervals"][:, 0]))
+
+
+def render(edl, load_source):
+    """
+    audio of an augmented track
+
+    arguments
+    ---
+        edl : dict
+            edit list from `read`
+        load_source : function
+            load_source(path, sr) -> (y, sr), mono audio of the source
+
+    return
+    ---
+        y : np.array
+            augmented audio
+        sr : int
+            sampling rate
+    """
+    check_source(edl)
+    y, sr = load_source(edl["source"], edl["sr"])
+    y = np.concatenate([y[..., start:end] for start, end in edl["intervals"]], axis=-1)
+    return y, sr
+
+
+def frame_index(edl, fps, num_frames=None, num_source_frames=None):
+    """
+    frame of the source for every frame of the augmented track, so that
+    `features[frame_index(edl, fps)]` are the features of the augmented track
+    for frame-wise `features` of the source (e.g. a spectrogram). frames are
+    centered, frame i is at i / fps seconds, and mapped to the nearest source
+    frame, so the features are off by up to half a frame, and frames that
+    straddle a splice point only see one side of it
+
+    arguments
+    ---
+        edl : dict
+            edit list from `read`
+        fps : float
+            frame rate of the features
+        num_frames : int
+            number of frames of the augmented track. defaults to the number
+            of centered frames of the rendered audio
+        num_source_frames : int
+            number of frames of the source features, the index is clipped to
+            it if given
+
+    return
+    ---
+        index : np.array
+            int64 source frame of each frame
+    """
+    intervals = edl["intervals"]
+    sr = edl["sr"]
+    lengths = intervals[:, 1] - intervals[:, 0]
+    ends = np.cumsum(lengths)
+    starts = ends - lengths
+    if num_frames is None:
+        num_frames = int(ends[-1] / sr * fps) + 1 if len(ends) else 0
+
+    samples = np.floor(np.arange(num_frames) * sr / fps).astype(np.int64)
+    # interval of every frame, frames past the end stay in the last interval
+    k = np.minimum(np.searchsorted(ends, samples, side="right"), len(intervals) - 1)
+    source_samples = intervals[k, 0] + samples - starts[k]
+    index = np.maximum(np.round(source_samples * fps / sr).astype(np.int64), 0)
+    if num_source_frames is not None:
+        index = np.minimum(index, num_source_frames - 1)
+    return index
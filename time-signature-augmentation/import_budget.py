@@ -0,0 +1,123 @@
+"""
+Check the import time of the augmentation CLIs against a budget
+
+every module is imported in a fresh interpreter with `python -X importtime`.
+the check fails if its cumulative import time is over budget, or if it
+pulls in one of the heavy dependencies that should only be imported on the
+code paths that use them (mirdata, librosa, soundfile, ...). exits with a
+non-zero status on failure, so it can gate orchestration scripts or CI.
+
+example usage
+---
+    python import_budget.py
+    python import_budget.py --scale 2  # slower machine
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+
+# module: (budget in milliseconds, packages it must not import)
+BUDGETS = {
+    "augment_dataset": (50, ("mirdata", "librosa", "soundfile", "numpy", "tqdm")),
+    "parse_candombe": (50, ("mirdata", "numpy", "tqdm")),
+    "make_splits": (50, ("mirdata", "librosa", "numpy")),
+    "utils": (20, ("mirdata", "librosa", "numpy")),
+    "dataset": (250, ("mirdata", "librosa")),
+    "profiling": (20, ("numpy",)),
+}
+
+
+def import_times(module):
+    """
+    import `module` in a fresh interpreter
+
+    return
+    ---
+        times : dict
+            cumulative import time in microseconds of every imported module
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"importing {module} failed:\n{result.stderr}")
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line.split("|")
+        times[name.strip()] = int(cumulative)
+    return times
+
+
+def check(module, budget_ms, forbidden):
+    """
+    return
+    ---
+        elapsed_ms : float
+            cumulative import time of `module`
+        errors : list[str]
+            budget and forbidden import violations
+    """
+    times = import_times(module)
+    elapsed_ms = times[module] / 1000
+    errors = []
+    if elapsed_ms > budget_ms:
+        errors.append(f"{elapsed_ms:.1f} ms over the {budget_ms:.0f} ms budget")
+    imported = {name.split(".")[0] for name in times}
+    for package in forbidden:
+        if package in imported:
+            errors.append(f"imports {package}")
+    return elapsed_ms, errors
+
+
+def main(args):
+    failed = False
+    print(f"{'module':<20}{'time (ms)':>10}{'budget':>8}  status")
+    for module, (budget_ms, forbidden) in BUDGETS.items():
+        if args.modules and module not in args.modules:
+            continue
+        budget_ms *= args.scale
+        # keep the fastest of a few runs to reduce noise
+        runs = [check(module, budget_ms, forbidden) for _ in range(args.repeat)]
+        elapsed_ms, errors = min(runs, key=lambda run: run[0])
+        failed |= bool(errors)
+        status = "; ".join(errors) if errors else "ok"
+        print(f"{module:<20}{elapsed_ms:>10.1f}{budget_ms:>8.0f}  {status}")
+    sys.exit(1 if failed else 0)
+
+
+def create_parser():
+    """
+    creates ArgumentParser
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--modules",
+        type=str,
+        nargs="+",
+        default=None,
+        help="modules to check. if None, checks all the modules with a budget",
+    )
+    parser.add_argument(
+        "--scale",
+        type=float,
+        default=1.0,
+        help="multiply every budget, for slower machines (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=3,
+        help="number of runs per module, the fastest one is kept (default: %(default)s)",
+    )
+    return parser
+
+
+if __name__ == "__main__":
+    main(create_parser().parse_args())
@@ -2,224 +2,545 @@
 Meter augmentation functions
 """
 
-import librosa
+import os
+
 import numpy as np
+import soundfile as sf
+
+import profiling
+
+
+def time_to_samples(times, sr):
+    """
+    convert times in seconds to int64 sample offsets. like
+    librosa.time_to_samples, offsets are floored
+    """
+    return np.floor(np.asarray(times, dtype=np.float64) * sr).astype(np.int64)
 
 
-def remix(y, sr, intervals):
+def remix(y, intervals):
     """
-    remix track
+    remix track by concatenating sample ranges
 
     arguments
     ---
         y : np.array
             audio array
-        sr : float
-            sampling rate
         intervals : np.array
-            array with beat intervals we want to keep
+            int64 array with the sample ranges of the beat intervals we want to
+            keep, shape (n, 2)
     """
-    # we need to add the start interval otherwise librosa.remix
-    # will not consider the first miliseconds
-    start_interval = np.asarray([[0, intervals[0][0]]])
-    remix_intervals = np.concatenate((start_interval, intervals))
-
-    y2 = librosa.effects.remix(y, librosa.time_to_samples(remix_intervals, sr=sr))
+    with profiling.stage("remix"):
+        y2 = np.concatenate(
+            [y[..., start:end] for start, end in remix_intervals(intervals)], axis=-1
+        )
 
     return y2
 
 
-def get_beat_intervals(beats):
+def remix_intervals(intervals):
     """
-    given a list of beats, create inter beat intervals
+    all the sample ranges concatenated by `remix`, i.e. the kept intervals
+    preceded by the audio before the first one
     """
-    beat_intervals = []
-    for idx, val in enumerate(beats.times):
-        if idx == len(beats.times) - 1:
-            break
-        beat_intervals.append([val, beats.times[idx + 1]])
+    # we need to add the start interval otherwise the first miliseconds
+    # before the first kept beat are lost
+    start_interval = np.asarray([[0, intervals[0][0]]], dtype=np.int64)
+    return np.concatenate((start_interval, intervals))
 
-    return np.asarray(beat_intervals)
 
-
-def correct_annotations(beats, good_intervals):
+def _copy_frames(src, dst, start, end, block_frames):
     """
-    correct annotations for time displacements
+    copy frames [start, end) of `src` into `dst` as mono, `block_frames` at a time
     """
-    good_durations = np.diff(good_intervals)
-    corrected_intervals = []
-    start = beats.times[0]
-    for idx in range(len(good_intervals)):
-        corrected_intervals.append([start, start + good_durations[idx][0]])
-        start += good_durations[idx][0]
-
-    corrected_intervals = np.asarray(corrected_intervals)
-
-    return corrected_intervals
-
+    src.seek(start)
+    while start < end:
+        block = src.read(min(block_frames, end - start), dtype="float32", always_2d=True)
+        if len(block) == 0:
+            break
+        dst.write(block.mean(axis=1))
+        profiling.add_bytes("read", block.nbytes)
+        start += len(block)
 
-def correct_positions(positions, meter):
-    """
-    correct the beat values for an augmented track
 
-    example
-    ---
-    augmented_positions = np.array([3,4,5,1,2,3,4,5])
-    corrected = np.array([3,4,5,1,2,3,4,5])
+def stream_remix(in_path, out_path, intervals, bars, block_frames=2**18):
     """
-    corrected = (
-        np.arange(positions[0] - 1, len(positions) + positions[0] - 1) % meter + 1
-    )
-    return corrected
+    remix an audio file into `out_path` without loading it in memory.
 
+    the input is read one bar at a time (all the intervals of a bar are sliced
+    from a single read) and the output is written incrementally, so the peak
+    memory is bounded by the longest bar or `block_frames`, whichever is
+    smaller, regardless of the track length. like `load_audio`, the output is
+    mono, but it keeps the sampling rate of the input file.
 
-def to_24(dataset, track_id, **kwargs):
+    arguments
+    ---
+        in_path : str
+            input audio file
+        out_path : str
+            output wav file
+        intervals : np.array
+            int64 array with the sample ranges of the beat intervals we want to
+            keep, shape (n, 2)
+        bars : np.array
+            bar index of each interval. consecutive intervals of the same bar
+            are read together
+        block_frames : int
+            maximum number of frames read at once
     """
-    augment 4/4 track to 2/4 by removing two beat bars
+    with sf.SoundFile(in_path) as src, sf.SoundFile(
+        out_path, "w", samplerate=src.samplerate, channels=1
+    ) as dst:
+        intervals = np.minimum(intervals, src.frames)
+        # audio before the first kept interval
+        _copy_frames(src, dst, 0, intervals[0][0], block_frames)
+
+        bar_starts = np.flatnonzero(np.diff(bars, prepend=bars[0] - 1))
+        for bar in np.split(intervals, bar_starts[1:]):
+            start, end = bar[:, 0].min(), bar[:, 1].max()
+            if end - start > block_frames:
+                for ival_start, ival_end in bar:
+                    _copy_frames(src, dst, ival_start, ival_end, block_frames)
+                continue
+
+            src.seek(start)
+            block = src.read(end - start, dtype="float32", always_2d=True).mean(axis=1)
+            profiling.add_bytes("read", block.nbytes)
+            for ival_start, ival_end in bar - start:
+                dst.write(block[ival_start:ival_end])
+
+
+class BeatGrid:
     """
-    y, sr = dataset.track(track_id).audio
-    beats = dataset.track(track_id).beats
+    beat annotations of a track, computed once and shared by all the meter
+    transforms. all the arrays are contiguous.
 
-    beat_intervals = get_beat_intervals(beats)
-    beat_positions = beats.positions.astype(int)
+    attributes
+    ---
+        times : np.array
+            beat times in seconds
+        positions : np.array
+            beat positions inside the bar (1 is the downbeat) as integers
+        intervals : np.array
+            inter beat intervals, shape (len(times) - 1, 2)
+        bars : np.array
+            bar index of each beat. a new bar starts whenever the beat position
+            does not increase, so a leading incomplete bar is bar 0
+        downbeats : np.array
+            indices of the downbeats (position 1) in `times`
+    """
 
-    good_intervals = beat_intervals[beat_positions[:-1] < 3]
-    # drop 3 and 4
-    good_positions = beat_positions[beat_positions < 3]
+    def __init__(self, times, positions):
+        self.times = np.ascontiguousarray(times, dtype=np.float64)
+        self.positions = np.ascontiguousarray(positions).astype(np.int64)
+        self.intervals = np.ascontiguousarray(
+            np.column_stack((self.times[:-1], self.times[1:]))
+        )
+        new_bar = np.ones(len(self.positions), dtype=bool)
+        new_bar[1:] = np.diff(self.positions) <= 0
+        self.bars = np.cumsum(new_bar) - 1
+        self.downbeats = np.flatnonzero(self.positions == 1)
 
-    corrected_intervals = correct_annotations(beats, good_intervals)
-    corrected_positions = correct_positions(good_positions, 2)
+    @classmethod
+    def from_beats(cls, beats):
+        return cls(beats.times, beats.positions)
 
-    y2 = remix(y, sr, good_intervals)
+    def save(self, path):
+        np.savez(path, times=self.times, positions=self.positions)
 
-    return y2, corrected_intervals, corrected_positions
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(data["times"], data["positions"])
 
 
-def to_34(dataset, track_id):
+def grid_cache_path(beats_path):
     """
-    augment 4/4 track to 3/4 by removing one beat interval from each bar
+    path of the .npz cache stored next to a beats annotation file
     """
+    return f"{beats_path}.npz"
 
-    beat_to_skip = 4
 
-    if beat_to_skip is None:
-        import random
+def load_beat_grid(track, cache=False):
+    """
+    compute the BeatGrid of a track.
 
-        beat_to_skip = random.randint(2, 4)
-        print(f"skipping {beat_to_skip}")
+    if `cache` is True the grid is persisted as .npz next to the beat annotations
+    and reused as long as it is newer than the annotation file.
+    """
+    beats_path = getattr(track, "beats_path", None)
+    cache = cache and beats_path is not None and os.path.isfile(beats_path)
 
-    y, sr = dataset.track(track_id).audio
-    beats = dataset.track(track_id).beats
+    if cache:
+        npz_path = grid_cache_path(beats_path)
+        if (
+            os.path.isfile(npz_path)
+            and os.path.getmtime(npz_path) >= os.path.getmtime(beats_path)
+        ):
+            profiling.add_file_bytes("read", npz_path)
+            return BeatGrid.load(npz_path)
 
-    beat_intervals = get_beat_intervals(beats)
-    beat_positions = beats.positions.astype(int)
+    profiling.add_file_bytes("read", beats_path)
+    grid = BeatGrid.from_beats(track.beats)
 
-    good_intervals = beat_intervals[beat_positions[:-1] != beat_to_skip]
-    good_positions = beat_positions[beat_positions != beat_to_skip]
+    if cache:
+        grid.save(npz_path)
 
-    corrected_intervals = correct_annotations(beats, good_intervals)
-    corrected_positions = correct_positions(good_positions, 3)
+    return grid
 
-    y2 = remix(y, sr, good_intervals)
 
-    return y2, corrected_intervals, corrected_positions
+def load_beat_grids(dataset, track_ids, cache=False):
+    """
+    compute the BeatGrid of several tracks
+
+    return
+    ---
+        grids : dict
+            dictionary of type {track_id: BeatGrid}
+    """
+    grids = {}
+    with profiling.stage("load_beats"):
+        for track_id in track_ids:
+            grids[track_id] = load_beat_grid(dataset.track(track_id), cache=cache)
+    return grids
 
 
-def to_54(dataset, track_id, **kwargs):
+def load_track(dataset, track_id, grid=None):
     """
-    augment 4/4 track to 5/4 by repeating one beat interval per bar
+    load audio and beat annotations of a track. beat annotations are only
+    loaded if no precomputed `grid` is given
+
+    return
+    ---
+        y : np.array
+            audio array
+        sr : float
+            sampling rate
+        grid : BeatGrid
+            beat annotations
     """
-    y, sr = dataset.track(track_id).audio
-    beats = dataset.track(track_id).beats
+    track = dataset.track(track_id)
 
-    beat_intervals = get_beat_intervals(beats)
-    beat_positions = beats.positions.astype(int)
+    with profiling.stage("load_audio"):
+        y, sr = track.audio
+    profiling.add_file_bytes("read", track.audio_path)
 
-    good_intervals = []
-    good_positions = []
+    if grid is None:
+        with profiling.stage("load_beats"):
+            grid = load_beat_grid(track)
 
-    for ival, val in zip(beat_intervals, beat_positions):
-        good_intervals.append(ival)
-        good_positions.append(val)
+    return y, sr, grid
 
-        if val == 3:
-            good_intervals.append(ival)
-            good_positions.append(5)
 
-    corrected_intervals = correct_annotations(beats, good_intervals)
-    corrected_positions = correct_positions(good_positions, 5)
+def correct_annotations(intervals, sr):
+    """
+    correct annotations for time displacements.
 
-    y2 = remix(y, sr, good_intervals)
+    the corrected intervals are derived from the sample positions where each
+    kept interval lands in the remixed audio, so they stay aligned with it
+    regardless of the track length.
 
-    return y2, corrected_intervals, corrected_positions
+    arguments
+    ---
+        intervals : np.array
+            int64 array with the sample ranges of the kept beat intervals, as
+            passed to `remix`
+        sr : float
+            sampling rate
+
+    return
+    ---
+        corrected_intervals : np.array
+            intervals in seconds inside the remixed audio
+    """
+    intervals = np.asarray(intervals, dtype=np.int64).reshape(-1, 2)
+    lengths = intervals[:, 1] - intervals[:, 0]
+    # the audio before the first kept interval is kept as is
+    ends = intervals[0, 0] + np.cumsum(lengths)
+    starts = ends - lengths
 
+    return np.column_stack((starts, ends)) / sr
 
-def to_64(dataset, track_id, **kwargs):
+
+def parse_beats(spec):
     """
-    augment 4/4 track to 6/4 by removing two beat intervals for every other bar
+    parse a beat list such as "4", "1-2" or "1,3-4" into a list of beats
     """
-    y, sr = dataset.track(track_id).audio
-    beats = dataset.track(track_id).beats
+    beats = []
+    for part in spec.split(","):
+        first, _, last = part.strip().partition("-")
+        beats.extend(range(int(first), int(last or first) + 1))
+    return beats
 
-    beat_intervals = get_beat_intervals(beats)
-    beat_positions = beats.positions.astype(int)
 
-    good_intervals = []
-    good_positions = []
-    keep = True
+def parse_pattern(pattern):
+    """
+    parse a meter pattern into a list of (period, phase, operation, beats)
+    clauses.
+
+    a pattern is a list of clauses separated by ";". each clause is an
+    operation ("drop" or "repeat") followed by the beats it applies to
+    (optionally introduced by "beat" or "beats"), optionally preceded by the
+    bars it applies to:
+
+        "drop beat 4", "drop 4"             drop beat 4 of every bar
+        "repeat beat 3", "repeat 3"         play beat 3 twice in every bar
+        "drop beats 3-4"                    drop beats 3 and 4 of every bar
+        "every other bar drop 1-2"          drop beats 1 and 2 of the second bar
+                                            of every pair of bars
+        "every 3 bars drop 1"               drop beat 1 of the third bar of every
+                                            group of 3 bars
+        "keep"                              keep all the beats (e.g. to regroup
+                                            bars into a different meter)
+    """
+    clauses = []
+    for clause in pattern.split(";"):
+        words = clause.split()
+        if words == ["keep"] or not words:
+            continue
 
-    for ival, val in zip(beat_intervals, beat_positions):
-        # Always keep 3 and 4
-        if val > 2:
-            good_intervals.append(ival)
-            good_positions.append(val)
-        else:
-            if keep:
-                good_intervals.append(ival)
-                good_positions.append(val)
-                if val == 2:
-                    keep = False
-            else:
-                if val == 2:
-                    keep = True
+        period = 1
+        if words[:3] == ["every", "other", "bar"]:
+            period, words = 2, words[3:]
+        elif len(words) > 3 and words[0] == "every" and words[2] == "bars":
+            period, words = int(words[1]), words[3:]
 
-    corrected_intervals = correct_annotations(beats, good_intervals)
-    corrected_positions = correct_positions(good_positions, 6)
+        if len(words) == 3 and words[1] in ("beat", "beats"):
+            words = [words[0], words[2]]
+        if len(words) != 2 or words[0] not in ("drop", "repeat"):
+            raise ValueError(f"invalid meter pattern clause '{clause.strip()}'")
 
-    y2 = remix(y, sr, good_intervals)
+        clauses.append((period, period - 1, words[0], parse_beats(words[1])))
 
-    return y2, corrected_intervals, corrected_positions
+    return clauses
 
 
-def to_74(dataset, track_id, **kwargs):
+class MeterTransform:
     """
-    augment 4/4 track to 7/4 by removing one beat interval for every other bar
-    """
-    y, sr = dataset.track(track_id).audio
-    beats = dataset.track(track_id).beats
-
-    beat_intervals = get_beat_intervals(beats)
-    beat_positions = beats.positions.astype(int)
-
-    good_intervals = []
-    good_positions = []
-    keep = True
+    meter augmentation compiled from a pattern over the beats of the source
+    meter (see `parse_pattern`).
 
-    for ival, val in zip(beat_intervals, beat_positions):
-        if val == 1:
-            if keep:
-                good_intervals.append(ival)
-                good_positions.append(val)
-                keep = False
-            else:
-                keep = True
-        else:
-            good_intervals.append(ival)
-            good_positions.append(val)
+    the pattern is compiled into two tables indexed by (bar phase, beat):
+    how many times each source beat interval is played and where its first
+    copy lands inside the output bar(s). applying the transform to a track is
+    then a couple of vectorized lookups over its BeatGrid.
 
-    corrected_intervals = correct_annotations(beats, good_intervals)
-    corrected_positions = correct_positions(good_positions, 7)
+    bar phases are counted from the first downbeat of the track, so a leading
+    incomplete bar belongs to the last phase. beats whose position exceeds the
+    source meter are dropped.
 
-    y2 = remix(y, sr, good_intervals)
+    example
+    ---
+        to_64 = MeterTransform("4/4", "6/4", "every other bar drop 1-2")
+        y2, sr, corrected_intervals, corrected_positions = to_64(dataset, track_id)
+    """
 
-    return y2, corrected_intervals, corrected_positions
+    def __init__(self, source, target, pattern):
+        self.source = source
+        self.target = target
+        self.pattern = pattern
+
+        self.source_beats = int(source.split("/")[0])
+        self.target_beats = int(target.split("/")[0])
+
+        clauses = parse_pattern(pattern)
+        period = np.lcm.reduce([1] + [c[0] for c in clauses])
+
+        counts = np.ones((period, self.source_beats), dtype=np.int64)
+        for clause_period, phase, operation, beats in clauses:
+            if max(beats) > self.source_beats or min(beats) < 1:
+                raise ValueError(f"pattern '{pattern}' has beats outside of {source}")
+            bars = np.arange(phase, period, clause_period)
+            idx = np.ix_(bars, np.asarray(beats) - 1)
+            if operation == "drop":
+                counts[idx] = 0
+            else:
+                counts[idx] += 1
+
+        # the beats of a period of source bars must fill complete output
+        # bars, or a whole number of periods must fill one output bar, so
+        # that output bars start on source downbeats
+        n_beats = counts.sum()
+        if n_beats == 0:
+            raise ValueError(f"pattern '{pattern}' drops all the beats")
+        if n_beats % self.target_beats and self.target_beats % n_beats:
+            raise ValueError(
+                f"pattern '{pattern}' plays {n_beats} beats every {period} {source} "
+                f"bar(s), which do not make whole {target} bars"
+            )
+
+        # group as many bars as needed to fill complete output bars,
+        # e.g. two 3/4 bars for one 6/8 bar
+        counts = np.tile(counts, (self.target_beats // np.gcd(n_beats, self.target_beats), 1))
+
+        self.period = len(counts)
+        self.counts = counts
+        self.offsets = (np.cumsum(counts) - counts.ravel()).reshape(counts.shape)
+
+    def __repr__(self):
+        return f"MeterTransform('{self.source}', '{self.target}', '{self.pattern}')"
+
+    def select(self, grid):
+        """
+        select the beat intervals of a track
+
+        return
+        ---
+            keep : np.array
+                indices in `grid.intervals` of the intervals to play, in order
+            positions : np.array
+                beat positions of the kept intervals in the target meter
+        """
+        positions = grid.positions[:-1]
+        anchor = grid.bars[grid.downbeats[0]] if len(grid.downbeats) else 0
+        phase = (grid.bars[:-1] - anchor) % self.period
+
+        valid = (positions >= 1) & (positions <= self.source_beats)
+        beat = np.where(valid, positions, 1) - 1
+        counts = np.where(valid, self.counts[phase, beat], 0)
+
+        keep = np.repeat(np.arange(len(positions)), counts)
+        first = np.repeat(self.offsets[phase, beat], counts)
+        copy = np.arange(len(keep)) - np.repeat(np.cumsum(counts) - counts, counts)
+
+        return keep, (first + copy) % self.target_beats + 1
+
+    def __call__(self, dataset, track_id, grid=None, **kwargs):
+        """
+        augment a track
+
+        return
+        ---
+            y2 : np.array
+                augmented audio
+            sr : float
+                sampling rate
+            corrected_intervals : np.array
+                beat intervals in seconds inside the augmented audio
+            corrected_positions : np.array
+                beat positions in the target meter
+        """
+        y, sr, grid = load_track(dataset, track_id, grid)
+
+        good_intervals, corrected_intervals, corrected_positions = self.intervals(grid, sr)
+
+        y2 = remix(y, good_intervals)
+
+        return y2, sr, corrected_intervals, corrected_positions
+
+    def stream(self, dataset, track_id, out_path, grid=None, **kwargs):
+        """
+        augment a track reading and writing its audio in blocks (see
+        `stream_remix`). the augmented audio is written to `out_path` at the
+        sampling rate of the source file.
+
+        return
+        ---
+            sr : float
+                sampling rate
+            corrected_intervals : np.array
+                beat intervals in seconds inside the augmented audio
+            corrected_positions : np.array
+                beat positions in the target meter
+        """
+        track = dataset.track(track_id)
+        if grid is None:
+            with profiling.stage("load_beats"):
+                grid = load_beat_grid(track)
+
+        sr = sf.info(track.audio_path).samplerate
+
+        good_intervals, corrected_intervals, corrected_positions, bars = self.intervals(
+            grid, sr, return_bars=True
+        )
+
+        with profiling.stage("stream_remix"):
+            stream_remix(track.audio_path, out_path, good_intervals, bars)
+
+        return sr, corrected_intervals, corrected_positions
+
+    def intervals(self, grid, sr, return_bars=False):
+        """
+        sample ranges of a track to remix and the corrected annotations
+
+        arguments
+        ---
+            grid : BeatGrid
+                beat grid of the track
+            sr : float
+                sampling rate of the audio the sample ranges refer to
+            return_bars : bool
+                also return the source bar of every kept interval, as passed
+                to `stream_remix`
+
+        return
+        ---
+            good_intervals : np.array
+                int64 sample ranges of the kept beat intervals, as passed to
+                `remix`
+            corrected_intervals : np.array
+                beat intervals in seconds inside the augmented audio
+            corrected_positions : np.array
+                beat positions in the target meter
+            bars : np.array
+                source bar of every kept interval, only if `return_bars`
+        """
+        with profiling.stage("intervals"):
+            keep, corrected_positions = self.select(grid)
+            good_intervals = time_to_samples(grid.intervals, sr)[keep]
+            corrected_intervals = correct_annotations(good_intervals, sr)
+        if return_bars:
+            return good_intervals, corrected_intervals, corrected_positions, grid.bars[keep]
+        return good_intervals, corrected_intervals, corrected_positions
+
+    def virtual(self, dataset, track_id, sr, grid=None, **kwargs):
+        """
+        augment a track without touching its audio, for an edit list (see
+        `edit_list.py`). `sr` is the rate the audio is decoded at when the
+        edit list is rendered
+
+        return
+        ---
+            remix_intervals : np.array
+                int64 sample ranges of the source to concatenate
+            corrected_intervals : np.array
+                beat intervals in seconds inside the augmented audio
+            corrected_positions : np.array
+                beat positions in the target meter
+        """
+        if grid is None:
+            with profiling.stage("load_beats"):
+                grid = load_beat_grid(dataset.track(track_id))
+
+        good_intervals, corrected_intervals, corrected_positions = self.intervals(grid, sr)
+
+        return remix_intervals(good_intervals), corrected_intervals, corrected_positions
+
+
+METER_TRANSFORMS = {
+    # remove two beat bars
+    "24": MeterTransform("4/4", "2/4", "drop 3-4"),
+    # remove one beat interval from each bar
+    "34": MeterTransform("4/4", "3/4", "drop beat 4"),
+    # repeat one beat interval per bar
+    "54": MeterTransform("4/4", "5/4", "repeat beat 3"),
+    # remove two beat intervals for every other bar
+    "64": MeterTransform("4/4", "6/4", "every other bar drop 1-2"),
+    # remove one beat interval for every other bar
+    "74": MeterTransform("4/4", "7/4", "every other bar drop 1"),
+    # group pairs of 3/4 bars
+    "68": MeterTransform("3/4", "6/8", "keep"),
+}
+
+
+def get_transform(target_augmentation):
+    """
+    return the MeterTransform of a target augmentation, e.g. "34" for 3/4
+    """
+    try:
+        return METER_TRANSFORMS[target_augmentation]
+    except KeyError:
+        raise ValueError(
+            f"unknown target augmentation {target_augmentation}. "
+            f"available: {list(METER_TRANSFORMS)}"
+        )
@@ -0,0 +1,518 @@
+"""
+Pack augmented tracks into large shard files for sequential reading
+
+the augmented datasets are thousands of small wav, .beats and .meter files,
+so reading them in random order is seek-bound on spinning disks and network
+storage. this script packs them into flat binary shards of about
+`--shard_size` bytes: the raw arrays of the tracks are concatenated (aligned
+to 64 bytes, so that they can also be memory mapped), and `index.json` holds
+the offset, dtype and shape of every array together with its annotations
+(beats, meter, target augmentation, sampling rate). tracks are shuffled
+before packing, so that every shard is a random sample of the corpus.
+
+`iterate` streams the tracks back: shards are read front to back in a
+background thread that keeps `prefetch` tracks ahead, and a shuffle buffer
+mixes tracks across shards. `read_track` gives random access to a single
+track through a memory map.
+
+layouts that can be packed:
+    `{path}/{ta}/audio/*.wav`: output of `augment_dataset.py`, or `*.edl`
+        with `--virtual`, rendered from the source audio
+    `{path}/audio/*.wav`: a flat folder, e.g. the timeshift augmentation
+with annotations in `annotations/beats/{name}.beats` and
+`annotations/meter/{name}.meter` next to `audio`. `.npy` files in the audio
+folder (e.g. precomputed spectrograms) are packed as "spect" arrays.
+
+example usage
+---
+pack the gtzan augmentations into shards of 512 MB:
+
+    python pack_shards.py \
+            --input_paths /home/Documents/datasets/gtzan_genre_augmented \
+                ../timeshift-augmentation/augmented_guitarset_dataset \
+            --output_path /home/Documents/datasets/packed \
+            --shard_size 512000000 \
+            --verify
+
+    # in python
+    import pack_shards
+    for track in pack_shards.iterate("/home/Documents/datasets/packed", shuffle_buffer=256):
+        y, sr, beats = track["audio"], track["sr"], track["beats"]
+"""
+
+import argparse
+import glob
+import json
+import os
+import queue
+import random
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+INDEX_FILE = "index.json"
+ALIGNMENT = 64
+# edit lists (.edl) of `augment_dataset.py --virtual` are rendered when packed
+AUDIO_EXTENSIONS = (".wav", ".flac", ".edl")
+# read size of the shard files, large enough that a spinning disk streams
+READ_BUFFER = 16 * 2**20
+
+
+def find_tracks(path):
+    """
+    audio and annotation files of every track under `path`
+
+    return
+    ---
+        tracks : list[dict]
+            id, dataset, target augmentation (None for a flat folder), and the
+            paths of the array, beats and meter files (None if missing)
+    """
+    dataset = os.path.basename(os.path.normpath(path))
+    if os.path.isdir(os.path.join(path, "audio")):
+        roots = [(path, None)]
+    else:
+        roots = [
+            (os.path.dirname(audio_path), os.path.basename(os.path.dirname(audio_path)))
+            for audio_path in sorted(glob.glob(os.path.join(path, "*", "audio")))
+        ]
+
+    tracks = []
+    for root, target in roots:
+        for name in sorted(os.listdir(os.path.join(root, "audio"))):
+            track_id, ext = os.path.splitext(name)
+            if ext not in AUDIO_EXTENSIONS + (".npy",):
+                continue
+            beats_file = os.path.join(root, "annotations", "beats", f"{track_id}.beats")
+            meter_file = os.path.join(root, "annotations", "meter", f"{track_id}.meter")
+            tracks.append(
+                {
+                    "id": track_id,
+                    "dataset": dataset,
+                    "target": target,
+                    "array_path": os.path.join(root, "audio", name),
+                    "beats_path": beats_file if os.path.exists(beats_file) else None,
+                    "meter_path": meter_file if os.path.exists(meter_file) else None,
+                }
+            )
+    return tracks
+
+
+def load_array(array_path, dtype="int16"):
+    """
+    array of a track: the samples of an audio file (or rendered edit list)
+    read as `dtype`, or the content of a .npy file
+
+    return
+    ---
+        key : str
+            "audio" or "spect"
+        array : np.array
+        sr : int or None
+            sampling rate of audio files
+    """
+    if array_path.endswith(".npy"):
+        return "spect", np.load(array_path), None
+    if array_path.endswith(".edl"):
+        from dataset import load_audio
+
+        y, sr = load_audio(array_path)
+        if np.dtype(dtype) == np.int16:
+            # as soundfile writes float samples to 16 bit files
+            y = np.rint(np.clip(y, -1.0, 1.0) * 32767)
+        return "audio", y.astype(dtype), int(sr)
+    import soundfile as sf
+
+    y, sr = sf.read(array_path, dtype=dtype)
+    return "audio", y, sr
+
+
+def load_annotations(track):
+    """
+    beats (time, position) as a list of pairs and meter of a track, None if
+    they are missing
+    """
+    beats = meter = None
+    if track["beats_path"] is not None:
+        beats = np.loadtxt(track["beats_path"], ndmin=2).tolist()
+    if track["meter_path"] is not None:
+        with open(track["meter_path"]) as f:
+            meter = f.read().strip()
+    return beats, meter
+
+
+class _ShardWriter:
+    """
+    writes arrays to numbered shard files, starting a new one when the next
+    array would exceed `shard_size`. shards are written to a temporary file
+    and renamed when they are complete
+    """
+
+    def __init__(self, output_path, shard_size):
+        self.output_path = output_path
+        self.shard_size = shard_size
+        self.shards = []
+        self._file = None
+        self._tmp_path = None
+        self._size = 0
+
+    def _open(self):
+        fd, self._tmp_path = tempfile.mkstemp(dir=self.output_path, suffix=".tmp")
+        self._file = os.fdopen(fd, "wb")
+        self._size = 0
+
+    def close(self):
+        if self._file is None:
+            return
+        self._file.close()
+        name = f"shard-{len(self.shards):05d}.bin"
+        os.replace(self._tmp_path, os.path.join(self.output_path, name))
+        self.shards.append(name)
+        self._file = None
+
+    def write(self, array):
+        """
+        return
+        ---
+            shard : int
+                number of the shard the array is written to
+            offset : int
+                byte offset of the array in the shard
+        """
+        data = np.ascontiguousarray(array)
+        if self._file is not None and self._size + data.nbytes > self.shard_size:
+            self.close()
+        if self._file is None:
+            self._open()
+        padding = -self._size % ALIGNMENT
+        self._file.write(b"\0" * padding)
+        offset = self._size + padding
+        self._file.write(data.tobytes())
+        self._size = offset + data.nbytes
+        return len(self.shards), offset
+
+    def abort(self):
+        if self._file is not None:
+            self._file.close()
+            os.remove(self._tmp_path)
+            self._file = None
+
+
+def pack(tracks, output_path, shard_size, dtype="int16"):
+    """
+    write tracks to shard files and their index
+
+    arguments
+    ---
+        tracks : list[dict]
+            tracks from `find_tracks`, in the order they are packed
+        output_path : str
+            folder for the shards and index.json
+        shard_size : int
+            approximate size of each shard in bytes. a track is never split,
+            so a shard can be larger if a single track is
+        dtype : str
+            dtype of the packed audio samples
+
+    return
+    ---
+        index : dict
+            the content of index.json
+    """
+    import tqdm
+
+    os.makedirs(output_path, exist_ok=True)
+    writer = _ShardWriter(output_path, shard_size)
+    entries = []
+    try:
+        for track in tqdm.tqdm(tracks):
+            key, array, sr = load_array(track["array_path"], dtype)
+            beats, meter = load_annotations(track)
+            shard, offset = writer.write(array)
+            entries.append(
+                {
+                    "id": track["id"],
+                    "dataset": track["dataset"],
+                    "target": track["target"],
+                    "key": key,
+                    "dtype": array.dtype.str,
+                    "shape": list(array.shape),
+                    "sr": sr,
+                    "shard": shard,
+                    "offset": offset,
+                    "nbytes": array.nbytes,
+                    "beats": beats,
+                    "meter": meter,
+                }
+            )
+        writer.close()
+    except BaseException:
+        writer.abort()
+        raise
+
+    index = {
+        "version": 1,
+        "alignment": ALIGNMENT,
+        "shards": writer.shards,
+        "tracks": entries,
+    }
+    # the index is written last, so a pack without index.json is incomplete
+    fd, tmp_path = tempfile.mkstemp(dir=output_path, suffix=".tmp")
+    with os.fdopen(fd, "w") as f:
+        json.dump(index, f)
+    os.replace(tmp_path, os.path.join(output_path, INDEX_FILE))
+    return index
+
+
+def read_index(path):
+    """
+    index of a pack, from its folder or its index.json
+    """
+    if os.path.isdir(path):
+        path = os.path.join(path, INDEX_FILE)
+    with open(path) as f:
+        index = json.load(f)
+    index["path"] = os.path.dirname(os.path.abspath(path))
+    return index
+
+
+def _track_dict(entry, array):
+    track = {
+        k: entry[k] for k in ("id", "dataset", "target", "sr", "meter")
+    }
+    track["beats"] = None if entry["beats"] is None else np.asarray(entry["beats"])
+    track[entry["key"]] = array
+    return track
+
+
+def read_track(index, i):
+    """
+    random access to track `i` of a pack, with its array memory mapped
+    """
+    entry = index["tracks"][i]
+    array = np.memmap(
+        os.path.join(index["path"], index["shards"][entry["shard"]]),
+        dtype=np.dtype(entry["dtype"]),
+        mode="r",
+        offset=entry["offset"],
+        shape=tuple(entry["shape"]),
+    )
+    return _track_dict(entry, array)
+
+
+def _read_shards(index, shards, out, stop):
+    """
+    read the tracks of `shards` in file order and put them in the `out` queue,
+    followed by None. exceptions are forwarded through the queue
+    """
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                out.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    by_shard = {}
+    for entry in index["tracks"]:
+        by_shard.setdefault(entry["shard"], []).append(entry)
+    try:
+        for shard in shards:
+            path = os.path.join(index["path"], index["shards"][shard])
+            entries = sorted(by_shard.get(shard, []), key=lambda e: e["offset"])
+            with open(path, "rb", buffering=READ_BUFFER) as f:
+                for entry in entries:
+                    # only skips the alignment padding, within the read buffer
+                    if f.tell() != entry["offset"]:
+                        f.seek(entry["offset"])
+                    array = np.empty(entry["shape"], dtype=np.dtype(entry["dtype"]))
+                    if f.readinto(memoryview(array).cast("B")) != entry["nbytes"]:
+                        raise EOFError(f"{path} is truncated")
+                    if not put(_track_dict(entry, array)):
+                        return
+        put(None)
+    except BaseException as e:
+        put(e)
+
+
+def iterate(path, shuffle_buffer=0, prefetch=64, seed=None, worker=None, epochs=1):
+    """
+    stream the tracks of a pack
+
+    arguments
+    ---
+        path : str
+            folder of the pack or its index.json
+        shuffle_buffer : int
+            number of tracks to draw from at random. 0 keeps the order of the
+            pack (the shard order is still shuffled if `seed` is set)
+        prefetch : int
+            number of tracks read ahead by the background thread
+        seed : int
+            seed of the shard order and the shuffle buffer. if None, the
+            shards are read in order
+        worker : tuple
+            (i, n) to only read the shards i, i + n, i + 2n, ..., e.g. one
+            part per data loading worker
+        epochs : int
+            number of passes over the shards, None to loop forever
+
+    return
+    ---
+        tracks : generator of dict
+            id, dataset, target, sr, meter, beats (np.array of time and
+            position) and "audio" or "spect" array of every track
+    """
+    index = read_index(path)
+    shards = list(range(len(index["shards"])))
+    if worker is not None:
+        shards = shards[worker[0] :: worker[1]]
+    rng = random.Random(seed)
+
+    epoch = 0
+    while epochs is None or epoch < epochs:
+        order = list(shards)
+        if seed is not None:
+            rng.shuffle(order)
+        out = queue.Queue(maxsize=max(prefetch, 1))
+        stop = threading.Event()
+        reader = threading.Thread(
+            target=_read_shards, args=(index, order, out, stop), daemon=True
+        )
+        reader.start()
+        try:
+            buffer = []
+            while True:
+                track = out.get()
+                if track is None:
+                    break
+                if isinstance(track, BaseException):
+                    raise track
+                if len(buffer) < shuffle_buffer:
+                    buffer.append(track)
+                    continue
+                if not buffer:
+                    yield track
+                    continue
+                # yield a random track of the buffer and replace it
+                j = rng.randrange(len(buffer))
+                yield buffer[j]
+                buffer[j] = track
+            rng.shuffle(buffer)
+            yield from buffer
+        finally:
+            stop.set()
+            reader.join()
+        epoch += 1
+
+
+def verify(tracks, output_path, dtype="int16"):
+    """
+    stream the pack back and compare every track with its source files
+
+    return
+    ---
+        errors : list[str]
+            tracks that are missing or differ
+    """
+    sources = {(t["dataset"], t["target"], t["id"]): t for t in tracks}
+    errors = []
+    seen = set()
+    num_bytes = 0
+    start = time.perf_counter()
+    for track in iterate(output_path):
+        key = (track["dataset"], track["target"], track["id"])
+        seen.add(key)
+        source = sources.get(key)
+        if source is None:
+            errors.append(f"{key}: not in the sources")
+            continue
+        array_key, array, sr = load_array(source["array_path"], dtype)
+        beats, meter = load_annotations(source)
+        packed = track[array_key]
+        num_bytes += packed.nbytes
+        if not np.array_equal(packed, array) or track["sr"] != sr:
+            errors.append(f"{key}: {array_key} differs")
+        if (beats is None) != (track["beats"] is None) or (
+            beats is not None and not np.array_equal(track["beats"], beats)
+        ):
+            errors.append(f"{key}: beats differ")
+        if track["meter"] != meter:
+            errors.append(f"{key}: meter differs")
+    errors.extend(f"{key}: missing" for key in sources if key not in seen)
+    seconds = time.perf_counter() - start
+    print(f"read {num_bytes / 1e6:.1f} MB in {seconds:.1f} s (including the sources)")
+    return errors
+
+
+def create_parser():
+    """
+    creates ArgumentParser
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--input_paths",
+        type=str,
+        nargs="+",
+        required=True,
+        help="augmented dataset folders ({path}/{ta}/audio) or flat folders ({path}/audio)",
+    )
+    parser.add_argument(
+        "--output_path",
+        type=str,
+        required=True,
+        help="folder for the shards and index.json",
+    )
+    parser.add_argument(
+        "--shard_size",
+        type=int,
+        default=256 * 2**20,
+        help="approximate size of each shard in bytes (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--dtype",
+        type=str,
+        choices=("int16", "float32"),
+        default="int16",
+        help="dtype of the packed audio samples (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=0,
+        help="seed of the order in which tracks are packed (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--verify",
+        action="store_true",
+        help="read the pack back and compare it with the source files",
+    )
+    return parser
+
+
+if __name__ == "__main__":
+    args = create_parser().parse_args()
+
+    tracks = [t for path in args.input_paths for t in find_tracks(path)]
+    if not tracks:
+        raise SystemExit(f"no tracks found in {args.input_paths}")
+    random.Random(args.seed).shuffle(tracks)
+
+    index = pack(tracks, args.output_path, args.shard_size, args.dtype)
+    num_bytes = sum(t["nbytes"] for t in index["tracks"])
+    print(
+        f"packed {len(index['tracks'])} tracks ({num_bytes / 1e6:.1f} MB) "
+        f"into {len(index['shards'])} shards in {args.output_path}"
+    )
+
+    if args.verify:
+        errors = verify(tracks, args.output_path, args.dtype)
+        for error in errors:
+            print(f"ERROR {error}")
+        if errors:
+            raise SystemExit(1)
+        print("pack verified")
@@ -14,12 +14,10 @@ import os
 import shutil
 from collections import Counter
 
-import mirdata
-import numpy as np
-from tqdm import tqdm
-
 
 def infer_meter(track):
+    import numpy as np
+
     try:
         beat_positions = track.beats.positions
         c = Counter(beat_positions[np.where(np.diff(beat_positions) < 0)])
@@ -47,6 +45,11 @@ def create_parser():
 
 if __name__ == "__main__":
     args = create_parser().parse_args()
+
+    # only needed past argument parsing
+    import mirdata
+    from tqdm import tqdm
+
     audio_folder = os.path.join(args.output_path, "audio")
     annotations_folder = os.path.join(args.output_path, "annotations")
     beats_folder = os.path.join(annotations_folder, "beats")
@@ -0,0 +1,131 @@
+"""
+Lightweight instrumentation for the augmentation scripts
+
+stages are timed with the `stage` context manager and accumulated in a
+module-level registry, so that `augment()` and the `to_XX` functions can be
+instrumented without passing a profiler around.
+
+example usage
+---
+    import profiling
+
+    with profiling.stage("load"):
+        y, sr = track.audio
+    profiling.add_bytes("read", os.path.getsize(track.audio_path))
+
+    profiling.print_summary()
+    profiling.to_json("augment_timings.json")
+"""
+
+import json
+import os
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+_timings = defaultdict(lambda: {"calls": 0, "seconds": 0.0})
+_bytes = defaultdict(int)
+
+
+@contextmanager
+def stage(name):
+    """
+    time the enclosed block and accumulate it under `name`
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _timings[name]["calls"] += 1
+        _timings[name]["seconds"] += time.perf_counter() - start
+
+
+def add_bytes(kind, n_bytes):
+    """
+    add `n_bytes` to the `kind` counter, e.g. "read" or "written"
+    """
+    _bytes[kind] += int(n_bytes)
+
+
+def add_file_bytes(kind, path):
+    """
+    add the size of the file in `path` to the `kind` counter. missing files
+    (e.g. mirdata tracks with no local audio path) are ignored
+    """
+    if path is not None and os.path.isfile(path):
+        add_bytes(kind, os.path.getsize(path))
+
+
+def reset():
+    """
+    clear all the accumulated timings and counters
+    """
+    _timings.clear()
+    _bytes.clear()
+
+
+def summary():
+    """
+    return the accumulated timings and counters as a dictionary
+    """
+    total = sum(t["seconds"] for t in _timings.values())
+    stages = {
+        name: {
+            "calls": t["calls"],
+            "seconds": t["seconds"],
+            "mean_seconds": t["seconds"] / t["calls"] if t["calls"] else 0.0,
+            "percent": 100 * t["seconds"] / total if total else 0.0,
+        }
+        for name, t in sorted(_timings.items(), key=lambda x: -x[1]["seconds"])
+    }
+    return {"stages": stages, "bytes": dict(_bytes), "total_seconds": total}
+
+
+def print_summary():
+    """
+    print a table with time spent per stage and the bytes counters
+    """
+    s = summary()
+    print(f"{'stage':<20}{'calls':>8}{'total (s)':>12}{'mean (s)':>12}{'%':>8}")
+    for name, t in s["stages"].items():
+        print(
+            f"{name:<20}{t['calls']:>8}{t['seconds']:>12.3f}"
+            f"{t['mean_seconds']:>12.4f}{t['percent']:>8.1f}"
+        )
+    for kind, n_bytes in s["bytes"].items():
+        print(f"bytes {kind}: {n_bytes / 2**20:.1f} MiB")
+
+
+def to_json(path):
+    """
+    export the summary to a json file
+    """
+    with open(path, "w") as f:
+        json.dump(summary(), f, indent=4)
+
+
+@contextmanager
+def profile(output_prefix, n_stats=20):
+    """
+    run cProfile and tracemalloc on the enclosed block. cProfile stats are
+    dumped to `{output_prefix}.prof` and the top `n_stats` functions by
+    cumulative time are printed together with the peak traced memory
+    """
+    import cProfile
+    import pstats
+    import tracemalloc
+
+    profiler = cProfile.Profile()
+    tracemalloc.start()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        profiler.dump_stats(f"{output_prefix}.prof")
+        pstats.Stats(profiler).sort_stats("cumulative").print_stats(n_stats)
+        print(f"peak traced memory: {peak / 2**20:.1f} MiB")
+        print(f"cProfile stats written to {output_prefix}.prof")
@@ -1,11 +1,6 @@
 import os
 from collections import Counter
 
-import numpy as np
-from mirdata import initialize
-
-from dataset import Dataset
-
 
 def get_split_tracks(split_file):
     """
@@ -22,6 +17,8 @@ def custom_dataset_loader(path, dataset_name, folder="datasets"):
     """
     loads a custom dataset
     """
+    from dataset import Dataset
+
     print(f"Loading {dataset_name} through custom loader")
     datasetdir = os.path.join(path, folder, dataset_name)
     dataset = Dataset(
@@ -47,6 +44,7 @@ def multi_dataset_loader(data_home, dataset_names):
            dictionary with mirdata.Track information
 
     """
+    from mirdata import initialize
 
     tracks = {}
     augs = ["_24", "_34", "_64"]
@@ -170,6 +168,8 @@ def dataset_meter(dataset):
         dictionary of type {track_id: meter}
 
     """
+    import numpy as np
+
     dataset_meter = {}
 
     for t in dataset.track_ids: